@@ -0,0 +1,125 @@
+""" Per-frame cost of the table-driven codec paths vs. the original ones.
+
+Run with:  python benchmarks/codec_tables_microbench.py
+"""
+from spana.encoder import Encoder, Decoder, encode_samples, header_bits, byte_to_nibbles, SAMPLES_PER_FRAME
+import numpy as np
+import timeit
+
+
+# --- the pre-table implementations, kept here only for comparison ---
+
+def old_nibble_to_signed(b:int):
+    if b > 7:
+        return b - 16
+    return b
+
+def old_header_bits(g, keep_going) -> int:
+    g = int(g)
+    keep_going = 1 if bool(keep_going) else 0
+    assert 0 <= g <= 7
+    return (int(f"{g:03b}"[::-1],2)<<1) | keep_going
+
+def old_extract_frame_fields(frame:bytes):
+    steps = []
+    nts = old_nibble_to_signed
+
+    step0, hb = byte_to_nibbles(frame[0])
+    steps.append( nts(step0) )
+
+    rev_g = ((hb&0b1110) >> 1)
+    g = int(f"{rev_g:03b}"[::-1],2)
+    keep_going = bool(hb&0b1)
+
+    for byte_idx in range(1,11+1):
+        nh, nl = byte_to_nibbles(frame[byte_idx])
+        nh = nts(nh)
+        nl = nts(nl)
+        if byte_idx %3 == 2:
+            steps.append(nh)
+            steps.append(nl)
+        else:
+            steps.append(nl)
+            steps.append(nh)
+    return steps, g, keep_going
+
+def old_encode_samples(x, hb):
+    try:
+        it = iter(x)
+        while True:
+            s = next(it)
+            assert -8 <= s < 8
+            yield ((s&0b1111)<<4) | hb
+            del s
+
+            for byte_idx in range(1,11+1):
+                s1 = next(it)
+                assert -8 <= s1 < 8
+                s2 = next(it)
+                assert -8 <= s2 < 8
+
+                if byte_idx %3 == 2:
+                    s2,s1 = s1,s2
+                yield ((s2&0b1111)<<4) | (s1&0b1111)
+    except StopIteration:
+        pass
+
+
+def old_encode_frame_at_gain(s, g:int, s_init:int):
+    gain = 2**g
+    cur = s_init
+    steps = np.zeros([23], dtype=np.int8)
+    error = np.zeros([23])
+    for idx in range(23):
+        step = np.round((s[idx] - cur)/gain).astype(int).clip(-8,+7)
+        steps[idx] = step
+        cur = cur + step * gain
+        error[idx] = s[idx] - cur
+
+    sample_list = list(int(x) for x in old_encode_samples(steps, old_header_bits(g=g, keep_going=True)))
+    sample_list = [ (x if x >=0 else x%256) for x in sample_list ]
+    return (bytes(sample_list), np.sum(error**2), cur)
+
+def old_encode_frame(s, last_sample:int = 0):
+    # one Python loop per candidate gain, keeping the first best score
+    best_encoding_so_far = None
+    for g in range(0,6+1):
+        tup = old_encode_frame_at_gain(s, g, last_sample)
+        if (best_encoding_so_far is None) or (tup[1] < best_encoding_so_far[1]):
+            best_encoding_so_far = tup
+    return best_encoding_so_far
+
+
+def per_frame_us(fn, number:int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def main():
+    rnd = np.random.default_rng(0)
+    frame = bytes(rnd.integers(0, 256, size=12, dtype=np.uint8))
+    steps = rnd.integers(-8, 8, size=SAMPLES_PER_FRAME).tolist()
+    samples = (300*np.sin(np.arange(SAMPLES_PER_FRAME)/3)).round().astype(np.int64)
+
+    cases = [
+        ("header_bits",
+            lambda: old_header_bits(3, True),
+            lambda: header_bits(3, True)),
+        ("extract_frame_fields",
+            lambda: old_extract_frame_fields(frame),
+            lambda: Decoder.extract_frame_fields(frame)),
+        ("encode_samples (1 frame)",
+            lambda: bytes(old_encode_samples(steps, 0b1101)),
+            lambda: bytes(encode_samples(steps, 0b1101))),
+        ("Encoder.encode_frame",
+            lambda: old_encode_frame(samples),
+            lambda: Encoder().encode_frame(samples)),
+    ]
+
+    print(f"{'per-frame cost':32s} {'before (us)':>12s} {'after (us)':>12s} {'speedup':>8s}")
+    for name, before, after in cases:
+        number = 200 if "Encoder" in name else 20000
+        t_before = per_frame_us(before, number)
+        t_after = per_frame_us(after, number)
+        print(f"{name:32s} {t_before:12.2f} {t_after:12.2f} {t_before/t_after:7.2f}x")
+
+if __name__ == "__main__":
+    main()
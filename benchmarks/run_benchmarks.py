@@ -0,0 +1,200 @@
+""" Timing suite for the codec, offset table, trace parser and voice pack compiler.
+
+Everything runs on synthetic data (plus voice_packs/snoop_dogg for the compile),
+so no flash image or capture log is needed.  Results are written as JSON and,
+if a baseline is given, compared against it:
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --threshold 0.25
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --update-baseline
+
+Exits with status 1 if any benchmark is more than --threshold slower than its
+baseline.  Timings are the best of --repeat runs.
+"""
+from spana.encoder import Encoder, Decoder
+from spana.offset_table import OffsetTableDb, PRESUMED_OFFSET_TABLE_LENGTH
+from spana.parse_trace import parse_read_operations, parse_read_operations_fast
+from spana.synthetic import synthetic_speech, synthetic_image, write_em100_log
+import numpy as np
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import typing
+
+this_file_dir = os.path.dirname(os.path.normpath(__file__))
+DEFAULT_BASELINE = os.path.join(this_file_dir, "baseline.json")
+SNOOP_DOGG_WAV_DIR = os.path.join(this_file_dir, "..", "voice_packs", "snoop_dogg")
+
+RESULTS_VERSION = 1
+
+
+# --- benchmarks ---
+# each one sets up its data and returns (function to time, number of calls per timing, {unit: amount per call})
+
+def bench_encode_fully():
+    s = synthetic_speech(23*1000)
+    enc = Encoder()
+    return (lambda: enc.encode_fully(s)), 1, dict(samples=len(s))
+
+def bench_decode_fully():
+    encoded = Encoder().encode_fully(synthetic_speech(23*1000))
+    dec = Decoder()
+    return (lambda: dec.decode_fully(io.BytesIO(encoded))), 1, dict(bytes=len(encoded))
+
+def bench_decode_array():
+    encoded = Encoder().encode_fully(synthetic_speech(23*1000))
+    dec = Decoder()
+    return (lambda: dec.decode_array(encoded)), 50, dict(bytes=len(encoded))
+
+def bench_offset_table_from_flash_image():
+    image, _ = synthetic_image(samples_per_entry=2000)
+    image = image.tobytes()
+    return (lambda: OffsetTableDb.from_flash_image(image)), 50, dict(entries=PRESUMED_OFFSET_TABLE_LENGTH)
+
+def bench_offset_table_generate_bytes():
+    _, otd = synthetic_image(samples_per_entry=2000)
+    return (lambda: otd.generate_bytes_for_image()), 1000, dict(entries=len(otd))
+
+def synthetic_log(size:int=5*2**20) -> str:
+    image, otd = synthetic_image(samples_per_entry=2000)
+    log_fo = io.StringIO()
+    write_em100_log(log_fo, image, otd, size)
+    return log_fo.getvalue()
+
+def bench_parse_read_operations(parse=parse_read_operations):
+    log = synthetic_log()
+    def run():
+        for _ in parse(io.StringIO(log)):
+            pass
+    return run, 1, dict(bytes=len(log))
+
+def bench_parse_read_operations_fast():
+    return bench_parse_read_operations(parse_read_operations_fast)
+
+def bench_compile_snoop_dogg():
+    from spana.cli import main as spana_main
+
+    # removed when compile, the only thing referring to it, has been timed and dropped
+    out_dir = tempfile.TemporaryDirectory(prefix="spana_bench_")
+    def compile():
+        out_filename = os.path.join(out_dir.name, "compiled_voice_pack.bin")
+        with contextlib.redirect_stdout(io.StringIO()):
+            spana_main(["compile", "-d", SNOOP_DOGG_WAV_DIR, "-o", out_filename, "--no-cache"])
+    return compile, 1, dict(files=len(os.listdir(SNOOP_DOGG_WAV_DIR)))
+
+BENCHMARKS = {
+    "encode_fully": bench_encode_fully,
+    "decode_fully": bench_decode_fully,
+    "decode_array": bench_decode_array,
+    "offset_table_from_flash_image": bench_offset_table_from_flash_image,
+    "offset_table_generate_bytes": bench_offset_table_generate_bytes,
+    "parse_read_operations": bench_parse_read_operations,
+    "parse_read_operations_fast": bench_parse_read_operations_fast,
+    "compile_snoop_dogg": bench_compile_snoop_dogg,
+}
+SLOW_BENCHMARKS = { "compile_snoop_dogg" }
+
+
+def run_benchmark(name:str, repeat:int) -> dict:
+    fn, number, per_call = BENCHMARKS[name]()
+    if name in SLOW_BENCHMARKS:
+        repeat = min(repeat, 2)
+    times = [ t / number for t in timeit.repeat(fn, number=number, repeat=repeat) ]
+    seconds = min(times)
+    return dict(
+        seconds=seconds,
+        median_seconds=float(np.median(times)),
+        repeat=repeat,
+        number=number,
+        per_second={ unit: amount / seconds for (unit, amount) in per_call.items() },
+    )
+
+
+def run_all(names:typing.Sequence[str], repeat:int) -> dict:
+    results = {}
+    for name in names:
+        t_start = time.perf_counter()
+        results[name] = run_benchmark(name, repeat)
+        rates = ", ".join(f"{v:,.0f} {unit}/s" for (unit, v) in results[name]["per_second"].items())
+        print(f"  {name:32s} {results[name]['seconds']*1e3:10.3f} ms  ({rates}; {time.perf_counter() - t_start:.1f}s total)")
+
+    return dict(
+        version=RESULTS_VERSION,
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        machine=dict(python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count(),
+                     numpy=np.__version__),
+        results=results,
+    )
+
+
+def compare(results:dict, baseline:dict, threshold:float) -> typing.List[str]:
+    """ Prints each benchmark's time relative to the baseline; returns the names of those slower by more than threshold """
+    regressions = []
+    print(f"{'benchmark':34s} {'baseline (ms)':>14s} {'now (ms)':>10s} {'ratio':>7s}")
+    for (name, result) in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"  {name:32s} {'-':>14s} {result['seconds']*1e3:10.3f}   (no baseline)")
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"  {name:32s} {base['seconds']*1e3:14.3f} {result['seconds']*1e3:10.3f} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("run_benchmarks", description="Time spana's codec, offset table, trace parser and compiler on synthetic data")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help=f"Compare against this results file (e.g. {os.path.relpath(DEFAULT_BASELINE)})")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Fail if a benchmark is more than this fraction slower than its baseline (default: %(default)s)")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results over --baseline instead of comparing")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing runs per benchmark, the best is kept (default: %(default)s)")
+    parser.add_argument("--skip-slow", action="store_true", help=f"Skip {', '.join(sorted(SLOW_BENCHMARKS))}")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [ name for name in names if name not in BENCHMARKS ]
+    if unknown:
+        raise SystemExit(f"error: unknown benchmark(s) {unknown}, choose from {list(BENCHMARKS)}")
+    if args.skip_slow:
+        names = [ name for name in names if name not in SLOW_BENCHMARKS ]
+
+    print(f"Running {len(names)} benchmarks...")
+    results = run_all(names, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as out_fo:
+            json.dump(results, out_fo, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as out_fo:
+            json.dump(results, out_fo, indent=2)
+        print(f"Wrote baseline {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as in_fo:
+            baseline = json.load(in_fo)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"No regressions (threshold {args.threshold:.0%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+from spana.cli import main
+
+main()
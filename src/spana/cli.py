@@ -0,0 +1,65 @@
+""" The `spana` command: one entry point for all of the tools.
+
+Only the module of the chosen subcommand is imported (and its own heavy
+imports are deferred until they're used), so `spana --help` and
+`spana <command> --help` start quickly.
+"""
+import importlib
+import sys
+
+# subcommand -> (module, entry point function, one-line help)
+SUBCOMMANDS = {
+    "analyze": ("spana.trace_analytics", "main", "Rebuild a word transcript and per-entry statistics from a trace"),
+    "compile": ("spana.compile_voice_pack", "main", "Build a Speak & Spell flash image from wav files"),
+    "convert-trace": ("spana.trace_recording", "main", "Convert an em100 trace log into a binary trace recording"),
+    "decode": ("spana.decode_sounds_to_wav", "decoder_main", "Decode a Speak & Spell flash image into wav files"),
+    "extract": ("spana.extract_sound_blobs_to_bin_files", "main", "Write the raw speech data of offset table entries to .bin files"),
+    "fake-em100": ("spana.fake_em100", "main", "Pretend to be em100, replaying a trace (for testing live_trace)"),
+    "frame-index": ("spana.frame_index", "main", "Show where the decoder really stops in each entry of a flash image"),
+    "split": ("spana.split_file", "main", "Split a recording into one wav file per word, at the silences"),
+    "synth": ("spana.synthetic", "main", "Generate a synthetic flash image and em100 trace log"),
+    "timing": ("spana.trace_timing", "main", "Analyze read timing and bandwidth in a trace"),
+    "trace-audio": ("spana.live_audio", "main", "Rebuild the audio the toy played from a trace"),
+    "trace": ("spana.live_trace", "main", "Run the em100 with a (possibly modified) flash image"),
+}
+
+
+def find_command(argv) -> str:
+    """ The subcommand named in argv (the first non-option argument), if any """
+    for arg in argv:
+        if not arg.startswith("-"):
+            return arg
+    return None
+
+
+def make_parser(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser("spana", description="Speak & Spell analysis tools")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    command = find_command(argv)
+    for (name, (module_name, main_name, help)) in SUBCOMMANDS.items():
+        if name != command:
+            subparsers.add_parser(name, help=help, description=help)
+            continue
+
+        # only the chosen subcommand's module gets imported
+        module = importlib.import_module(module_name)
+        subparser = subparsers.add_parser(name, help=help,
+            description=getattr(module, "DESCRIPTION", help),
+            epilog=getattr(module, "EPILOG", None))
+        module.add_arguments(subparser)
+        subparser.set_defaults(main=getattr(module, main_name))
+
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = make_parser(argv).parse_args(argv)
+    return args.main(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+""" Precomputed lookup tables for the speech codec, shared by Encoder and Decoder.
+
+The per-byte/per-frame code paths use the tuple tables (plain Python ints),
+the array code paths use the numpy tables.  The numpy tables (A_*,
+QUANT_TABLE) and QUANT_TABLE_ROWS are built on first access, so importing
+this module is cheap and does not import numpy.
+"""
+
+NUM_GAINS = 8   # g is a 3-bit field
+
+# nibble (0..15) -> signed step (-8..7)
+NIBBLE_TO_SIGNED = tuple( (x - 16 if x > 7 else x) for x in range(16) )
+
+# byte -> (signed step from high nibble, signed step from low nibble)
+BYTE_TO_STEPS_HI_LO = tuple( (NIBBLE_TO_SIGNED[b>>4], NIBBLE_TO_SIGNED[b&0xF]) for b in range(256) )
+# byte -> (signed step from low nibble, signed step from high nibble)
+BYTE_TO_STEPS_LO_HI = tuple( (lo, hi) for (hi, lo) in BYTE_TO_STEPS_HI_LO )
+
+def _reverse_3_bits(x:int) -> int:
+    return int(f"{x:03b}"[::-1],2)
+
+# header nibble (low nibble of a frame's first byte) -> (g, keep_going)
+HEADER_TO_G_KEEP_GOING = tuple( (_reverse_3_bits((h>>1)&0b111), bool(h&0b1)) for h in range(16) )
+
+# [g][keep_going] -> header nibble
+G_KEEP_GOING_TO_HEADER = tuple(
+    tuple( (_reverse_3_bits(g)<<1) | keep_going for keep_going in (0, 1) )
+    for g in range(NUM_GAINS)
+)
+
+# [hi_step][lo_step] -> byte.  Indexed directly with signed steps: negative
+# steps wrap around to the same entries as their two's-complement nibbles.
+STEPS_TO_BYTE = tuple( tuple( (hi<<4) | lo for lo in range(16) ) for hi in range(16) )
+
+
+# Quantization: the step chosen for a delta at gain 2**g is
+#   QUANT_TABLE[g, clip(delta, QUANT_DELTA_MIN, QUANT_DELTA_MAX) - QUANT_DELTA_MIN]
+# which equals clip(round_half_even(delta / 2**g), -8, 7) for integer deltas.
+# The clip range is wide enough that every gain has saturated at both ends.
+QUANT_DELTA_MIN = -9 * 2**(NUM_GAINS-1)
+QUANT_DELTA_MAX = +8 * 2**(NUM_GAINS-1)
+
+
+def _build_quant_table_rows() -> dict:
+    # per-gain rows of QUANT_TABLE as lists, for the per-sample code paths
+    # (round() rounds half-to-even, like np.rint)
+    return { "QUANT_TABLE_ROWS": tuple(
+        [ min(max(round(delta / 2**g), -8), +7) for delta in range(QUANT_DELTA_MIN, QUANT_DELTA_MAX+1) ]
+        for g in range(NUM_GAINS)
+    ) }
+
+
+def _build_array_tables() -> dict:
+    import numpy as np
+
+    tables = {}
+    tables["A_BYTE_TO_STEPS_HI_LO"] = np.array(BYTE_TO_STEPS_HI_LO, dtype=np.int64)
+    tables["A_BYTE_TO_STEPS_LO_HI"] = np.array(BYTE_TO_STEPS_LO_HI, dtype=np.int64)
+    tables["A_HEADER_TO_G"] = np.array([ g for (g, _) in HEADER_TO_G_KEEP_GOING ], dtype=np.int64)
+    tables["A_HEADER_TO_KEEP_GOING"] = np.array([ kg for (_, kg) in HEADER_TO_G_KEEP_GOING ], dtype=bool)
+
+    # Stacked byte->step-pair tables, indexed [nibble_order, byte] where
+    # nibble_order is 0 for (lo, hi) and 1 for (hi, lo)
+    tables["A_BYTE_TO_STEP_PAIR"] = np.stack([tables["A_BYTE_TO_STEPS_LO_HI"], tables["A_BYTE_TO_STEPS_HI_LO"]])
+
+    # nibble order of bytes 1..11 of a frame (every third byte, starting at byte 2, is nibble-swapped)
+    tables["A_FRAME_BYTE_NIBBLE_ORDER"] = (np.arange(1, 11+1) % 3 == 2).astype(np.int64)
+
+    # byte -> sum of its two steps (what bytes 1..11 add to a frame's running value, before gain)
+    tables["A_BYTE_TO_STEP_SUM"] = tables["A_BYTE_TO_STEPS_HI_LO"].sum(axis=1)
+
+    # [hi_step, lo_step] -> byte, indexable with signed steps like STEPS_TO_BYTE
+    tables["A_STEPS_TO_BYTE"] = np.array(STEPS_TO_BYTE, dtype=np.uint8)
+
+    tables["QUANT_TABLE"] = np.array(__getattr__("QUANT_TABLE_ROWS"), dtype=np.int64)
+    return tables
+
+ARRAY_TABLE_NAMES = (
+    "A_BYTE_TO_STEPS_HI_LO", "A_BYTE_TO_STEPS_LO_HI", "A_HEADER_TO_G", "A_HEADER_TO_KEEP_GOING",
+    "A_BYTE_TO_STEP_PAIR", "A_BYTE_TO_STEP_SUM", "A_FRAME_BYTE_NIBBLE_ORDER", "A_STEPS_TO_BYTE", "QUANT_TABLE",
+)
+
+def __getattr__(name:str):
+    # built on first access; later lookups find them in globals() directly
+    if name == "QUANT_TABLE_ROWS":
+        globals().update(_build_quant_table_rows())
+        return globals()[name]
+    if name in ARRAY_TABLE_NAMES:
+        globals().update(_build_array_tables())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,12 +1,20 @@
+from __future__ import annotations
 from spana.offset_table import OffsetTableDb, OffsetTableEntry
-from spana.encoder import Encoder
-from scipy.io.wavfile import read as wav_read, write as wav_write
-import numpy as np
+from spana.encoder import Encoder, Decoder
+from spana.image_builder import ImageBuilder, FlashCapacityExceededError, SOUND_SECTION_START_OFFSET
+from spana.encode_cache import EncodeCache, DEFAULT_ENCODE_CACHE_DIR, DEFAULT_MAX_BYTES
+from spana.lazy_import import lazy_import
 import multiprocessing
+import dataclasses
+import fractions
+import time
+import typing
 
 import glob
 import os
 
+np = lazy_import("numpy", globals())
+
 this_file_dir = os.path.dirname(os.path.normpath(__file__))
 
 def get_single_match(pattern, dir_to_search):
@@ -18,38 +26,251 @@ def get_single_match(pattern, dir_to_search):
     return os.path.join( dir_to_search, matches[0] )
 
 
-def parse_args():
-    import argparse
-
-    parser = argparse.ArgumentParser("compile_voice_pack", 
-        description="Build a Speak & Spell flash image from wav files",
-        epilog="""The directory specified with -d/--wav-dir should contain 223 WAV files (at 10kHz
-sample rate).  Each wav file should have a 3-digit (with leading zeros) number
+DESCRIPTION = "Build a Speak & Spell flash image from wav files"
+EPILOG = """The directory specified with -d/--wav-dir should contain 223 WAV files (any
+sample rate or channel count, they are resampled to 10kHz mono).  Each wav file should have a 3-digit (with leading zeros) number
 in the filename (e.g. 042_angel.wav) which indicates which record in the offset
 table it will be encoded into.
 
 See known_phrases.csv for a list of all known Speak&Spell words."""
-    )
+
+def add_arguments(parser):
     parser.add_argument("-d", "--wav-dir", required=1, type=str, help="Input search dir for wav files")
     parser.add_argument("-o", "--output-filename", type=str, help="Output filename (default: compilied_voice_pack.bin)", default="compiled_voice_pack.bin")
+    parser.add_argument("--target-size", type=lambda x: int(x, 0), default=None, help="Pick a sample rate per wav file (10, 8, 6.67 or 5kHz) so that the image's used size fits in this many bytes, e.g. 0x100000")
+    parser.add_argument("--min-snr-db", type=float, default=DEFAULT_MIN_SNR_DB, help="With --target-size, never use a sample rate whose decoded SNR (vs. the source) is below this (default: %(default)g dB)")
+    parser.add_argument("--compact", action="store_true", help="Share frames between entries' speech data (overlapping leading/trailing frames) to save flash space")
+    parser.add_argument("--usage-report", action="store_true", help="Print the address and size of every entry's speech data")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_ENCODE_CACHE_DIR, help=f"Directory for cached encoded wav files (default: {DEFAULT_ENCODE_CACHE_DIR})")
+    parser.add_argument("--no-cache", action="store_true", help="Encode every wav file, without reading or writing the cache")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES/2**20, help="Size cap of the cache, least recently used entries are evicted beyond it (default: %(default)g)")
 
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("compile_voice_pack", description=DESCRIPTION, epilog=EPILOG)
+    add_arguments(parser)
     return parser.parse_args()
 
+NORMALIZE_PEAK = 450
+TARGET_SAMPLE_RATE_HZ = 10000
+
+# rate dividers tried by --target-size, best quality first: 10kHz, 8kHz, 6.67kHz, 5kHz
+CANDIDATE_RATE_DIVIDERS = (200, 250, 300, 400)
+DEFAULT_MIN_SNR_DB = 12.0
+
+def rate_divider_to_sample_rate_Hz(rate_divider:int):
+    """ Same as OffsetTableEntry.sample_rate_Hz, but an int when it's a whole number of Hz """
+    sample_rate_Hz = 2e6 / rate_divider
+    return int(sample_rate_Hz) if sample_rate_Hz.is_integer() else sample_rate_Hz
+
 def normalize_signal(s):
     s = np.hstack([ [0], s ])
     s_max = np.abs(s).max()
-    s = (s/s_max * 450).round().astype(int)
+    s = (s/s_max * NORMALIZE_PEAK).round().astype(int)
 
     return s
 
 
-def encode_single_file(filename, out_bytes_filename=None) -> bytes:
-    sample_rate, s = wav_read(filename)
+def get_encode_settings(target_sample_rate_Hz=TARGET_SAMPLE_RATE_HZ) -> dict:
+    """ Everything besides the wav data that affects encode_single_file's output (part of the cache key) """
+    return dict(normalize_peak=NORMALIZE_PEAK, target_sample_rate_Hz=target_sample_rate_Hz)
+
+
+def load_wav_for_encoding(filename:str, target_sample_rate_Hz:float=TARGET_SAMPLE_RATE_HZ) -> typing.Tuple[np.ndarray, str]:
+    """ Reads a wav file of any sample rate, channel count and sample format, as mono samples at target_sample_rate_Hz.
+
+    Returns (samples, description of the conversion).  10kHz mono files come
+    back untouched; otherwise channels are averaged and the signal is
+    polyphase-resampled (scipy.signal.resample_poly, which also low-pass
+    filters to avoid aliasing).
+    """
+    from scipy.io.wavfile import read as wav_read
+
+    sample_rate_Hz, s = wav_read(filename)
+    num_channels = 1 if s.ndim == 1 else s.shape[1]
+    description = f"{sample_rate_Hz} Hz {s.dtype.name} x{num_channels}"
+
+    if s.dtype == np.uint8:
+        s = s.astype(np.int16) - 128        # 8-bit wav samples are unsigned
+    if num_channels > 1:
+        s = s.mean(axis=1)
+
+    if sample_rate_Hz != target_sample_rate_Hz:
+        s = resample(s, sample_rate_Hz, target_sample_rate_Hz)
+        description += f" -> {target_sample_rate_Hz:.0f} Hz"
+    return s, description
+
+
+def resample(s:np.ndarray, from_sample_rate_Hz:float, to_sample_rate_Hz:float) -> np.ndarray:
+    from scipy.signal import resample_poly
+
+    # e.g. 2e6/300 Hz is 20000/3 Hz
+    ratio = fractions.Fraction(to_sample_rate_Hz).limit_denominator(1000) / fractions.Fraction(from_sample_rate_Hz).limit_denominator(1000)
+    return resample_poly(np.asarray(s, dtype=float), ratio.numerator, ratio.denominator)
+
+
+def measure_snr_db(filename:str, encoded:bytes, sample_rate_Hz:float) -> float:
+    """ SNR of encoded (at sample_rate_Hz) against the source wav, both compared at TARGET_SAMPLE_RATE_HZ.
+
+    The decoded signal is scaled by its least-squares gain first, so only
+    distortion (codec noise, lost bandwidth) counts, not level.
+    """
+    reference, _ = load_wav_for_encoding(filename, TARGET_SAMPLE_RATE_HZ)
+    reference = np.asarray(reference, dtype=float)
+
+    decoded = Decoder().decode_array(encoded)[1:]       # [0] is the 0 that normalize_signal prepends
+    if sample_rate_Hz != TARGET_SAMPLE_RATE_HZ:
+        decoded = resample(decoded, sample_rate_Hz, TARGET_SAMPLE_RATE_HZ)
+    # a short decode is missing its tail: compare that against silence
+    decoded = np.pad(decoded, (0, len(reference) - len(decoded))) if len(decoded) < len(reference) else decoded[:len(reference)]
+
+    decoded_energy = np.dot(decoded, decoded)
+    gain = np.dot(reference, decoded) / decoded_energy if decoded_energy else 0.0
+    noise_energy = np.sum((reference - gain*decoded)**2)
+    signal_energy = np.dot(reference, reference)
+    if noise_energy == 0:
+        return float("inf")
+    return float(10*np.log10(signal_energy / noise_energy)) if signal_energy else float("-inf")
+
+
+@dataclasses.dataclass
+class EncodeTiming:
+    filename: str
+    conversion: str             # from load_wav_for_encoding
+    load_seconds: float         # read + downmix + resample
+    encode_seconds: float       # normalize + encode
+    encoded_len_bytes: int
+
+    def __str__(self):
+        return (f"{os.path.basename(self.filename)}: {self.conversion}, load {1e3*self.load_seconds:.1f} ms, "
+                f"encode {1e3*self.encode_seconds:.1f} ms, {self.encoded_len_bytes} bytes")
+
+
+def encode_wav_file(filename:str, target_sample_rate_Hz:float=TARGET_SAMPLE_RATE_HZ) -> typing.Tuple[bytes, EncodeTiming]:
+    """ encode_single_file without the cache, also returning how long each stage took """
+    t_start = time.perf_counter()
+    s, conversion = load_wav_for_encoding(filename, target_sample_rate_Hz)
+    t_loaded = time.perf_counter()
 
     s = normalize_signal(s)
 
     enc = Encoder()
-    encoded = b"".join(list(enc.encode_int_array(s)))
+    encoded = b"".join(enc.encode_int_array(s))
+    t_encoded = time.perf_counter()
+
+    return encoded, EncodeTiming(filename, conversion, t_loaded - t_start, t_encoded - t_loaded, len(encoded))
+
+
+@dataclasses.dataclass
+class EncodeResult:
+    filename: str
+    rate_divider: int
+    encoded: bytes
+    timing: typing.Optional[EncodeTiming]   # None if it came from the cache
+    snr_db: typing.Optional[float] = None   # only measured for --target-size
+
+def encode_task(task) -> EncodeResult:
+    """ Pool worker: (filename, rate_divider, cached encoded bytes or None, measure_snr) -> EncodeResult """
+    filename, rate_divider, encoded, measure_snr = task
+    sample_rate_Hz = rate_divider_to_sample_rate_Hz(rate_divider)
+
+    timing = None
+    if encoded is None:
+        encoded, timing = encode_wav_file(filename, sample_rate_Hz)
+    snr_db = measure_snr_db(filename, encoded, sample_rate_Hz) if measure_snr else None
+    return EncodeResult(filename, rate_divider, encoded, timing, snr_db)
+
+
+def encode_files(filenames:typing.Sequence[str], rate_dividers:typing.Sequence[int], cache:EncodeCache=None, measure_snr:bool=False) -> typing.Dict[typing.Tuple[str, int], EncodeResult]:
+    """ Encodes every file at every rate divider, in parallel; returns (filename, rate_divider) -> EncodeResult """
+    # cache lookups happen here, only the misses (and SNR measurements) go out to the pool
+    tasks = []
+    cache_keys = {}
+    for filename in filenames:
+        for rate_divider in rate_dividers:
+            encoded = None
+            if cache is not None:
+                key = cache_keys[(filename, rate_divider)] = cache.key_for_file(filename, get_encode_settings(rate_divider_to_sample_rate_Hz(rate_divider)))
+                encoded = cache.get(key)
+            tasks.append( (filename, rate_divider, encoded, measure_snr) )
+
+    num_to_encode = sum(1 for task in tasks if task[2] is None)
+    tasks_for_pool = tasks if measure_snr else [ task for task in tasks if task[2] is None ]
+    results = { (task[0], task[1]): EncodeResult(task[0], task[1], task[2], None) for task in tasks if task[2] is not None }
+
+    # loading/resampling happens in the workers too, overlapping with encoding
+    def report(pool_results):
+        for result in pool_results:
+            results[(result.filename, result.rate_divider)] = result
+            if result.timing is not None:
+                print(f"  {result.timing}" + (f", SNR {result.snr_db:.1f} dB" if result.snr_db is not None else ""))
+            if cache is not None and result.timing is not None:
+                cache.put(cache_keys[(result.filename, result.rate_divider)], result.encoded)
+
+    what = f"Encoding {num_to_encode} files" + (f" and measuring SNR of {len(tasks)}" if measure_snr else "")
+    t_start = time.perf_counter()
+    NUM_PROCESSES = max(1, multiprocessing.cpu_count() - 2)
+    if len(tasks_for_pool) <= 1 or NUM_PROCESSES == 1:
+        print(f"{what}...")
+        report(map(encode_task, tasks_for_pool))
+    else:
+        print(f"{what} in {NUM_PROCESSES} parallel processes...")
+        with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+            report(pool.imap_unordered(encode_task, tasks_for_pool))
+    if tasks_for_pool:
+        print(f"  done in {time.perf_counter() - t_start:.2f}s")
+
+    if cache is not None:
+        num_evicted = cache.evict()
+        print(f"  {cache.stats_str()}" + (f", evicted {num_evicted}" if num_evicted else ""))
+    return results
+
+
+def choose_rate_dividers(candidates:typing.Dict[str, typing.Sequence[EncodeResult]], budget_bytes:int, min_snr_db:float,
+                         overhead_bytes:int=0) -> typing.Dict[str, EncodeResult]:
+    """ Picks one candidate encoding per file so the total fits in budget_bytes.
+
+    Every file starts at its first (best quality) candidate.  While the total
+    is over budget, the single downgrade with the most bytes saved per dB of
+    SNR lost is applied, never to a candidate below min_snr_db.  Each file's
+    size counts overhead_bytes on top of the encoded bytes.
+    """
+    chosen = { filename: results[0] for (filename, results) in candidates.items() }
+    total_bytes = sum(len(result.encoded) + overhead_bytes for result in chosen.values())
+
+    while total_bytes > budget_bytes:
+        best = None     # (score, filename, result)
+        for (filename, results) in candidates.items():
+            current = chosen[filename]
+            for result in results:
+                saved = len(current.encoded) - len(result.encoded)
+                if saved <= 0 or result.snr_db < min_snr_db:
+                    continue
+                snr_lost = max(current.snr_db - result.snr_db, 0.1)
+                score = saved / snr_lost
+                if best is None or score > best[0]:
+                    best = (score, filename, result)
+        if best is None:
+            raise FlashCapacityExceededError(
+                f"can't fit in {budget_bytes} bytes without going below {min_snr_db} dB SNR "
+                f"(smallest that stays above it is {total_bytes} bytes)")
+        (_, filename, result) = best
+        total_bytes -= len(chosen[filename].encoded) - len(result.encoded)
+        chosen[filename] = result
+
+    return chosen
+
+
+def encode_single_file(filename, out_bytes_filename=None, cache:EncodeCache=None) -> bytes:
+    if cache is not None:
+        key = cache.key_for_file(filename, get_encode_settings())
+        encoded = cache.get(key)
+        if encoded is None:
+            encoded = encode_single_file(filename)
+            cache.put(key, encoded)
+    else:
+        encoded, _ = encode_wav_file(filename)
 
     if out_bytes_filename is not None:
         with open(out_bytes_filename, "wb") as out_fo:
@@ -58,11 +279,10 @@ def encode_single_file(filename, out_bytes_filename=None) -> bytes:
     return encoded
 
 
+def main(args=None):
 
-
-def main():
-
-    args = parse_args()
+    if args is None:
+        args = parse_args()
 
     wav_file_dir = args.wav_dir
 
@@ -85,37 +305,50 @@ def main():
     #print(f"{len(idx_to_matching_filename)=}")
     #print(f"{len(unique_filenames)=}")
 
-    NUM_PROCESSES = multiprocessing.cpu_count() - 2
-    print(f"Encoding {len(idx_to_matching_filename)} files in {NUM_PROCESSES} parallel processes...")
-    with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
-        encoded_bytes = pool.map(encode_single_file, unique_filenames)
-        filename_to_encoded_bytes = dict(zip(unique_filenames, encoded_bytes))
-    del encoded_bytes
-
-    #print(f"{len(filename_to_encoded_bytes)=}")
-
-    SOUND_SECTION = b""
-    filename_to_encoded_bytes_offset = {}
+    cache = None
+    if not args.no_cache:
+        cache = EncodeCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 2**20))
 
     prefix    = bytes.fromhex("008800 008800 008800 008800")
     separator = bytes.fromhex('008800 008800 008800 008800 008801 000000')
 
-    print(f"Allocating...")
-    # associate offset table entry to a sound
-    # "allocate" space for the sounds, update the offset table entry start addresses
-    for (filename, encoded_bytes) in filename_to_encoded_bytes.items():
-        filename_to_encoded_bytes_offset[filename] = len(SOUND_SECTION)
-        SOUND_SECTION += prefix + (encoded_bytes) +  separator*2
+    if args.target_size is None:
+        results = encode_files(unique_filenames, [CANDIDATE_RATE_DIVIDERS[0]], cache)
+        filename_to_result = { filename: results[(filename, CANDIDATE_RATE_DIVIDERS[0])] for filename in unique_filenames }
+    else:
+        print(f"Choosing sample rates to fit in {args.target_size} bytes (candidates: "
+              + ", ".join(f"{rate_divider_to_sample_rate_Hz(d):.0f} Hz" for d in CANDIDATE_RATE_DIVIDERS) + ")")
+        results = encode_files(unique_filenames, CANDIDATE_RATE_DIVIDERS, cache, measure_snr=True)
+        candidates = { filename: [ results[(filename, d)] for d in CANDIDATE_RATE_DIVIDERS ] for filename in unique_filenames }
+        try:
+            filename_to_result = choose_rate_dividers(candidates,
+                budget_bytes=args.target_size - SOUND_SECTION_START_OFFSET,
+                min_snr_db=args.min_snr_db,
+                overhead_bytes=len(prefix) + 2*len(separator))
+        except FlashCapacityExceededError as e:
+            raise SystemExit(f"error: {e}")
+
+        for filename in sorted(filename_to_result, key=os.path.basename):
+            result = filename_to_result[filename]
+            if result.rate_divider != CANDIDATE_RATE_DIVIDERS[0]:
+                print(f"  {os.path.basename(filename)}: {rate_divider_to_sample_rate_Hz(result.rate_divider):.0f} Hz, "
+                      f"{len(result.encoded)} bytes (vs {len(candidates[filename][0].encoded)}), SNR {result.snr_db:.1f} dB")
+        for rate_divider in CANDIDATE_RATE_DIVIDERS:
+            num_files = sum(1 for result in filename_to_result.values() if result.rate_divider == rate_divider)
+            print(f"  {num_files:4d} files at {rate_divider_to_sample_rate_Hz(rate_divider):.0f} Hz")
+    filename_to_encoded_bytes = { filename: result.encoded for (filename, result) in filename_to_result.items() }
 
-    #print(f"{len(SOUND_SECTION)=}")
-    SOUND_SECTION_START_OFFSET = 0x470
+    #print(f"{len(filename_to_encoded_bytes)=}")
 
-    print(f"Relocating...")
+    print(f"Allocating and relocating...")
+    # associate offset table entry to a sound, "allocate" space for the sounds
+    # (in offset table order, identical blobs stored once) and update the offset
+    # table entry start addresses
+    builder = ImageBuilder(start_addr=SOUND_SECTION_START_OFFSET)
     otd = OffsetTableDb.get_blank( num_offset_table_entries=len(idx_to_matching_filename) )
+    entry_blobs = {}
     for otd_idx in range(len(otd)):
         ote = otd.get_by_idx(otd_idx)
-        ote.sample_rate_Hz = 10000
-
         filename = idx_to_matching_filename[otd_idx]
 
         #print(f"mapping {otd_idx=} to {filename=}")
@@ -124,22 +357,28 @@ def main():
             ote.sound_data_start_addr = 0
             continue
 
-        encoded_bytes_offset = filename_to_encoded_bytes_offset[filename]
-        ote.sound_data_start_addr = SOUND_SECTION_START_OFFSET + encoded_bytes_offset
-    
-    header = otd.generate_bytes_for_image()
-    assert len(header) < SOUND_SECTION_START_OFFSET
-    header=(header+bytes([0]*SOUND_SECTION_START_OFFSET))[:SOUND_SECTION_START_OFFSET]
+        ote.rate_divider = filename_to_result[filename].rate_divider
+        entry_blobs[otd_idx] = prefix + filename_to_encoded_bytes[filename] + separator*2
+
+    try:
+        if args.compact:
+            entry_addrs = builder.add_blobs_compacted(entry_blobs)     # also checks every entry still decodes the same
+        else:
+            entry_addrs = { otd_idx: builder.add_blob(blob, entry_idx=otd_idx) for (otd_idx, blob) in entry_blobs.items() }
+        for (otd_idx, addr) in entry_addrs.items():
+            otd.get_by_idx(otd_idx).sound_data_start_addr = addr
+
+        image = builder.build(otd)
+    except FlashCapacityExceededError as e:
+        raise SystemExit(f"error: the voice pack does not fit in flash: {e}")
 
-    image = header + SOUND_SECTION
-    
-    if len(image) < 2**20:
-        image += bytes([0] * (2**20-len(image)))
+    if args.usage_report:
+        print(builder.usage_report())
+    else:
+        print(f"  {builder.usage_summary()}")
 
-    
     print(f"Saving to {args.output_filename}")
-    with open(args.output_filename, "wb") as out_fo:
-        out_fo.write(image)
+    image.save(args.output_filename)
     print(f"done")
 
 
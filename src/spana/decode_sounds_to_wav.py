@@ -1,65 +1,129 @@
-
 from spana.offset_table import OffsetTableDb
-from spana.file_paths import get_default_image_bytes, ORIGINAL_BINARY
+from spana.file_paths import get_default_image_path, ORIGINAL_BINARY
 from spana.encoder import Decoder
+from spana.flash_image import FlashImage
+from spana.frame_index import FrameIndex, DEFAULT_FRAME_INDEX_DIR
+from spana.lazy_import import lazy_import
 import os, io
-from scipy.io.wavfile import read as wav_read, write as wav_write
-import numpy as np
+import typing
+import multiprocessing
+import time
+
+np = lazy_import("numpy", globals())
 
 #import wave
 
 
+DESCRIPTION = "Decode a Speak & Spell flash image into wav files"
+
+def add_arguments(parser):
+    parser.add_argument("-o", "--output-dir", type=str, help="Output directory in which WAV files will be created (defaults to \"decoded_sounds\").  When several images are given, each gets its own subdirectory.", default="decoded_sounds")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="Number of parallel decode processes (default: number of CPUs, 1 decodes in this process)")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_FRAME_INDEX_DIR, help="Directory for cached frame indexes of the images (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Index each image's frames without reading or writing the cache")
+    parser.add_argument("image_files", nargs='*', type=str, help=f"Image file(s) to decode (if not specified, default at {ORIGINAL_BINARY} is used")
+
 def parse_args():
     import argparse
 
-    parser = argparse.ArgumentParser("decode_sounds_to_wav", 
-        description="Decode a Speak & Spell flash image into wav files")
-    parser.add_argument("-o", "--output-dir", type=str, help="Output directory in which WAV files will be created (defaults to \"decoded_sounds\")", default="decoded_sounds")
-    parser.add_argument("image_file", nargs='?', type=str, help=f"Image file to decode (if not specified, default at {ORIGINAL_BINARY} is used")
-
+    parser = argparse.ArgumentParser("decode_sounds_to_wav", description=DESCRIPTION)
+    add_arguments(parser)
     return parser.parse_args()
 
 
-def decoder_main():
+# image path -> memory-mapped FlashImage, per process.  Workers only ever
+# receive (path, offsets) so the image itself is never pickled.
+_mapped_images = {}
 
-    args = parse_args()
+def get_mapped_image(image_path:str) -> FlashImage:
+    image = _mapped_images.get(image_path)
+    if image is None:
+        image = _mapped_images[image_path] = FlashImage.from_file(image_path)
+    return image
 
-    os.makedirs(args.output_dir, exist_ok=True)
 
-    if args.image_file is None:
-        image_bytes = get_default_image_bytes()
-    else:
-        with open(args.image_file, "rb") as in_fo:
-            image_bytes = in_fo.read()
+def decode_entry_to_wav(task) -> tuple:
+    """ Decodes one offset table entry of a mapped image and writes it to a wav file.
 
-    otd = OffsetTableDb.get_default()
-    for ote in otd:
-        speech_bytes = image_bytes[ote.sound_data_start_addr:ote.sound_data_end_addr]
+    task is (image_path, sound_data_start_addr, sound_data_end_addr, sample_rate_Hz, filename).
+    Returns (filename, compressed_len_bytes, decoded_len_bytes).
+    """
+    from scipy.io.wavfile import write as wav_write
+
+    image_path, start_addr, end_addr, sample_rate_Hz, filename = task
 
-        compressed_len_bytes = len(speech_bytes)
+    speech_bytes = get_mapped_image(image_path).view(start_addr, end_addr)
+    compressed_len_bytes = len(speech_bytes)
 
-        dec = Decoder()
-        pcm = dec.decode_fully( io.BytesIO(speech_bytes) )
-        #print(f'{pcm=}')
+    dec = Decoder()
+    pcm = dec.decode_array(speech_bytes)
+    del speech_bytes
 
-        filename = os.path.join(args.output_dir, f"ss_{ote.idx:03d}_{ote.speech or '???'}.wav")
-        a_pcm = np.array(pcm, dtype=float)
+    a_pcm = pcm.astype(float)
+    if len(a_pcm) and a_pcm.any():
         a_pcm /= np.abs(a_pcm).max()
 
-        decoded_len_bytes = len(a_pcm) * 2  # assuming 16 bit encoding
+    decoded_len_bytes = len(a_pcm) * 2  # assuming 16 bit encoding
+
+    wav_write(filename=filename, rate=int(sample_rate_Hz), data=a_pcm)
+
+    return (filename, compressed_len_bytes, decoded_len_bytes)
+
 
-        wav_write(filename=filename, rate=int(ote.sample_rate_Hz), data=a_pcm)
-        #wav_write(filename=filename, rate=10000, data=a_pcm)
+def make_decode_tasks(image_path:str, output_dir:str, cache_dir:typing.Optional[str]=DEFAULT_FRAME_INDEX_DIR) -> list:
+    os.makedirs(output_dir, exist_ok=True)
 
-        #with wave.open(filename, mode="wb") as wav_file:
-        #    wav_file.setnchannels(1)
-        #    wav_file.setsampwidth(2)
-        #    wav_file.setframerate(10000)
-        #    wav_file.writeframes( b"".join([ int(x).to_bytes(length=2, byteorder='little') for x in pcm ]) )
+    # parse the offset table of *this* image, once, in the parent, and hand out
+    # each entry up to where the decoder really stops (not the next entry's start)
+    image = get_mapped_image(image_path)
+    otd = OffsetTableDb.from_flash_image(image)
+    true_ends = FrameIndex.load_or_build(image, otd, cache_dir=cache_dir).entry_ends()
 
-        CR = decoded_len_bytes / compressed_len_bytes
+    tasks = []
+    for ote in otd:
+        if ote is None:
+            continue
+        filename = os.path.join(output_dir, f"ss_{ote.idx:03d}_{ote.speech or '???'}.wav")
+        tasks.append( (image_path, ote.sound_data_start_addr, int(true_ends[ote.idx]), ote.sample_rate_Hz, filename) )
+    return tasks
+
+
+def decoder_main(args=None):
+
+    if args is None:
+        args = parse_args()
+
+    image_files = args.image_files
+    if not image_files:
+        image_files = [get_default_image_path()]    # raises a helpful error if the default image is missing
+
+    tasks = []
+    for image_file in image_files:
+        output_dir = args.output_dir
+        if len(image_files) > 1:
+            output_dir = os.path.join(output_dir, os.path.basename(image_file))
+        tasks.extend(make_decode_tasks(image_file, output_dir, cache_dir=None if args.no_cache else args.cache_dir))
+
+    t_start = time.perf_counter()
+    total_compressed_bytes = 0
+
+    def report(results):
+        nonlocal total_compressed_bytes
+        for (filename, compressed_len_bytes, decoded_len_bytes) in results:
+            CR = decoded_len_bytes / compressed_len_bytes if compressed_len_bytes else 0.0
+            total_compressed_bytes += compressed_len_bytes
+            print(f"  wrote {filename}, enc size: {compressed_len_bytes:5d}, pcm size: {decoded_len_bytes}, CR: {CR:2.2f}")
+
+    if args.jobs <= 1:
+        report(map(decode_entry_to_wav, tasks))
+    else:
+        print(f"Decoding {len(tasks)} entries from {len(image_files)} image(s) in {args.jobs} parallel processes...")
+        with multiprocessing.Pool(processes=args.jobs) as pool:
+            report(pool.imap_unordered(decode_entry_to_wav, tasks, chunksize=8))
 
-        print(f"  wrote {filename}, enc size: {compressed_len_bytes:5d}, pcm size: {decoded_len_bytes}, CR: {CR:2.2f}")
+    elapsed = time.perf_counter() - t_start
+    print(f"Decoded {len(tasks)} entries ({total_compressed_bytes/1e6:.2f} MB of speech data) in {elapsed:.2f}s: "
+          f"{len(tasks)/elapsed:.1f} entries/s, {total_compressed_bytes/1e6/elapsed:.2f} MB/s")
 
 if __name__ == "__main__":
     decoder_main()
@@ -0,0 +1,84 @@
+""" On-disk cache of encoded speech blobs, for compile_voice_pack.
+
+Entries are keyed by the sha256 of the WAV file's contents, the settings that
+affect the encoding (normalization etc.) and ENCODER_VERSION, so a changed WAV,
+changed settings or a changed encoder each miss.  The cache is capped in size;
+least recently used entries (by file mtime, which hits refresh) are evicted.
+"""
+from spana.encoder import ENCODER_VERSION
+from spana.file_paths import CACHE_DIR
+import hashlib
+import os
+import typing
+
+DEFAULT_ENCODE_CACHE_DIR = os.path.join(CACHE_DIR, "encoded")
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+
+class EncodeCache:
+    def __init__(self, cache_dir:str=DEFAULT_ENCODE_CACHE_DIR, max_bytes:int=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(wav_bytes:bytes, settings:typing.Dict[str, typing.Any]) -> str:
+        h = hashlib.sha256(wav_bytes)
+        h.update(repr( (ENCODER_VERSION, sorted(settings.items())) ).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def key_for_file(cls, wav_filename:str, settings:typing.Dict[str, typing.Any]) -> str:
+        with open(wav_filename, "rb") as in_fo:
+            return cls.make_key(in_fo.read(), settings)
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def get(self, key:str) -> typing.Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as in_fo:
+                encoded = in_fo.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)      # most recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return encoded
+
+    def put(self, key:str, encoded:bytes):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as out_fo:
+            out_fo.write(encoded)
+        os.replace(tmp_path, path)      # atomic, so concurrent readers never see a partial blob
+
+    def evict(self) -> int:
+        """ Removes least recently used entries until the cache fits in max_bytes; returns how many were removed """
+        entries = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if dir_entry.name.endswith(".bin") and dir_entry.is_file():
+                st = dir_entry.stat()
+                entries.append( (st.st_mtime_ns, st.st_size, dir_entry.path) )
+
+        total_bytes = sum(size for (_, size, _) in entries)
+        num_removed = 0
+        for (_, size, path) in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            num_removed += 1
+        return num_removed
+
+    def stats_str(self) -> str:
+        return f"encode cache ({self.cache_dir}): {self.hits} hits, {self.misses} misses"
@@ -1,25 +1,41 @@
+from __future__ import annotations
 import typing
-import numpy as np
 import os, sys
 import dataclasses
 import io
 
+from spana.flash_image import FlashImage
+from spana.lazy_import import lazy_import
+from spana import codec_tables     # numpy tables, built on first use
+from spana.codec_tables import (
+    NIBBLE_TO_SIGNED, BYTE_TO_STEPS_HI_LO, BYTE_TO_STEPS_LO_HI, HEADER_TO_G_KEEP_GOING,
+    G_KEEP_GOING_TO_HEADER, STEPS_TO_BYTE,
+    QUANT_DELTA_MIN, QUANT_DELTA_MAX,
+)
+
+np = lazy_import("numpy", globals())
+
 MAX_VAL = 460
 MIN_VAL = -480
 
+SAMPLES_PER_FRAME = 23
+FRAME_SIZE_BYTES = 12   # 96 bits
+CANDIDATE_GAINS = tuple(range(0, 6+1))
+
+# bump whenever a change makes the Encoder produce different bytes (invalidates EncodeCache entries)
+ENCODER_VERSION = 1
+
 def byte_to_nibbles(b:int):
     return ((b>>4)&0xF), (b&0xF)
 
 def nibble_to_signed(b:int):
-    if b > 7:
-        return b - 16
-    return b
+    return NIBBLE_TO_SIGNED[b]
 
 def header_bits(g, keep_going) -> int:
     g = int(g)
     keep_going = 1 if bool(keep_going) else 0
     assert 0 <= g <= 7
-    return (int(f"{g:03b}"[::-1],2)<<1) | keep_going
+    return G_KEEP_GOING_TO_HEADER[g][keep_going]
 
 
 def encode_samples(x, header_bits):
@@ -30,7 +46,7 @@ def encode_samples(x, header_bits):
             s = next(it)
             assert -8 <= s < 8
             #print(f"{s=} {bin((s&0b1111)<<4)=}")
-            yield ((s&0b1111)<<4) | header_bits
+            yield STEPS_TO_BYTE[s][0] | header_bits
             del s
 
             # 22 more samples (11 bytes)
@@ -42,10 +58,29 @@ def encode_samples(x, header_bits):
 
                 if byte_idx %3 == 2:
                     s2,s1 = s1,s2 # nibble swap
-                yield ((s2&0b1111)<<4) | (s1&0b1111)
+                yield STEPS_TO_BYTE[s2][s1]
     except StopIteration:
         pass
 
+def find_stop_frame(keep_going) -> int:
+    """ Returns the index of the frame at which Decoder.decode stops, or len(keep_going) if it never does.
+
+    Same rule as the stop counter in Decoder.decode, computed with scans: the
+    counter at each frame is the distance back to the most recent keep_going
+    frame (or to one before the start, if there hasn't been one yet).
+    """
+    keep_going = np.asarray(keep_going, dtype=bool)
+    pos = np.arange(len(keep_going))
+
+    last_keep_going = np.maximum.accumulate(np.where(keep_going, pos, -1))
+    stop_going_ctr = pos - last_keep_going
+    got_at_least_one_keep_going = last_keep_going >= 0
+
+    stop = ((stop_going_ctr >= 3) & got_at_least_one_keep_going) | (stop_going_ctr > 4)
+    if not stop.any():
+        return len(keep_going)
+    return int(np.argmax(stop))
+
 def pad_up_to_multiple(a, multiple:int, value_to_append = 0):
     a = list(a)
     discrepancy = len(a) % multiple
@@ -100,37 +135,143 @@ class Encoder:
 
         return (encoded_bytes, score, last_sample, vals, steps, error)
 
-    def encode_frame(self, s: np.ndarray, fixed_g:int = None):
-        last_sample = self._last_sample
+    @classmethod
+    def encode_frame_all_gains(cls, s: np.ndarray, s_init:int, gs:typing.Sequence[int] = CANDIDATE_GAINS):
+        """ Same quantizer as encode_frame_at_gain, but run for every gain in gs at once.
+
+        Keeps one row of state per candidate gain (a len(gs) x 23 matrix) and
+        walks it column by column, so the per-sample work is a handful of small
+        array ops instead of one Python loop per gain.  Integer samples go
+        through the table-driven _quantize_all_gains_int instead.  Returns
+        (scores, vals, steps, error) with one row per gain.
+        """
+        s = np.asarray(s)
+        assert s.shape == (SAMPLES_PER_FRAME,)
+
+        if np.issubdtype(s.dtype, np.integer):
+            scores, vals, steps = cls._quantize_all_gains_int(s.tolist(), int(s_init), gs)
+            vals = np.array(vals, dtype=np.int64)
+            return (np.array(scores, dtype=float), vals, np.array(steps, dtype=np.int64), (s - vals).astype(float))
+        s = s.astype(float)
+
+        gains = (2**np.asarray(gs, dtype=np.int64)).astype(float)
+
+        # state is kept in float64 (exact for these small integers) so that the
+        # loop body is all in-place ufuncs; np.rint rounds half-to-even like np.round
+        cur = np.full(len(gains), s_init, dtype=float)
+        step = np.empty(len(gains))
+        steps = np.empty([len(gains), SAMPLES_PER_FRAME])
+        vals = np.empty([len(gains), SAMPLES_PER_FRAME])
+        for idx in range(SAMPLES_PER_FRAME):
+            np.subtract(s[idx], cur, out=step)
+            np.divide(step, gains, out=step)
+            np.rint(step, out=step)
+            np.maximum(step, -8, out=step)
+            np.minimum(step, +7, out=step)
+            steps[:,idx] = step
+            np.multiply(step, gains, out=step)
+            np.add(cur, step, out=cur)
+            vals[:,idx] = cur
+
+        error = s - vals
+        scores = np.sum(error**2, axis=1)
+
+        steps = steps.astype(np.int64)
+        vals = vals.astype(np.int64)
+
+        return (scores, vals, steps, error)
+
+    @classmethod
+    def _quantize_all_gains_int(cls, s: typing.List[int], s_init:int, gs:typing.Sequence[int]):
+        """ Integer-sample version of the all-gains quantizer, driven by QUANT_TABLE.
+
+        The state is only len(gs) wide, so it is walked column by column with
+        plain ints (a table lookup per sample) rather than with array ops.
+        Returns (scores, vals, steps) as lists with one row per gain.
+        """
+        quant_rows = [ codec_tables.QUANT_TABLE_ROWS[g] for g in gs ]
+        gains = [ 2**g for g in gs ]
+        num_gains = len(gs)
+
+        cur = [s_init] * num_gains
+        scores = [0] * num_gains
+        steps = [ [0]*SAMPLES_PER_FRAME for _ in range(num_gains) ]
+        vals = [ [0]*SAMPLES_PER_FRAME for _ in range(num_gains) ]
+        for idx, next in enumerate(s):
+            for row in range(num_gains):
+                delta = next - cur[row]
+                if delta < QUANT_DELTA_MIN:
+                    delta = QUANT_DELTA_MIN
+                elif delta > QUANT_DELTA_MAX:
+                    delta = QUANT_DELTA_MAX
+                step = quant_rows[row][delta - QUANT_DELTA_MIN]
+                c = cur[row] = cur[row] + step * gains[row]
+                steps[row][idx] = step
+                vals[row][idx] = c
+                scores[row] += (next - c)**2
+
+        return scores, vals, steps
 
-        if fixed_g is None:
+    def encode_frame(self, s: np.ndarray, fixed_g:int = None):
+        gs = CANDIDATE_GAINS if fixed_g is None else (fixed_g,)
 
-            best_encoding_so_far = None
-            for g in range(0,6+1):
-                tup = self.encode_frame_at_gain(s, g, last_sample)
-                #print(f" encoded with {g=}, {tup[1:]=}")
-                _, score, _ = tup[:3]
-                if (best_encoding_so_far is None) or (score < best_encoding_so_far[1]):
-                    best_encoding_so_far = tuple(list(tup) + [g])
+        s = np.asarray(s)
+        if np.issubdtype(s.dtype, np.integer):
+            scores, vals, steps = self._quantize_all_gains_int(s.tolist(), int(self._last_sample), gs)
         else:
-            best_encoding_so_far = tuple( list(self.encode_frame_at_gain(s, fixed_g, last_sample)) + [fixed_g] )
+            scores, vals, steps, _ = self.encode_frame_all_gains(s, self._last_sample, gs)
+
+        # argmin picks the lowest gain on ties, same as the old strict "<" search over g=0..6
+        best = int(np.argmin(scores))
+        g = gs[best]
+
+        # only the winning gain gets packed into bytes
+        encoded_bytes = bytes(encode_samples(steps[best], header_bits(g=g, keep_going=True)))
+        best_vals = np.asarray(vals[best], dtype=np.int64)
+        last_sample = int(best_vals[-1])
 
-        encoded_bytes, score, last_sample = best_encoding_so_far[:3]
+        best_encoding_so_far = (encoded_bytes, float(scores[best]), last_sample, best_vals, np.asarray(steps[best], dtype=np.int8), (s - best_vals).astype(float), g)
 
         self._last_sample = last_sample
         return encoded_bytes, best_encoding_so_far
 
-    def encode_int_array(self, s:np.ndarray, fixed_g:int = None) -> typing.Generator[bytes, None, None]:
-        idx = 0
-        s = pad_up_to_multiple(s, 23)
-
-        while idx < len(s):
-            #print(f"{idx=}:")
-            frame = s[idx:idx+23]
-            byts, _ = self.encode_frame(frame, fixed_g)
-            idx += 23
+    def encode_stream(self, chunks:typing.Iterable[np.ndarray], fixed_g:int = None) -> typing.Generator[bytes, None, None]:
+        """ Encodes sample chunks of any size, yielding each frame's bytes as soon as its 23 samples are in.
+
+        Only a partial frame (< 23 samples) is carried from one chunk to the
+        next (along with _last_sample), so memory doesn't grow with the length
+        of the stream.  A final partial frame is padded with zeros.
+        """
+        pending = None      # samples of a partial frame left over from the previous chunk
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            idx = 0
+
+            if pending is not None:
+                idx = SAMPLES_PER_FRAME - len(pending)
+                pending = np.concatenate([pending, chunk[:idx]])
+                if len(pending) < SAMPLES_PER_FRAME:
+                    continue
+                byts, _ = self.encode_frame(pending, fixed_g)
+                pending = None
+                yield byts
+
+            while idx + SAMPLES_PER_FRAME <= len(chunk):
+                byts, _ = self.encode_frame(chunk[idx:idx+SAMPLES_PER_FRAME], fixed_g)
+                idx += SAMPLES_PER_FRAME
+                yield byts
+
+            if idx < len(chunk):
+                pending = chunk[idx:]
+
+        if pending is not None:
+            padding = np.zeros([SAMPLES_PER_FRAME - len(pending)], dtype=pending.dtype)
+            byts, _ = self.encode_frame(np.concatenate([pending, padding]), fixed_g)
             yield byts
 
+    def encode_int_array(self, s:np.ndarray, fixed_g:int = None) -> typing.Generator[bytes, None, None]:
+        return self.encode_stream([s], fixed_g=fixed_g)
+
     def encode_fully(self, s:np.ndarray, fixed_g:int = None) -> bytes:
         return b"".join(list(self.encode_int_array(s, fixed_g=fixed_g)))
 
@@ -149,29 +290,15 @@ class Decoder:
     def extract_frame_fields(cls, frame:bytes) -> FrameFields:
         assert(len(frame)==12)
 
-        steps = []
+        steps = [ BYTE_TO_STEPS_HI_LO[frame[0]][0] ]
 
-        nts = nibble_to_signed
-
-        step0, header_bits = byte_to_nibbles(frame[0])
-        steps.append( nts(step0) )
-        del step0
-
-        rev_g = ((header_bits&0b1110) >> 1)
-        g = int(f"{rev_g:03b}"[::-1],2) # bit reversal and re-parse
-        keep_going = bool(header_bits&0b1)
+        g, keep_going = HEADER_TO_G_KEEP_GOING[frame[0] & 0b1111]
 
         for byte_idx in range(1,11+1):
-            nh, nl = byte_to_nibbles(frame[byte_idx])
-            nh = nts(nh)
-            nl = nts(nl)
-
             if byte_idx %3 == 2:
-                steps.append(nh)
-                steps.append(nl)
+                steps.extend(BYTE_TO_STEPS_HI_LO[frame[byte_idx]])
             else:
-                steps.append(nl)
-                steps.append(nh)
+                steps.extend(BYTE_TO_STEPS_LO_HI[frame[byte_idx]])
 
         return FrameFields(
             steps=steps,
@@ -234,3 +361,173 @@ class Decoder:
             L.extend(vals)
         return L
 
+    def decode_array(self, speech_bytes: bytes) -> np.ndarray:
+        """ Decodes a whole speech blob at once; gives the same samples as decode_fully, as an int32 array. """
+        data = np.frombuffer(speech_bytes, dtype=np.uint8)
+        num_frames = len(data) // FRAME_SIZE_BYTES
+        frames = data[:num_frames*FRAME_SIZE_BYTES].reshape([-1, FRAME_SIZE_BYTES])
+
+        header_bits = frames[:,0] & 0b1111
+        keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[header_bits]
+
+        stop_frame = find_stop_frame(keep_going)
+        return self.decode_frames(frames[:stop_frame][keep_going[:stop_frame]])
+
+    @classmethod
+    def decode_frames(cls, frames:np.ndarray, s_init:int=0) -> np.ndarray:
+        """ Decodes a (num_frames, 12) uint8 array of keep_going frames, starting from sample value s_init """
+        header_bits = frames[:,0] & 0b1111
+
+        # note: g == 7 really does decode with a gain of 128 (see decode_frame)
+        gain = np.left_shift(1, codec_tables.A_HEADER_TO_G[header_bits])
+
+        steps = np.empty([len(frames), SAMPLES_PER_FRAME], dtype=np.int64)
+        steps[:,0] = codec_tables.A_BYTE_TO_STEPS_HI_LO[frames[:,0], 0]
+        steps[:,1:] = codec_tables.A_BYTE_TO_STEP_PAIR[codec_tables.A_FRAME_BYTE_NIBBLE_ORDER, frames[:,1:]].reshape([-1, SAMPLES_PER_FRAME-1])
+
+        return (s_init + np.cumsum(steps * gain[:,None])).astype(np.int32)
+
+    def decode_entry(self, image, ote) -> np.ndarray:
+        """ decode_array on an OffsetTableEntry's speech data, straight out of a FlashImage (or bytes) """
+        if isinstance(image, FlashImage):
+            return self.decode_array(image.entry_view(ote))
+        return self.decode_array(image[ote.sound_data_start_addr:ote.sound_data_end_addr])
+
+
+class StreamingDecoder:
+    """ Decoder.decode for speech data that arrives a piece at a time (e.g. as the toy reads it).
+
+    feed() takes the next bytes of a blob and returns the samples of the frames
+    they completed; reset() starts a new blob.  Feeding a blob in any split
+    gives the same samples as decode_array on the whole thing.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._pending = b""
+        self._cur = 0
+        self._stop_going_ctr = 0
+        self._got_at_least_one_keep_going = False
+        self.done = False
+
+    def feed(self, data:bytes) -> np.ndarray:
+        if self.done:
+            return np.zeros(0, dtype=np.int32)
+        buf = self._pending + bytes(data)
+        num_frames = len(buf) // FRAME_SIZE_BYTES
+        self._pending = buf[num_frames*FRAME_SIZE_BYTES:]
+        frames = np.frombuffer(buf, dtype=np.uint8, count=num_frames*FRAME_SIZE_BYTES).reshape([-1, FRAME_SIZE_BYTES])
+        keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[frames[:,0] & 0b1111]
+
+        # the stop counter carries over between pieces, so run it frame by frame (headers only)
+        for (frame_idx, kg) in enumerate(keep_going.tolist()):
+            if kg:
+                self._got_at_least_one_keep_going = True
+                self._stop_going_ctr = 0
+            else:
+                self._stop_going_ctr += 1
+            if (self._stop_going_ctr >= 3 and self._got_at_least_one_keep_going) or (self._stop_going_ctr > 4):
+                self.done = True
+                frames = frames[:frame_idx]
+                keep_going = keep_going[:frame_idx]
+                break
+
+        samples = Decoder.decode_frames(frames[keep_going], s_init=self._cur)
+        if len(samples):
+            self._cur = int(samples[-1])
+        return samples
+
+
+@dataclasses.dataclass
+class FrameCheckpoints:
+    """ Where each frame of a blob stands in a full decode (frames up to the one Decoder.decode stops at) """
+    start_values: np.ndarray    # the decoder's running sample value at the start of each frame
+    sample_offsets: np.ndarray  # index of each frame's first sample in the full decode, plus the total at the end
+    keep_going: np.ndarray      # frames without keep_going are skipped: no samples, no change to the running value
+    stop_frame: int
+
+    @property
+    def num_samples(self) -> int:
+        return int(self.sample_offsets[-1])
+
+    @classmethod
+    def from_bytes(cls, speech_bytes:bytes) -> "FrameCheckpoints":
+        """ Without decoding any samples: a frame moves the running value by gain * (sum of its steps) """
+        data = np.frombuffer(speech_bytes, dtype=np.uint8)
+        frames = data[:len(data) // FRAME_SIZE_BYTES * FRAME_SIZE_BYTES].reshape([-1, FRAME_SIZE_BYTES])
+        header_bits = frames[:,0] & 0b1111
+        keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[header_bits]
+        stop_frame = find_stop_frame(keep_going)
+        frames, header_bits, keep_going = frames[:stop_frame], header_bits[:stop_frame], keep_going[:stop_frame]
+
+        step_sums = codec_tables.A_BYTE_TO_STEPS_HI_LO[frames[:,0], 0] + codec_tables.A_BYTE_TO_STEP_SUM[frames[:,1:]].sum(axis=1)
+        deltas = np.where(keep_going, step_sums << codec_tables.A_HEADER_TO_G[header_bits], 0)
+        return cls(
+            start_values=np.concatenate([[0], np.cumsum(deltas)[:-1]]).astype(np.int64) if stop_frame else np.zeros(0, dtype=np.int64),
+            sample_offsets=np.concatenate([[0], np.cumsum(keep_going * SAMPLES_PER_FRAME)]).astype(np.int64),
+            keep_going=keep_going,
+            stop_frame=stop_frame,
+        )
+
+
+class SeekableDecoder:
+    """ Decodes any range of an entry's frames without decoding what comes before it.
+
+    Frame numbers count 12-byte frames from the entry's start address (so a
+    read at addr is in frame (addr - start) // 12).  The per-frame
+    checkpoints are computed once per entry (or for every entry with
+    precompute) and kept; decode_range then only touches the frames asked for.
+    Given a FrameIndex (see frame_index) of the image, its checkpoints and true
+    entry ends are used instead.
+    """
+    def __init__(self, image, frame_index=None):
+        self.image = image
+        self.frame_index = frame_index
+        self._checkpoints = {}
+
+    def _entry_end(self, ote) -> int:
+        if self.frame_index is not None and self.frame_index.covers(ote):
+            return int(self.frame_index.true_ends[ote.idx])
+        return ote.sound_data_end_addr
+
+    def _entry_bytes(self, ote, start:int=0, end:typing.Optional[int]=None):
+        entry_end = self._entry_end(ote)
+        end = entry_end if end is None else min(ote.sound_data_start_addr + end, entry_end)
+        start = ote.sound_data_start_addr + start
+        if isinstance(self.image, FlashImage):
+            return self.image.view(start, end)
+        return self.image[start:end]
+
+    def checkpoints(self, ote) -> FrameCheckpoints:
+        key = (ote.sound_data_start_addr, self._entry_end(ote))
+        checkpoints = self._checkpoints.get(key)
+        if checkpoints is None:
+            if self.frame_index is not None and self.frame_index.covers(ote):
+                checkpoints = self.frame_index.checkpoints(ote.idx)
+            else:
+                checkpoints = FrameCheckpoints.from_bytes(self._entry_bytes(ote))
+            self._checkpoints[key] = checkpoints
+        return checkpoints
+
+    def precompute(self, otd) -> int:
+        """ Checkpoints every entry of an OffsetTableDb; returns how many entries that was """
+        entries = [ ote for ote in otd if ote is not None ]
+        for ote in entries:
+            self.checkpoints(ote)
+        return len(entries)
+
+    def frame_at(self, ote, addr:int) -> int:
+        return (addr - ote.sound_data_start_addr) // FRAME_SIZE_BYTES
+
+    def decode_range(self, ote, first_frame:int, n_frames:int) -> np.ndarray:
+        """ The samples frames [first_frame, first_frame + n_frames) contribute to a full decode_entry """
+        checkpoints = self.checkpoints(ote)
+        first_frame = max(first_frame, 0)
+        last_frame = min(first_frame + n_frames, checkpoints.stop_frame)
+        if last_frame <= first_frame:
+            return np.zeros(0, dtype=np.int32)
+
+        data = np.frombuffer(self._entry_bytes(ote, first_frame*FRAME_SIZE_BYTES, last_frame*FRAME_SIZE_BYTES), dtype=np.uint8)
+        frames = data.reshape([-1, FRAME_SIZE_BYTES])[checkpoints.keep_going[first_frame:last_frame]]
+        return Decoder.decode_frames(frames, s_init=int(checkpoints.start_values[first_frame]))
@@ -8,24 +8,44 @@ import os
 
 from contextlib import closing
 
-from spana.file_paths import KNOWN_PHRASES_CSV, get_default_image_bytes
+from spana.file_paths import KNOWN_PHRASES_CSV
+from spana.flash_image import FlashImage
 
 EM100_CMD = "em100"
 CHIP="BY25D80"
 
-def main():
-    F_ORIG = get_default_image_bytes()
+DESCRIPTION = "Write the raw speech data of offset table entries to .bin files"
+
+def add_arguments(parser):
+    parser.add_argument("-B", "--base-image", default=None, type=str, help="Image to extract from (default is original)")
+    parser.add_argument("speech_pattern", nargs="?", default="Press Go to Begin", help="Speech pattern of the entries to extract, e.g. \"*Beep*\" (default: \"Press Go to Begin\")")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("extract_sound_blobs_to_bin_files", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    if args.base_image is not None:
+        F_ORIG = FlashImage.from_file(args.base_image)
+    else:
+        F_ORIG = FlashImage.get_default()
     oft = OffsetTableDb.from_flash_image(F_ORIG)
     #beep_otes = oft.lookup_by_speech("*Beep*")
     #beep_otes = oft.lookup_by_speech("*as in two*")
     #beep_otes = oft[0:26]
     #beep_otes = oft[192:193]
-    beep_otes = oft.lookup_by_speech("Press Go to Begin")
+    beep_otes = oft.lookup_by_speech(args.speech_pattern)
     if not beep_otes:
         raise ValueError("no entries returned!")
 
     for ote in beep_otes:
-        byts = F_ORIG[ ote.sound_data_start_addr:ote.sound_data_end_addr ]
+        byts = F_ORIG.entry_view(ote)
 
         with open(f"sound_data_{ote.idx:03d}_{ote.speech or ''}.bin", "wb") as out_fo:
             out_fo.write(byts)
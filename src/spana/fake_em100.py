@@ -0,0 +1,102 @@
+""" Stand-in for the em100 command, so live_trace can run without the hardware.
+
+Takes the same arguments live_trace passes to em100 and prints an em100-style
+trace to stdout: either a replay of a recorded log or recording (--replay), or
+synthetic playback of random entries of the downloaded image (-d).  Operations
+come out at their recorded pace (scaled by --speed; 0 means as fast as
+possible), e.g.
+
+    spana trace -B image.bin --em100-cmd "spana fake-em100 --replay capture.sptrace --speed 4"
+"""
+from spana.synthetic import command_line, data_lines, em100_log_chunks
+from spana.trace_recording import read_operations
+from spana.parse_trace import SPIFlashOperation
+from spana.flash_image import FlashImage
+from spana.offset_table import OffsetTableDb
+import itertools
+import sys
+import time
+import typing
+
+
+def op_to_text(op:SPIFlashOperation) -> str:
+    text = command_line(op.timestamp, op.command_idx, op.command, op.command_str)
+    if op.addr is not None:
+        text += data_lines(op.addr, op.data)
+    return text
+
+def chunk_timestamp(chunk:str) -> float:
+    """ The timestamp of an em100_log_chunks()/op_to_text() chunk ("Time: 000000.12345678 command # ...") """
+    return float(chunk.split(None, 2)[1])
+
+
+def replay_chunks(filename:str) -> typing.Generator[str, None, None]:
+    for op in read_operations(filename):
+        yield op_to_text(op)
+
+def synthetic_chunks(image_filename:str, seed:int=0) -> typing.Generator[str, None, None]:
+    image = FlashImage.from_file(image_filename)
+    return em100_log_chunks(image, OffsetTableDb.from_flash_image(image), seed=seed)
+
+
+def play(chunks:typing.Iterable[str], out_fo, speed:float=1.0):
+    """ Writes chunks to out_fo, each no earlier than its timestamp / speed after the first one """
+    t_start = None
+    for chunk in chunks:
+        if speed > 0:
+            timestamp = chunk_timestamp(chunk)
+            if t_start is None:
+                t_start = time.monotonic() - timestamp / speed
+            delay = t_start + timestamp / speed - time.monotonic()
+            if delay > 0:
+                out_fo.flush()
+                time.sleep(delay)
+        out_fo.write(chunk)
+    out_fo.flush()
+
+
+DESCRIPTION = "Pretend to be em100: print a replayed or synthetic trace"
+
+def add_arguments(parser):
+    # what live_trace passes to em100
+    parser.add_argument("-c", "--set", dest="chip", type=str, default=None, help="Chip (ignored)")
+    parser.add_argument("-d", "--download", type=str, default=None, help="Flash image to synthesize a trace of (unless --replay is given)")
+    parser.add_argument("--verify", action="store_true", help="(ignored)")
+    parser.add_argument("-p", "--holdpin", type=str, default=None, help="(ignored)")
+    parser.add_argument("-t", "--trace", action="store_true", help="(ignored, always traces)")
+    parser.add_argument("--start", action="store_true", help="(ignored)")
+
+    parser.add_argument("--replay", type=str, default=None, help="em100 log or trace recording to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed relative to the recorded timestamps, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--max-ops", type=int, default=None, help="Stop after this many operations (default: the whole replay, or forever)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic playback")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("fake_em100", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    if args.replay is not None:
+        chunks = replay_chunks(args.replay)
+    elif args.download is not None:
+        chunks = synthetic_chunks(args.download, seed=args.seed)
+    else:
+        raise SystemExit("fake_em100: need --replay or -d")
+    chunks = itertools.islice(chunks, args.max_ops)
+
+    print(f"fake_em100: tracing {args.replay or args.download}", file=sys.stderr)
+    try:
+        play(chunks, sys.stdout, speed=args.speed)
+    except (BrokenPipeError, KeyboardInterrupt):
+        # live_trace went away (or ^C went to both of us)
+        sys.stderr.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+from spana.file_paths import get_default_image_path
+import mmap
+import typing
+
+FLASH_SIZE_BYTES = 2**20
+
+
+class FlashImage:
+    """ A SPI flash image held in a single writable buffer.
+
+    The buffer is either a bytearray or a copy-on-write mmap of an image file
+    (writes stay private to this process and never reach the file).  Offset
+    table and speech data patches are applied in place, and per-entry speech
+    data is handed out as memoryview slices, so a chain of modifications
+    copies the image at most once (and not at all when it was mapped).
+    """
+
+    def __init__(self, data):
+        if isinstance(data, (bytearray, mmap.mmap)):
+            self._buf = data
+        else:
+            self._buf = bytearray(data)   # the one copy
+        self._view = memoryview(self._buf)
+
+    @classmethod
+    def from_file(cls, filename:str, use_mmap:bool=True) -> "FlashImage":
+        with open(filename, "rb") as in_fo:
+            if use_mmap:
+                buf = mmap.mmap(in_fo.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                buf = bytearray(in_fo.read())
+        return cls(buf)
+
+    @classmethod
+    def get_default(cls) -> "FlashImage":
+        return cls.from_file(get_default_image_path())
+
+    @classmethod
+    def blank(cls, size:int=FLASH_SIZE_BYTES) -> "FlashImage":
+        return cls(bytearray(size))
+
+    def __len__(self) -> int:
+        return len(self._buf)
+
+    def __getitem__(self, indexer):
+        return self._buf[indexer]
+
+    def __setitem__(self, indexer, new_bytes):
+        if isinstance(indexer, slice):
+            start, stop, stride = indexer.indices(len(self._buf))
+            if stride != 1:
+                raise ValueError("FlashImage only supports contiguous slice assignment")
+            if (indexer.stop is not None and indexer.stop > len(self._buf)) or (stop - start != len(new_bytes)):
+                raise ValueError(
+                    f"patch of {len(new_bytes)} bytes at 0x{start:06X} does not fit "
+                    f"[0x{start:06X}, 0x{(indexer.stop if indexer.stop is not None else stop):06X}) "
+                    f"of a 0x{len(self._buf):06X}-byte image"
+                )
+        self._buf[indexer] = new_bytes
+
+    def view(self, start:int=0, end:typing.Optional[int]=None) -> memoryview:
+        """ Zero-copy view of [start, end) (end=None means to the end of flash) """
+        return self._view[start:end]
+
+    def entry_view(self, ote) -> memoryview:
+        """ Zero-copy view of an OffsetTableEntry's speech data """
+        return self.view(ote.sound_data_start_addr, ote.sound_data_end_addr)
+
+    def patch(self, addr:int, new_bytes:bytes):
+        self[addr:addr+len(new_bytes)] = new_bytes
+
+    def apply_offset_table(self, otd):
+        """ Writes an OffsetTableDb's header and offset table over the start of this image, in place """
+        self.patch(0, otd.generate_bytes_for_image())
+
+    def tobytes(self) -> bytes:
+        return bytes(self._view)
+
+    def save(self, filename:str):
+        with open(filename, "wb") as out_fo:
+            out_fo.write(self._view)
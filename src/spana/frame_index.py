@@ -0,0 +1,305 @@
+""" Where every entry of a flash image really ends, frame by frame.
+
+OffsetTableDb presumes an entry's speech data ends where the next speech
+data (the next higher start address) begins, but the toy doesn't know about ends: it reads frames
+until the decoder's stop rule fires (see find_stop_frame), which is usually a
+few frames before the presumed end and can be past it.  (The Kaitai spec's
+repeat-until stops at the first non-keep_going frame after the second, which
+is yet another place.)
+
+A FrameIndex records, for every entry, the frames the decoder reads: their
+addresses, gain and keep_going bits and the running sample value at the start
+of each (so a SeekableDecoder can start anywhere), plus the stop frame, the
+true end address and the slack bytes between it and the presumed end.  It is
+built with a few numpy passes over the whole image, no per-frame Python:
+
+  1. the stop rule over the headers of every entry's frames, as one
+     segmented scan, repeated with a longer window only for entries that
+     haven't stopped by their presumed end
+  2. the step sums of the frames up to each entry's stop frame, cumulated
+     per entry
+
+load_or_build() keeps built indexes in CACHE_DIR/frame_index, keyed by the
+image's sha256, so decode, analyze, timing and live_trace share one scan per
+image.
+"""
+from __future__ import annotations
+
+from spana.encoder import FRAME_SIZE_BYTES, SAMPLES_PER_FRAME, FrameCheckpoints
+from spana.offset_table import OffsetTableDb
+from spana.flash_image import FlashImage
+from spana.file_paths import CACHE_DIR
+from spana import codec_tables
+from spana.lazy_import import lazy_import
+import dataclasses
+import hashlib
+import os
+import typing
+
+np = lazy_import("numpy", globals())
+
+FRAME_INDEX_VERSION = 2
+DEFAULT_FRAME_INDEX_DIR = os.path.join(CACHE_DIR, "frame_index")
+# how far past the start to look for the stop frame of an entry without a usable presumed end (doubled until found)
+INITIAL_SCAN_BYTES = 4096
+NO_FRAME = -1
+
+
+def image_sha256(image) -> str:
+    return hashlib.sha256(image.view() if isinstance(image, FlashImage) else image).hexdigest()
+
+
+def _segments(starts:np.ndarray, ends:np.ndarray):
+    """ (entry of each frame, frame number within its entry, frame address, indptr) for the whole frames in [start, end) """
+    num_frames = np.maximum((ends - starts) // FRAME_SIZE_BYTES, 0)
+    indptr = np.concatenate([[0], np.cumsum(num_frames)]).astype(np.int64)
+    seg = np.repeat(np.arange(len(starts)), num_frames)
+    local = np.arange(indptr[-1]) - indptr[seg]
+    return seg, local, starts[seg] + FRAME_SIZE_BYTES*local, indptr
+
+
+def _first_per_segment(mask:np.ndarray, seg:np.ndarray, local:np.ndarray, num_segs:int) -> np.ndarray:
+    """ Frame number of the first frame of each segment where mask is set, or NO_FRAME """
+    out = np.full(num_segs, NO_FRAME, dtype=np.int64)
+    pos = np.flatnonzero(mask)
+    (segs, first) = np.unique(seg[pos], return_index=True)
+    out[segs] = local[pos[first]]
+    return out
+
+
+def find_stop_frames(data:np.ndarray, starts:np.ndarray, ends:np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """ find_stop_frame and the Kaitai spec's frame count for each [start, end) of data at once (NO_FRAME where they don't stop) """
+    seg, local, addrs, indptr = _segments(starts, ends)
+    keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[data[addrs] & 0b1111]
+
+    # find_stop_frame's scan, with each segment's "one before the start" being the frame before its first
+    pos = np.arange(len(seg))
+    before_start = indptr[:-1][seg] - 1
+    last_keep_going = np.maximum.accumulate(np.where(keep_going, pos, before_start)) if len(pos) else pos
+    stop_going_ctr = pos - last_keep_going
+    got_at_least_one_keep_going = last_keep_going > before_start
+    stop = ((stop_going_ctr >= 3) & got_at_least_one_keep_going) | (stop_going_ctr > 4)
+
+    kaitai_last = _first_per_segment(~keep_going & (local > 1), seg, local, len(starts))
+    return (_first_per_segment(stop, seg, local, len(starts)),
+            np.where(kaitai_last >= 0, kaitai_last + 1, NO_FRAME))
+
+
+@dataclasses.dataclass
+class FrameIndex:
+    # per entry (by offset table idx; -1 / 0 for missing entries)
+    starts: np.ndarray
+    presumed_ends: np.ndarray   # where the next speech data starts, -1 for the last entry
+    true_ends: np.ndarray       # one past the stop frame (or the end of the image, if the decoder never stops)
+    stop_frames: np.ndarray     # the frame the decoder stops at (= number of frames before it)
+    kaitai_frames: np.ndarray   # frames the .ksy's repeat-until parses, NO_FRAME if it runs off the end
+    terminated: np.ndarray
+    indptr: np.ndarray          # entry idx's frames are [indptr[idx], indptr[idx+1]), through its stop frame
+    # per frame
+    frame_addrs: np.ndarray
+    g: np.ndarray
+    keep_going: np.ndarray
+    start_values: np.ndarray    # the decoder's running value at the start of the frame
+    image_sha256: str = ""
+    from_cache: bool = False
+
+    SAVED_ARRAYS: typing.ClassVar[typing.Tuple[str, ...]] = (
+        "starts", "presumed_ends", "true_ends", "stop_frames", "kaitai_frames", "terminated", "indptr",
+        "frame_addrs", "g", "keep_going", "start_values",
+    )
+
+    @staticmethod
+    def entry_bounds(otd:OffsetTableDb) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """ (start, presumed end) arrays by entry idx, as OffsetTableDb.speech_data_bounds gives them (so an entry's
+        presumed end is the next higher start address, not the next entry's); -1 for missing entries and no end """
+        starts, ends = otd.speech_data_bounds()
+        return starts, np.where((ends > starts) & (ends != otd.speech_address_index.NO_END), ends, -1)
+
+    @classmethod
+    def build(cls, image, otd:typing.Optional[OffsetTableDb]=None) -> "FrameIndex":
+        if otd is None:
+            otd = OffsetTableDb.from_flash_image(image)
+        return cls.from_bounds(image, *cls.entry_bounds(otd))
+
+    @classmethod
+    def from_bounds(cls, image, starts, presumed_ends) -> "FrameIndex":
+        """ Index of the entries starting at starts (-1 for none), presumed to end at presumed_ends (-1 for unknown) """
+        data = np.frombuffer(image.view() if isinstance(image, FlashImage) else image, dtype=np.uint8)
+        starts = np.asarray(starts, dtype=np.int64)
+        presumed_ends = np.asarray(presumed_ends, dtype=np.int64)
+        present = (starts >= 0) & (starts < len(data))
+
+        # 1. stop frames, looking further only for the entries that haven't stopped yet
+        scan_ends = np.where(present, np.where(presumed_ends > starts, presumed_ends, starts + INITIAL_SCAN_BYTES), starts)
+        scan_ends = np.minimum(scan_ends, len(data))
+        stop_frames = np.full(len(starts), NO_FRAME, dtype=np.int64)
+        kaitai_frames = np.full(len(starts), NO_FRAME, dtype=np.int64)
+        pending = np.flatnonzero(present)
+        while len(pending):
+            (stops, kaitai) = find_stop_frames(data, starts[pending], scan_ends[pending])
+            stop_frames[pending] = stops
+            kaitai_frames[pending] = kaitai
+            pending = pending[(stops < 0) & (scan_ends[pending] < len(data))]
+            scan_ends[pending] = np.minimum(starts[pending] + 2*(scan_ends[pending] - starts[pending]) + INITIAL_SCAN_BYTES, len(data))
+
+        terminated = stop_frames >= 0
+        num_frames = np.where(terminated, stop_frames + 1, np.maximum((scan_ends - starts) // FRAME_SIZE_BYTES, 0))
+        stop_frames = np.where(terminated, stop_frames, num_frames)
+        true_ends = np.where(present, starts + num_frames*FRAME_SIZE_BYTES, -1)
+
+        # 2. per-frame fields and running values, up to and including each stop frame
+        seg, local, addrs, indptr = _segments(np.where(present, starts, 0), np.where(present, true_ends, 0))
+        frames = data[addrs[:,None] + np.arange(FRAME_SIZE_BYTES)]
+        header_bits = frames[:,0] & 0b1111
+        keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[header_bits]
+        g = codec_tables.A_HEADER_TO_G[header_bits]
+        step_sums = codec_tables.A_BYTE_TO_STEPS_HI_LO[frames[:,0], 0] + codec_tables.A_BYTE_TO_STEP_SUM[frames[:,1:]].sum(axis=1)
+        deltas = np.where(keep_going, step_sums << g, 0)
+        before = np.cumsum(deltas) - deltas
+        start_values = before - before[indptr[:-1][seg]]
+
+        return cls(
+            starts=starts,
+            presumed_ends=presumed_ends,
+            true_ends=true_ends,
+            stop_frames=np.where(present, stop_frames, 0),
+            kaitai_frames=kaitai_frames,
+            terminated=terminated,
+            indptr=indptr,
+            frame_addrs=addrs,
+            g=g.astype(np.uint8),
+            keep_going=keep_going,
+            start_values=start_values.astype(np.int64),
+            image_sha256=image_sha256(image),
+        )
+
+    # --- cache ---
+
+    def save(self, filename:str):
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as out_fo:
+            np.savez(out_fo, version=FRAME_INDEX_VERSION, image_sha256=self.image_sha256,
+                     **{ name: getattr(self, name) for name in self.SAVED_ARRAYS })
+        os.replace(tmp_filename, filename)      # atomic, so concurrent readers never see a partial index
+
+    @classmethod
+    def load(cls, filename:str) -> typing.Optional["FrameIndex"]:
+        """ None if the file is missing, unreadable or from another FRAME_INDEX_VERSION """
+        try:
+            with np.load(filename) as npz:
+                if int(npz["version"]) != FRAME_INDEX_VERSION:
+                    return None
+                arrays = { name: npz[name] for name in cls.SAVED_ARRAYS }
+                sha = str(npz["image_sha256"])
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(**arrays, image_sha256=sha, from_cache=True)
+
+    @classmethod
+    def load_or_build(cls, image, otd:typing.Optional[OffsetTableDb]=None,
+                      cache_dir:typing.Optional[str]=DEFAULT_FRAME_INDEX_DIR) -> "FrameIndex":
+        """ The cached index of image (built and cached if there isn't one for these entry bounds); cache_dir=None doesn't cache """
+        if otd is None:
+            otd = OffsetTableDb.from_flash_image(image)
+        starts, presumed_ends = cls.entry_bounds(otd)
+        if cache_dir is None:
+            return cls.from_bounds(image, starts, presumed_ends)
+
+        filename = os.path.join(cache_dir, f"{image_sha256(image)}.npz")
+        index = cls.load(filename)
+        if index is not None and np.array_equal(index.starts, starts) and np.array_equal(index.presumed_ends, presumed_ends):
+            return index
+
+        index = cls.from_bounds(image, starts, presumed_ends)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            index.save(filename)
+        except OSError:
+            pass    # a read-only cache only costs a rescan
+        return index
+
+    # --- per entry ---
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def frames(self, idx:int) -> slice:
+        """ The positions of entry idx's frames in the per-frame arrays """
+        return slice(int(self.indptr[idx]), int(self.indptr[idx+1]))
+
+    @property
+    def gain(self) -> np.ndarray:
+        return np.left_shift(1, self.g.astype(np.int64))
+
+    @property
+    def slack_bytes(self) -> np.ndarray:
+        """ Bytes between the stop frame and the next speech data (negative where the decoder reads into it, 0 for the last entry) """
+        return np.where(self.presumed_ends >= 0, self.presumed_ends - self.true_ends, 0)
+
+    def entry_ends(self) -> np.ndarray:
+        """ True end addresses by entry idx (-1 for missing entries), e.g. for analyze_trace's entry_ends """
+        return self.true_ends
+
+    def covers(self, ote) -> bool:
+        return ote is not None and 0 <= ote.idx < len(self) and self.starts[ote.idx] == ote.sound_data_start_addr
+
+    def checkpoints(self, idx:int) -> FrameCheckpoints:
+        """ Same as FrameCheckpoints.from_bytes over the bytes the decoder reads from entry idx """
+        s = self.frames(idx)
+        stop_frame = int(self.stop_frames[idx])
+        keep_going = self.keep_going[s][:stop_frame]
+        return FrameCheckpoints(
+            start_values=self.start_values[s][:stop_frame],
+            sample_offsets=np.concatenate([[0], np.cumsum(keep_going * SAMPLES_PER_FRAME)]).astype(np.int64),
+            keep_going=keep_going,
+            stop_frame=stop_frame,
+        )
+
+    def format_entry_table(self, otd:typing.Optional[OffsetTableDb]=None) -> str:
+        lines = [f"{'idx':>4s} {'start':>8s} {'presumed':>8s} {'true end':>8s} {'slack':>6s} {'frames':>7s} {'ksy':>5s}  speech"]
+        slack = self.slack_bytes
+        for idx in np.flatnonzero(self.starts >= 0).tolist():
+            speech = otd[idx].speech if otd is not None and otd[idx] is not None else None
+            presumed = f"0x{self.presumed_ends[idx]:06X}" if self.presumed_ends[idx] >= 0 else "-"
+            true_end = f"0x{self.true_ends[idx]:06X}" + ("" if self.terminated[idx] else "!")
+            lines.append(f"{idx:4d} 0x{self.starts[idx]:06X} {presumed:>8s} {true_end:>8s} {slack[idx]:6d} "
+                         f"{self.stop_frames[idx]:7d} {self.kaitai_frames[idx]:5d}  {speech or '-'}")
+        return "\n".join(lines)
+
+    def summary(self) -> str:
+        present = self.starts >= 0
+        slack = self.slack_bytes[present & (self.presumed_ends >= 0)]
+        ksy_differs = present & self.terminated & (self.kaitai_frames != self.stop_frames + 1)
+        return (f"{int(present.sum())} entries, {len(self.frame_addrs)} frames read by the decoder; "
+                f"{int((slack > 0).sum())} end before their presumed end ({int(slack[slack > 0].sum())} slack bytes), "
+                f"{int((slack < 0).sum())} read past it, {int((present & ~self.terminated).sum())} never stop; "
+                f"the .ksy's repeat-until disagrees on {int(ksy_differs.sum())}")
+
+
+DESCRIPTION = "Index the frames of every entry in a flash image: where the decoder really stops, and the slack after it"
+
+def add_arguments(parser):
+    parser.add_argument("-B", "--base-image", default=None, type=str, help="Flash image to index (default is original)")
+    parser.add_argument("--no-cache", action="store_true", help=f"Rebuild the index instead of using (and filling) the cache in {DEFAULT_FRAME_INDEX_DIR}")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("frame_index", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    image = FlashImage.from_file(args.base_image) if args.base_image is not None else FlashImage.get_default()
+    otd = OffsetTableDb.from_flash_image(image)
+    index = FrameIndex.load_or_build(image, otd, cache_dir=None if args.no_cache else DEFAULT_FRAME_INDEX_DIR)
+    print(index.format_entry_table(otd))
+    print()
+    print(index.summary() + ("  (cached)" if index.from_cache else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+""" Lays out speech data blobs in a flash image.
+
+ImageBuilder writes each blob once, straight into a preallocated FlashImage
+(so building an image is linear in its size), stores byte-identical blobs
+only once, and refuses to write past the end of flash.
+
+add_blobs_compacted() additionally overlaps blobs at frame granularity (see
+compact_blobs), which is only valid because the decoder skips non-keep_going
+frames and stops on the same rule wherever a blob starts.
+"""
+from spana.flash_image import FlashImage, FLASH_SIZE_BYTES
+from spana.encoder import FRAME_SIZE_BYTES, find_stop_frame
+import dataclasses
+import hashlib
+import typing
+
+SOUND_SECTION_START_OFFSET = 0x470
+
+
+class FlashCapacityExceededError(ValueError):
+    pass
+
+
+@dataclasses.dataclass
+class BlobUsage:
+    addr: int
+    size: int
+    entry_idxs: typing.List[int]    # offset table entries pointing at this blob
+
+
+# stand-in for any non-keep_going frame in a blob's frame string (the decoder
+# only looks at their keep_going bit); keep_going frames get FIRST_FRAME_TOKEN
+# and up
+NON_KEEP_GOING_FRAME = chr(1)
+FIRST_FRAME_TOKEN = 2
+
+
+@dataclasses.dataclass
+class CompactedSection:
+    data: bytes
+    offsets: typing.List[int]           # per input blob, into data
+    decoded_sizes: typing.List[int]     # per input blob: bytes the decoder reads (up to and including the stop frame)
+
+
+def frames_as_string(blob:bytes, frame_tokens:typing.Dict[bytes, str]) -> typing.Optional[str]:
+    """ The frames the decoder reads from blob, one character per frame, or None if it never stops within blob.
+
+    keep_going frames map to a character per distinct 12-byte frame (assigned
+    in frame_tokens), non-keep_going frames all map to NON_KEEP_GOING_FRAME.
+    Two blobs with equal strings decode identically.
+    """
+    num_frames = len(blob) // FRAME_SIZE_BYTES
+    keep_going = [ blob[frame_idx*FRAME_SIZE_BYTES] & 0b1 for frame_idx in range(num_frames) ]
+    stop_frame = find_stop_frame(keep_going)
+    if stop_frame >= num_frames:
+        return None
+
+    chars = []
+    for frame_idx in range(stop_frame+1):
+        if keep_going[frame_idx]:
+            frame = blob[frame_idx*FRAME_SIZE_BYTES:(frame_idx+1)*FRAME_SIZE_BYTES]
+            token = frame_tokens.get(frame)
+            if token is None:
+                token = frame_tokens[frame] = chr(FIRST_FRAME_TOKEN + len(frame_tokens))
+            chars.append(token)
+        else:
+            chars.append(NON_KEEP_GOING_FRAME)
+    return "".join(chars)
+
+
+def frame_overlap(a:str, b:str) -> int:
+    """ Largest m < min(len(a), len(b)) such that the last m frames of a equal the first m frames of b """
+    best = 0
+    j = b.find(a[-1], 0, min(len(a), len(b)) - 1)
+    while j >= 0:
+        if a.endswith(b[:j+1]):
+            best = j + 1
+        j = b.find(a[-1], j+1, min(len(a), len(b)) - 1)
+    return best
+
+
+def compact_blobs(blobs:typing.Sequence[bytes]) -> CompactedSection:
+    """ Packs blobs into one section, sharing frames between them where decoding allows.
+
+    Only the frames a blob's decoding reads are kept (through the frame the stop
+    rule stops at); then
+      - a blob whose frames occur inside another blob's frames points into it,
+      - the remaining blobs are chained so that each one's leading frames
+        overlap the previous one's trailing frames (greedily, longest overlaps
+        first), which includes sharing a stop frame with the next blob's
+        leading non-keep_going frame.
+    A non-keep_going frame can stand in for any other, since the decoder only
+    looks at its keep_going bit.  Blobs that never stop within themselves are
+    appended verbatim, unshared.
+    """
+    frame_tokens = {}
+    strings = [ frames_as_string(blob, frame_tokens) for blob in blobs ]
+    decoded_sizes = [ len(blob) if s is None else len(s)*FRAME_SIZE_BYTES for (blob, s) in zip(blobs, strings) ]
+
+    # blobs contained in other blobs (longest first, so containers are kept)
+    kept = []
+    container = {}      # blob idx -> (containing blob idx, frame offset)
+    by_length = sorted((idx for (idx, s) in enumerate(strings) if s is not None), key=lambda idx: -len(strings[idx]))
+    for idx in by_length:
+        for kept_idx in kept:
+            pos = strings[kept_idx].find(strings[idx])
+            if pos >= 0:
+                container[idx] = (kept_idx, pos)
+                break
+        else:
+            kept.append(idx)
+    kept.sort()
+
+    # chain the kept blobs on their overlaps
+    edges = []
+    for a in kept:
+        for b in kept:
+            if a != b:
+                m = frame_overlap(strings[a], strings[b])
+                if m:
+                    edges.append( (-m, a, b) )
+    edges.sort()
+
+    successor, predecessor = {}, {}
+    chain_root = { idx: idx for idx in kept }
+    def find_root(idx):
+        while chain_root[idx] != idx:
+            chain_root[idx] = chain_root[chain_root[idx]]
+            idx = chain_root[idx]
+        return idx
+    for (neg_m, a, b) in edges:
+        if a in successor or b in predecessor or find_root(a) == find_root(b):
+            continue
+        successor[a] = (b, -neg_m)
+        predecessor[b] = a
+        chain_root[find_root(b)] = find_root(a)
+
+    data = bytearray()
+    offsets = [None] * len(blobs)
+    for head in kept:
+        if head in predecessor:
+            continue
+        offsets[head] = len(data)
+        data += blobs[head][:decoded_sizes[head]]
+        idx = head
+        while idx in successor:
+            (idx, m) = successor[idx]
+            overlap_bytes = m * FRAME_SIZE_BYTES
+            offsets[idx] = len(data) - overlap_bytes
+            data += blobs[idx][overlap_bytes:decoded_sizes[idx]]
+
+    for (idx, (kept_idx, pos)) in container.items():
+        offsets[idx] = offsets[kept_idx] + pos*FRAME_SIZE_BYTES
+
+    for (idx, s) in enumerate(strings):
+        if s is None:
+            offsets[idx] = len(data)
+            data += blobs[idx]
+
+    return CompactedSection(data=bytes(data), offsets=offsets, decoded_sizes=decoded_sizes)
+
+
+class ImageBuilder:
+    def __init__(self, image:FlashImage=None, start_addr:int=SOUND_SECTION_START_OFFSET, flash_size:int=FLASH_SIZE_BYTES):
+        if image is None:
+            image = FlashImage.blank(flash_size)
+        self.image = image
+        self.start_addr = start_addr
+        self.next_free_addr = start_addr
+        self.end_addr = len(image)
+
+        self.blobs : typing.Dict[bytes, BlobUsage] = {}     # sha256 digest -> usage
+        self.entry_blobs : typing.Dict[int, BlobUsage] = {}  # offset table idx -> usage
+        self.num_blobs_added = 0
+        self.num_bytes_added = 0                             # before dedup
+        self.num_unique_bytes = 0                            # after dedup
+        self.bytes_saved_by_compaction = 0
+
+    @classmethod
+    def over_image(cls, image:FlashImage) -> "ImageBuilder":
+        """ A builder that appends after the data already in image (i.e. into its trailing erased space) """
+        erased_byte = image[len(image)-1:len(image)]
+        used_end = len(image.tobytes().rstrip(erased_byte))
+        return cls(image, start_addr=used_end)
+
+    def check_capacity(self, addr:int, size:int, what:str):
+        if addr + size > self.end_addr:
+            raise FlashCapacityExceededError(
+                f"{what}: {size} bytes at 0x{addr:06X} would end at 0x{addr+size:06X}, "
+                f"{addr+size-self.end_addr} bytes past the end of the 0x{self.end_addr:06X}-byte flash"
+            )
+
+    def add_blob(self, blob:bytes, entry_idx:typing.Optional[int]=None) -> int:
+        """ Places blob in the next free space (unless an identical blob is already placed); returns its address """
+        self.num_blobs_added += 1
+        self.num_bytes_added += len(blob)
+
+        digest = hashlib.sha256(blob).digest()
+        usage = self.blobs.get(digest)
+        if usage is None:
+            addr = self.next_free_addr
+            self.check_capacity(addr, len(blob), f"blob for entry {entry_idx}" if entry_idx is not None else "blob")
+            self.image.patch(addr, blob)
+            self.next_free_addr = addr + len(blob)
+            usage = self.blobs[digest] = BlobUsage(addr=addr, size=len(blob), entry_idxs=[])
+            self.num_unique_bytes += len(blob)
+
+        if entry_idx is not None:
+            usage.entry_idxs.append(entry_idx)
+            self.entry_blobs[entry_idx] = usage
+        return usage.addr
+
+    def add_blobs_compacted(self, entry_blobs:typing.Dict[int, bytes], verify:bool=True) -> typing.Dict[int, int]:
+        """ Places all of entry_blobs (offset table idx -> blob) as one compact_blobs() section.
+
+        Returns offset table idx -> address.  With verify, every entry is
+        decoded from the image and compared to decoding its original blob.
+        """
+        unique_blobs = {}       # digest -> (blob idx, blob)
+        entry_blob_idxs = {}
+        for (entry_idx, blob) in entry_blobs.items():
+            self.num_blobs_added += 1
+            self.num_bytes_added += len(blob)
+            digest = hashlib.sha256(blob).digest()
+            if digest not in unique_blobs:
+                unique_blobs[digest] = (len(unique_blobs), blob)
+                self.num_unique_bytes += len(blob)
+            entry_blob_idxs[entry_idx] = unique_blobs[digest][0]
+
+        blobs = [ blob for (_, blob) in unique_blobs.values() ]
+        section = compact_blobs(blobs)
+
+        section_addr = self.next_free_addr
+        self.check_capacity(section_addr, len(section.data), f"compacted section of {len(blobs)} blobs")
+        self.image.patch(section_addr, section.data)
+        self.next_free_addr = section_addr + len(section.data)
+        self.bytes_saved_by_compaction += sum(len(blob) for blob in blobs) - len(section.data)
+
+        usages = [ BlobUsage(addr=section_addr + offset, size=size, entry_idxs=[])
+                   for (offset, size) in zip(section.offsets, section.decoded_sizes) ]
+        for (digest, (blob_idx, _)) in unique_blobs.items():
+            self.blobs[digest] = usages[blob_idx]
+        for (entry_idx, blob_idx) in entry_blob_idxs.items():
+            usages[blob_idx].entry_idxs.append(entry_idx)
+            self.entry_blobs[entry_idx] = usages[blob_idx]
+
+        entry_addrs = { entry_idx: usages[blob_idx].addr for (entry_idx, blob_idx) in entry_blob_idxs.items() }
+        if verify:
+            self.verify_decoding(entry_blobs, entry_addrs)
+        return entry_addrs
+
+    def verify_decoding(self, entry_blobs:typing.Dict[int, bytes], entry_addrs:typing.Dict[int, int]):
+        """ Checks that each entry decodes from the image exactly as its original blob does
+
+        The image side is decoded up to where the decoder really stops there (a
+        FrameIndex over all the entries, so one scan), not just over the bytes
+        the entry was given, so frames that follow it in the image are checked
+        too.
+        """
+        from spana.encoder import Decoder
+        from spana.frame_index import FrameIndex
+        import numpy as np
+
+        entry_idxs = list(entry_blobs)
+        starts = np.array([ entry_addrs[entry_idx] for entry_idx in entry_idxs ], dtype=np.int64)
+        sizes = np.array([ self.entry_blobs[entry_idx].size for entry_idx in entry_idxs ], dtype=np.int64)
+        true_ends = FrameIndex.from_bounds(self.image, starts, starts + sizes).entry_ends()
+
+        dec = Decoder()
+        for (pos, entry_idx) in enumerate(entry_idxs):
+            addr = entry_addrs[entry_idx]
+            expected = dec.decode_array(entry_blobs[entry_idx])
+            got = dec.decode_array(self.image.view(addr, int(true_ends[pos])))
+            if not np.array_equal(expected, got):
+                raise ValueError(f"entry {entry_idx} at 0x{addr:06X} decodes differently from its original blob")
+
+    def write_at(self, addr:int, blob:bytes, entry_idx:typing.Optional[int]=None):
+        """ Overwrites whatever is at addr with blob (no dedup, no allocation), checking it fits in flash """
+        self.check_capacity(addr, len(blob), f"write for entry {entry_idx}" if entry_idx is not None else "write")
+        self.image.patch(addr, blob)
+        if entry_idx is not None:
+            self.entry_blobs[entry_idx] = BlobUsage(addr=addr, size=len(blob), entry_idxs=[entry_idx])
+
+    def build(self, otd) -> FlashImage:
+        """ Writes otd's offset table over the start of the image and returns the image """
+        table_bytes = otd.generate_bytes_for_image()
+        if len(table_bytes) > self.start_addr:
+            raise FlashCapacityExceededError(
+                f"offset table ({len(table_bytes)} bytes) overlaps the sound data starting at 0x{self.start_addr:06X}")
+        self.image.apply_offset_table(otd)
+        return self.image
+
+    @property
+    def used_bytes(self) -> int:
+        return self.next_free_addr - self.start_addr
+
+    @property
+    def free_bytes(self) -> int:
+        return self.end_addr - self.next_free_addr
+
+    @property
+    def bytes_saved_by_dedup(self) -> int:
+        return self.num_bytes_added - self.num_unique_bytes
+
+    def usage_summary(self) -> str:
+        return (f"sound data: {self.used_bytes} bytes in {len(self.blobs)} blobs "
+                f"({self.num_blobs_added - len(self.blobs)} duplicates, {self.bytes_saved_by_dedup} bytes saved"
+                + (f", {self.bytes_saved_by_compaction} more saved by compaction" if self.bytes_saved_by_compaction else "")
+                + "), "
+                f"0x{self.start_addr:06X}-0x{self.next_free_addr:06X}, "
+                f"{self.free_bytes} bytes free ({100*self.next_free_addr/self.end_addr:.1f}% of flash used)")
+
+    def usage_report(self) -> str:
+        lines = [ f"{'entry':>5s} {'addr':>8s} {'size':>7s}  shared with" ]
+        for entry_idx in sorted(self.entry_blobs):
+            usage = self.entry_blobs[entry_idx]
+            shared_with = ", ".join(str(idx) for idx in usage.entry_idxs if idx != entry_idx)
+            lines.append(f"{entry_idx:5d} 0x{usage.addr:06X} {usage.size:7d}  {shared_with}")
+        lines.append(self.usage_summary())
+        return "\n".join(lines)
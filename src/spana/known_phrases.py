@@ -0,0 +1,148 @@
+""" Loader for known_phrases.csv, the offset_table_idx -> speech database.
+
+Parsed with the stdlib csv module once per process.  KnownPhrases.load() can
+also keep a pickled snapshot in a cache dir, keyed by the CSV's mtime and
+sha256, so later processes skip parsing entirely.
+"""
+from spana.file_paths import KNOWN_PHRASES_CSV, CACHE_DIR
+import csv
+import io
+import os
+import typing
+
+SNAPSHOT_VERSION = 1
+
+
+class KnownPhrases:
+    def __init__(self, columns:typing.Sequence[str], rows:typing.Sequence[dict]):
+        self.columns = tuple(columns)
+        self.rows = { row["offset_table_idx"]: row for row in rows }     # offset_table_idx -> row dict
+        self.idx_to_speech = { idx: row["speech"] for (idx, row) in self.rows.items() }
+
+    @classmethod
+    def from_csv_bytes(cls, csv_bytes:bytes) -> "KnownPhrases":
+        reader = csv.reader(io.StringIO(csv_bytes.decode("utf-8")))
+        header = next(reader)
+        # name blank header cells the way pandas.read_csv does ("Unnamed: 2")
+        columns = [ name if name else f"Unnamed: {col_idx}" for (col_idx, name) in enumerate(header) ]
+
+        rows = []
+        for fields in reader:
+            if not fields:
+                continue
+            row = { name: (value if value != "" else None) for (name, value) in zip(columns, fields) }
+            row["offset_table_idx"] = int(row["offset_table_idx"])
+            rows.append(row)
+        return cls(columns, rows)
+
+    @classmethod
+    def from_csv(cls, csv_path:str=KNOWN_PHRASES_CSV) -> "KnownPhrases":
+        with open(csv_path, "rb") as in_fo:
+            return cls.from_csv_bytes(in_fo.read())
+
+    @classmethod
+    def load(cls, csv_path:str=KNOWN_PHRASES_CSV, cache_dir:typing.Optional[str]=None) -> "KnownPhrases":
+        """ Loads csv_path, memoized per process.
+
+        If cache_dir is given, a pickled snapshot is read from (or written to)
+        it.  The snapshot is trusted as-is when the CSV's size and mtime match,
+        and otherwise only when the CSV's sha256 still matches.
+        """
+        key = (os.path.abspath(csv_path), cache_dir)
+        phrases = _loaded.get(key)
+        if phrases is None:
+            if cache_dir is None:
+                phrases = cls.from_csv(csv_path)
+            else:
+                phrases = cls._load_via_snapshot(csv_path, cache_dir)
+            _loaded[key] = phrases
+        return phrases
+
+    @classmethod
+    def get(cls) -> "KnownPhrases":
+        """ The known phrases shipped with spana """
+        return cls.load(KNOWN_PHRASES_CSV)
+
+    @staticmethod
+    def snapshot_filename(csv_path:str, cache_dir:str) -> str:
+        import hashlib
+        path_hash = hashlib.sha256(os.path.abspath(csv_path).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f"known_phrases-{path_hash}.pickle")
+
+    @classmethod
+    def _load_via_snapshot(cls, csv_path:str, cache_dir:str) -> "KnownPhrases":
+        import hashlib, pickle
+        st = os.stat(csv_path)
+        snapshot_filename = cls.snapshot_filename(csv_path, cache_dir)
+
+        snapshot = None
+        try:
+            with open(snapshot_filename, "rb") as in_fo:
+                snapshot = pickle.load(in_fo)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                snapshot = None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            snapshot = None
+
+        if snapshot is not None and (snapshot["mtime_ns"], snapshot["size"]) == (st.st_mtime_ns, st.st_size):
+            return snapshot["phrases"]
+
+        with open(csv_path, "rb") as in_fo:
+            csv_bytes = in_fo.read()
+        sha256 = hashlib.sha256(csv_bytes).hexdigest()
+
+        if snapshot is not None and snapshot["sha256"] == sha256:
+            phrases = snapshot["phrases"]      # touched, but not changed
+        else:
+            phrases = cls.from_csv_bytes(csv_bytes)
+
+        cls.write_snapshot(phrases, snapshot_filename, st, sha256)
+        return phrases
+
+    @staticmethod
+    def write_snapshot(phrases:"KnownPhrases", snapshot_filename:str, st:os.stat_result, sha256:str):
+        import pickle
+        snapshot = dict(version=SNAPSHOT_VERSION, mtime_ns=st.st_mtime_ns, size=st.st_size, sha256=sha256, phrases=phrases)
+        try:
+            os.makedirs(os.path.dirname(snapshot_filename), exist_ok=True)
+            tmp_filename = f"{snapshot_filename}.{os.getpid()}.tmp"
+            with open(tmp_filename, "wb") as out_fo:
+                pickle.dump(snapshot, out_fo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, snapshot_filename)
+        except OSError as e:
+            print(f"WARNING: could not write known phrases snapshot {snapshot_filename}: {e}")
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+    def speech(self, offset_table_idx:int) -> typing.Optional[str]:
+        return self.idx_to_speech.get(offset_table_idx)
+
+    def column(self, name:str) -> typing.Dict[int, typing.Optional[str]]:
+        """ offset_table_idx -> value of one column (e.g. "snoop") """
+        if name not in self.columns:
+            raise KeyError(f"no column \"{name}\" in known phrases (columns: {self.columns})")
+        return { idx: row[name] for (idx, row) in self.rows.items() }
+
+
+# (csv path, cache dir) -> KnownPhrases, per process
+_loaded = {}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser("known_phrases",
+        description="Write (or refresh) the precompiled snapshot of known_phrases.csv")
+    parser.add_argument("--csv", type=str, default=KNOWN_PHRASES_CSV, help="CSV file (default: the one shipped with spana)")
+    parser.add_argument("--cache-dir", type=str, default=CACHE_DIR, help=f"Snapshot directory (default: {CACHE_DIR}, or $SPANA_CACHE_DIR)")
+    args = parser.parse_args()
+
+    phrases = KnownPhrases.load(args.csv, cache_dir=args.cache_dir)
+    print(f"{len(phrases)} known phrases, columns {phrases.columns}, snapshot at {KnownPhrases.snapshot_filename(args.csv, args.cache_dir)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+""" Deferred imports for heavy third-party modules (numpy, scipy, pydub).
+
+    np = lazy_import("numpy", globals())
+
+binds a stand-in that imports numpy the first time an attribute is looked up
+on it, and then rebinds the module global to the real module, so only the
+first access pays for the indirection.  Modules using this should have
+`from __future__ import annotations` so that `np.ndarray` annotations are not
+evaluated at import time.
+"""
+import importlib
+import typing
+
+
+class LazyModule:
+    def __init__(self, name:str, module_globals:typing.Optional[dict]=None):
+        self._name = name
+        self._module_globals = module_globals
+
+    def load(self):
+        module = importlib.import_module(self._name)
+        module_globals = self._module_globals
+        if module_globals is not None:
+            for (global_name, value) in list(module_globals.items()):
+                if value is self:
+                    module_globals[global_name] = module
+        return module
+
+    def __getattr__(self, attr:str):
+        if attr.startswith("__"):
+            raise AttributeError(attr)   # e.g. copy/pickle probing the stand-in itself
+        return getattr(self.load(), attr)
+
+    def __repr__(self) -> str:
+        return f"<lazily imported module '{self._name}'>"
+
+
+def lazy_import(name:str, module_globals:typing.Optional[dict]=None) -> LazyModule:
+    return LazyModule(name, module_globals)
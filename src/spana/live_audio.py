@@ -0,0 +1,223 @@
+""" Rebuilds the audio the toy played from the speech data it read, as it reads it.
+
+Each offset table lookup in a trace carries the entry's record (rate_divider
+and start address), and the speech reads that follow carry the entry's
+encoded bytes.  LiveAudio follows that: a lookup arms a new word, the read of
+its start address starts it, and every read that continues where the last
+one ended goes through a StreamingDecoder, whose samples are written straight
+to a sink:
+
+    WavSink     a wav file whose header is kept up to date after every write,
+                rolling over to name_001.wav, ... when the sample rate changes
+                (or the file reaches max_seconds)
+    RawPcmSink  signed 16-bit mono PCM to a stream, e.g. stdout into aplay/sox
+
+Gaps between words (up to max_silence_s) are filled with silence.  If told
+when each operation's bytes arrived (read_time, time.monotonic()), LiveAudio
+measures the latency from there to the samples being written.
+"""
+from __future__ import annotations
+
+from spana.encoder import StreamingDecoder
+from spana.offset_table import OffsetTableDb, OFFSET_TABLE_RECORD_BYTES, offset_table_idx
+from spana.parse_trace import SPIFlashOperation, READ_OP
+from spana.trace_recording import read_operations
+from spana.flash_image import FlashImage
+from spana.lazy_import import lazy_import
+import array
+import dataclasses
+import os
+import sys
+import time
+import typing
+import wave
+
+np = lazy_import("numpy", globals())
+
+PCM_SCALE = 64          # decoded samples stay within about +-480
+DEFAULT_MAX_SILENCE_S = 1.0
+
+
+class WavSink:
+    def __init__(self, filename:str, max_seconds:typing.Optional[float]=None):
+        self.filename = filename
+        self.max_seconds = max_seconds
+        self.filenames = []
+        self._wav = None
+        self._sample_rate_Hz = None
+        self._frames_in_file = 0
+
+    def _roll(self, sample_rate_Hz:int):
+        self.close()
+        (base, ext) = os.path.splitext(self.filename)
+        filename = self.filename if not self.filenames else f"{base}_{len(self.filenames):03d}{ext}"
+        self._wav = wave.open(filename, "wb")
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate_Hz)
+        self._sample_rate_Hz = sample_rate_Hz
+        self._frames_in_file = 0
+        self.filenames.append(filename)
+
+    def write(self, pcm:np.ndarray, sample_rate_Hz:int):
+        if (self._wav is None or sample_rate_Hz != self._sample_rate_Hz
+                or (self.max_seconds is not None and self._frames_in_file >= self.max_seconds * sample_rate_Hz)):
+            self._roll(sample_rate_Hz)
+        # wave patches the header's lengths after every writeframes, so the file is always playable
+        self._wav.writeframes(pcm.astype("<i2").tobytes())
+        self._frames_in_file += len(pcm)
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+class RawPcmSink:
+    def __init__(self, out_fo:typing.BinaryIO):
+        self.out_fo = out_fo
+        self.sample_rate_Hz = None
+
+    def write(self, pcm:np.ndarray, sample_rate_Hz:int):
+        if sample_rate_Hz != self.sample_rate_Hz:
+            if self.sample_rate_Hz is not None:
+                print(f"live_audio: sample rate changed to {sample_rate_Hz} Hz", file=sys.stderr)
+            self.sample_rate_Hz = sample_rate_Hz
+        self.out_fo.write(pcm.astype("<i2").tobytes())
+        self.out_fo.flush()
+
+    def close(self):
+        self.out_fo.flush()
+
+
+@dataclasses.dataclass
+class AudioStats:
+    words: int = 0
+    samples_written: int = 0
+    silence_samples: int = 0
+    speech_bytes: int = 0
+    unmatched_reads: int = 0        # speech reads that neither started nor continued a word
+    latencies_s: array.array = dataclasses.field(default_factory=lambda: array.array("d"))
+
+    def summary(self) -> str:
+        text = (f"{self.words} words, {self.samples_written} samples ({self.silence_samples} of them silence) "
+                f"from {self.speech_bytes} bytes, {self.unmatched_reads} reads not part of a word")
+        if self.latencies_s:
+            latencies = np.frombuffer(self.latencies_s, dtype=np.float64)
+            text += (f"; read-to-audio latency median {np.median(latencies)*1e3:.1f} ms, "
+                     f"p99 {np.percentile(latencies, 99)*1e3:.1f} ms, max {latencies.max()*1e3:.1f} ms")
+        return text
+
+
+class LiveAudio:
+    def __init__(self, sink, otd:typing.Optional[OffsetTableDb]=None, max_silence_s:float=DEFAULT_MAX_SILENCE_S):
+        """ otd (optional) lets reads of an entry's start address begin a word even if the lookup wasn't traced """
+        self.sink = sink
+        self.otd = otd
+        self.max_silence_s = max_silence_s
+        self.stats = AudioStats()
+        self._decoder = StreamingDecoder()
+        self._armed = None              # (start_addr, rate_divider) from the last lookup
+        self._next_addr = None          # where the word being played continues
+        self._sample_rate_Hz = None
+        self._audio_end_time = None     # trace time at which the audio written so far ends
+
+    def _entry_starting_at(self, addr:int):
+        ote = self.otd.lookup_by_speech_data_address(addr) if self.otd is not None else None
+        return ote if ote is not None and ote.sound_data_start_addr == addr else None
+
+    def _start_word(self, op:SPIFlashOperation, rate_divider:int):
+        self._decoder.reset()
+        self._armed = None
+        self._sample_rate_Hz = int(round(2e6 / rate_divider))
+        self._next_addr = op.addr
+        self.stats.words += 1
+        if self._audio_end_time is not None and self.max_silence_s > 0:
+            silence_s = min(max(op.timestamp - self._audio_end_time, 0.0), self.max_silence_s)
+            num_samples = int(silence_s * self._sample_rate_Hz)
+            if num_samples:
+                self.sink.write(np.zeros(num_samples, dtype=np.int16), self._sample_rate_Hz)
+                self.stats.silence_samples += num_samples
+                self.stats.samples_written += num_samples
+        self._audio_end_time = op.timestamp
+
+    def write(self, op:SPIFlashOperation, read_time:typing.Optional[float]=None):
+        if op.command != READ_OP or op.addr is None or not op.len:
+            return
+
+        if op.len >= OFFSET_TABLE_RECORD_BYTES and offset_table_idx(op.addr) is not None:
+            record = bytes(op.data[:OFFSET_TABLE_RECORD_BYTES])
+            self._armed = (int.from_bytes(record[2:5], "big"), int.from_bytes(record[0:2], "big"))
+            self._next_addr = None
+            return
+
+        continues = self._next_addr is not None and op.addr <= self._next_addr < op.addr + op.len
+        if self._armed is not None and op.addr == self._armed[0]:
+            self._start_word(op, self._armed[1])
+        elif continues and not self._decoder.done:
+            pass
+        else:
+            # a finished word's next entry can start right where its last read ended
+            ote = self._entry_starting_at(op.addr)
+            if ote is not None:
+                self._start_word(op, ote.rate_divider)
+            elif not continues:
+                self.stats.unmatched_reads += 1
+                return
+
+        data = op.data[self._next_addr - op.addr:]
+        self._next_addr = op.addr + op.len
+        self.stats.speech_bytes += len(data)
+        samples = self._decoder.feed(data)
+        if len(samples):
+            pcm = np.clip(samples * PCM_SCALE, -32768, 32767)
+            self.sink.write(pcm, self._sample_rate_Hz)
+            self.stats.samples_written += len(pcm)
+            self._audio_end_time += len(pcm) / self._sample_rate_Hz
+            if read_time is not None:
+                self.stats.latencies_s.append(time.monotonic() - read_time)
+
+    def close(self):
+        self.sink.close()
+
+
+def make_sink(output:str, max_seconds:typing.Optional[float]=None):
+    """ "-" for raw PCM on stdout, otherwise a wav filename """
+    if output == "-":
+        return RawPcmSink(sys.stdout.buffer)
+    return WavSink(output, max_seconds=max_seconds)
+
+
+DESCRIPTION = "Rebuild the audio the toy played from a trace, into a wav file (or raw PCM on stdout)"
+
+def add_arguments(parser):
+    parser.add_argument("trace_filename", type=str, help="em100 text log or trace recording")
+    parser.add_argument("-B", "--base-image", default=None, type=str, help="Flash image the trace was taken with (default is original), for words whose offset table lookup wasn't traced")
+    parser.add_argument("-o", "--output", type=str, default="trace_audio.wav", help="wav file, or - for 16-bit PCM on stdout (default: %(default)s)")
+    parser.add_argument("--max-silence", type=float, default=DEFAULT_MAX_SILENCE_S, help="Longest silence to put between words, in seconds (default: %(default)s)")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("live_audio", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    image = FlashImage.from_file(args.base_image) if args.base_image is not None else FlashImage.get_default()
+    audio = LiveAudio(make_sink(args.output), otd=OffsetTableDb.from_flash_image(image), max_silence_s=args.max_silence)
+    try:
+        for op in read_operations(args.trace_filename):
+            audio.write(op)
+    finally:
+        audio.close()
+    print(audio.stats.summary(), file=sys.stderr)
+    if isinstance(audio.sink, WavSink):
+        print(f"Wrote {', '.join(audio.sink.filenames)}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
 from spana.util import TempFileMgr
-from spana.parse_trace import parse_read_operations
+from spana.trace_recording import TraceRecordingWriter
+from spana.trace_pipeline import run_pipeline
+from spana.live_audio import LiveAudio, RawPcmSink, make_sink
 from spana.offset_table import OffsetTableDb, OffsetTableEntry
 from spana.encoder import Encoder, encode_samples, header_bits
 import typing
 import random
 
-import numpy as np
-
 import subprocess
+import shlex
+import sys
 import os
 
-from contextlib import closing
+from contextlib import closing, redirect_stdout
+
+from spana.file_paths import KNOWN_PHRASES_CSV
+from spana.flash_image import FlashImage
+from spana.frame_index import FrameIndex, DEFAULT_FRAME_INDEX_DIR
+from spana.image_builder import ImageBuilder
+from spana.lazy_import import lazy_import
 
-from spana.file_paths import KNOWN_PHRASES_CSV, get_default_image_bytes
+np = lazy_import("numpy", globals())
 
 EM100_CMD = "em100"
 CHIP="BY25D80"
@@ -38,31 +46,39 @@ def pad_up_to_multiple(a, multiple:int, value_to_append = 0):
 
 
 def get_em100_cmdline(binfile:str, chip:str=CHIP, em100_cmd:str=EM100_CMD):
-    em100_cmdargs = [ em100_cmd, 
+    em100_cmdargs = shlex.split(em100_cmd) + [
         "-c", chip, 
         "-d", binfile, 
         "--verify", "-p", "float", "-t", "--start"]
     print(f"{em100_cmdargs=}")
     return em100_cmdargs
 
+def graft_data(FMOD:FlashImage, graft_start:int, new_data:bytes) -> int:
+    """ Overwrites FMOD with new_data at graft_start, in place; returns the end address.
+
+    Raises FlashCapacityExceededError if new_data would run past the end of flash.
+    """
+    ImageBuilder(FMOD, start_addr=graft_start).write_at(graft_start, new_data)
+    return graft_start + len(new_data)
+
 def save_latest_first_beep_data(new_first_beep_data:bytes):
     if 1:
         with open("latest_new_first_beep_data.dat", "wb") as out_fo:
             out_fo.write(new_first_beep_data)
 
-def make_all_beeps_point_to_first_beep(FMOD:bytearray, oft:OffsetTableDb):
+def make_all_beeps_point_to_first_beep(FMOD:FlashImage, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
 
     first_beep_entry = beep_entries[0]
     for beep_entry in beep_entries:
         beep_entry.sound_data_start_addr = first_beep_entry.sound_data_start_addr
     
-    FMOD = bytearray(oft.graft_onto_image(FMOD))
+    FMOD = oft.graft_onto_image(FMOD)
     #FMOD = bytearray(oft.graft_onto_image(FMOD, entry_prefix_bytes=bytes.fromhex("0080")))
     return FMOD
 
 
-def replace_prefixes(FMOD:bytearray, oft:OffsetTableDb):
+def replace_prefixes(FMOD:FlashImage, oft:OffsetTableDb):
 
     def select_portion(byts) -> bytes:
         return byts[:12+0]
@@ -81,7 +97,7 @@ def replace_prefixes(FMOD:bytearray, oft:OffsetTableDb):
     return FMOD
 
 
-def repeated_periodic_sound(FMOD:bytearray, oft:OffsetTableDb):
+def repeated_periodic_sound(FMOD:FlashImage, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
 
     first_beep_entry = beep_entries[0]
@@ -106,8 +122,7 @@ def repeated_periodic_sound(FMOD:bytearray, oft:OffsetTableDb):
 
     # graft that onto the first beep entry so we always play it
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_first_beep_data)
-    FMOD[graft_start:graft_end] = new_first_beep_data
+    graft_end = graft_data(FMOD, graft_start, new_first_beep_data)
 
     print(f" repeated_periodic_sound: replaced {len(new_first_beep_data)} bytes from 0x{graft_start:06X} to 0x{graft_end:06X}")
 
@@ -123,7 +138,7 @@ def repeated_periodic_sound(FMOD:bytearray, oft:OffsetTableDb):
     return FMOD
 
 
-def steve_martin_mode(FMOD:bytearray, oft:OffsetTableDb):
+def steve_martin_mode(FMOD:FlashImage, oft:OffsetTableDb):
 
     rnd = random.Random(42)
     idxs = list(range(len(oft)))
@@ -135,7 +150,7 @@ def steve_martin_mode(FMOD:bytearray, oft:OffsetTableDb):
     for idx, ote in zip(idxs, oft):
         ote.sound_data_start_addr = original_addresses[idx]
 
-    FMOD = bytearray(oft.graft_onto_image(FMOD))
+    FMOD = oft.graft_onto_image(FMOD)
     return FMOD
 
 
@@ -144,7 +159,7 @@ def steve_martin_mode(FMOD:bytearray, oft:OffsetTableDb):
 
 
 
-def chop_all_beeps_together(FMOD:bytearray, oft:OffsetTableDb):
+def chop_all_beeps_together(FMOD:FlashImage, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
 
     first_beep_entry = beep_entries[0]
@@ -316,8 +331,7 @@ def chop_all_beeps_together(FMOD:bytearray, oft:OffsetTableDb):
 
     # graft that onto the first beep entry so we always play it
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_first_beep_data)
-    FMOD[graft_start:graft_end] = new_first_beep_data
+    graft_end = graft_data(FMOD, graft_start, new_first_beep_data)
 
     print(f" chopping beeps: replaced {len(new_first_beep_data)} bytes from 0x{graft_start:06X} to 0x{graft_end:06X}")
 
@@ -332,7 +346,7 @@ def chop_all_beeps_together(FMOD:bytearray, oft:OffsetTableDb):
 
     return FMOD
 
-def say_twosix_eesg(FMOD:bytearray, oft:OffsetTableDb):
+def say_twosix_eesg(FMOD:FlashImage, oft:OffsetTableDb):
 
     new_data = bytearray()
     speeches = ["Two", "Six", "E"]
@@ -355,8 +369,7 @@ def say_twosix_eesg(FMOD:bytearray, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
     first_beep_entry = beep_entries[0]
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
     E_entry = oft.lookup_by_speech("E")[0]
     S_entry = oft.lookup_by_speech("S")[0]
@@ -382,11 +395,10 @@ def say_twosix_eesg(FMOD:bytearray, oft:OffsetTableDb):
 
     to_modify = oft.lookup_by_speech("Press Go to Begin")[0]
     graft_start = to_modify.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
 
-    FMOD = bytearray(oft.graft_onto_image(FMOD))
+    FMOD = oft.graft_onto_image(FMOD)
 
     return FMOD
 
@@ -405,7 +417,7 @@ def speech_bytes_to_frames(byts:bytes, frame_size_bytes:int=12, dtype=float):
 def nibble_swap(a):
     return ((a&0b1111_0000)>>4) | ((a&0b0000_1111)<<4)
 
-#def add_encoded_data(FMOD:bytearray, oft:OffsetTableDb):
+#def add_encoded_data(FMOD:FlashImage, oft:OffsetTableDb):
 #
 #    speech_lkup = "Beep 217"
 #    entry = oft.lookup_by_speech(speech_lkup)[0]
@@ -426,7 +438,30 @@ def nibble_swap(a):
 #
 #    return FMOD
 
-def encoded_synth(FMOD:bytearray, oft:OffsetTableDb):
+def linear_sweep_chunks(start_freq_Hz:float, stop_freq_Hz:float, num_samples:int, sample_rate_Hz:float, amplitude_counts:float, chunk_len:int=4096):
+    """ Samples of a linear pitch sweep, as int arrays of up to chunk_len samples.
+
+    Gives the same samples as computing the whole sweep at once with
+    np.linspace/np.cumsum, without ever holding more than one chunk.
+    """
+    freq_step = (stop_freq_Hz - start_freq_Hz) / (num_samples - 1) if num_samples > 1 else 0.0
+    phase = None
+    for chunk_start in range(0, num_samples, chunk_len):
+        chunk_end = min(chunk_start + chunk_len, num_samples)
+        freq = np.arange(chunk_start, chunk_end) * freq_step + start_freq_Hz
+        if chunk_end == num_samples and num_samples > 1:
+            freq[-1] = stop_freq_Hz     # like np.linspace
+        dphs = 2*np.pi*freq/sample_rate_Hz
+        if phase is not None:
+            # continue the running sum in the same order np.cumsum adds
+            dphs = np.concatenate([[phase], dphs])
+            phs = np.cumsum(dphs)[1:]
+        else:
+            phs = np.cumsum(dphs)
+        phase = phs[-1]
+        yield (amplitude_counts * np.sin(phs)).astype(int)
+
+def encoded_synth(FMOD:FlashImage, oft:OffsetTableDb):
 
     speech_lkup = "Beep 217"
     entry = oft.lookup_by_speech(speech_lkup)[0]
@@ -443,9 +478,7 @@ def encoded_synth(FMOD:bytearray, oft:OffsetTableDb):
         #AMPLITUDE_COUNTS =  3000
         #AMPLITUDE_COUNTS =  4000
         AMPLITUDE_COUNTS =  500
-        freq = np.linspace(220, 880, num=int(SAMPLE_RATE_HZ*duration_sec))
-        phs = np.cumsum( 2*np.pi*freq/SAMPLE_RATE_HZ )
-        x = (AMPLITUDE_COUNTS * np.sin(phs)).astype(int)
+        x = linear_sweep_chunks(220, 880, int(SAMPLE_RATE_HZ*duration_sec), SAMPLE_RATE_HZ, AMPLITUDE_COUNTS)
     elif 1:
         AMPLITUDE_COUNTS =  10000
         t = np.arange(int(SAMPLE_RATE_HZ*duration_sec))/SAMPLE_RATE_HZ
@@ -459,22 +492,23 @@ def encoded_synth(FMOD:bytearray, oft:OffsetTableDb):
         x[3000:3000+len(countdown)] = countdown
         print(f"{countdown=}")
 
+    if isinstance(x, np.ndarray):
+        x = [x]
     enc = Encoder()
-    new_data = enc.encode_fully(x, fixed_g=None)
+    new_data = b"".join(enc.encode_stream(x, fixed_g=None))
     print(f"{len(new_data)=}")
 
     # place "frames" into first beep's speech area (then later we make all beeps point to that slot)
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
     first_beep_entry = beep_entries[0]
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
     save_latest_first_beep_data(new_data)
 
     return FMOD
 
-def encoded_synth_raw(FMOD:bytearray, oft:OffsetTableDb):
+def encoded_synth_raw(FMOD:FlashImage, oft:OffsetTableDb):
 
     speech_lkup = "Beep 217"
     entry = oft.lookup_by_speech(speech_lkup)[0]
@@ -527,8 +561,7 @@ def encoded_synth_raw(FMOD:bytearray, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
     first_beep_entry = beep_entries[0]
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
     save_latest_first_beep_data(new_data)
 
@@ -537,7 +570,7 @@ def encoded_synth_raw(FMOD:bytearray, oft:OffsetTableDb):
 
 
 
-def synthesizer2(FMOD:bytearray, oft:OffsetTableDb):
+def synthesizer2(FMOD:FlashImage, oft:OffsetTableDb):
 
     speech_lkup = "Press Go to Begin"
     #speech_lkup = "I Win"
@@ -732,8 +765,7 @@ def synthesizer2(FMOD:bytearray, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
     first_beep_entry = beep_entries[0]
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
     save_latest_first_beep_data(new_data)
 
@@ -741,7 +773,7 @@ def synthesizer2(FMOD:bytearray, oft:OffsetTableDb):
 
 
 
-def synthesizer(FMOD:bytearray, oft:OffsetTableDb):
+def synthesizer(FMOD:FlashImage, oft:OffsetTableDb):
 
     speech_lkup = "Press Go to Begin"
     #speech_lkup = "I Win"
@@ -874,15 +906,14 @@ def synthesizer(FMOD:bytearray, oft:OffsetTableDb):
     beep_entries :typing.List[OffsetTableEntry]= oft.lookup_by_speech("*Beep*")
     first_beep_entry = beep_entries[0]
     graft_start = first_beep_entry.sound_data_start_addr
-    graft_end = graft_start + len(new_data)
-    FMOD[graft_start:graft_end] = new_data
+    graft_end = graft_data(FMOD, graft_start, new_data)
 
     save_latest_first_beep_data(new_data)
 
     return FMOD
 
 
-def access_mystery_data (FMOD:bytearray, oft:OffsetTableDb):
+def access_mystery_data (FMOD:FlashImage, oft:OffsetTableDb):
     # make the first beep point to the mystery data
     speech_lkup = "Beep *"
     entries = oft.lookup_by_speech(speech_lkup)
@@ -898,7 +929,7 @@ def access_mystery_data (FMOD:bytearray, oft:OffsetTableDb):
 
     return FMOD
 
-def change_first_byte (FMOD:bytearray, oft:OffsetTableDb):
+def change_first_byte (FMOD:FlashImage, oft:OffsetTableDb):
     # first two bytes are normally 00E0
     #FMOD[0:2] = bytes.fromhex("0010") # goes to A
     #FMOD[0:2] = bytes.fromhex("0110") # acts normal
@@ -915,19 +946,18 @@ def change_first_byte (FMOD:bytearray, oft:OffsetTableDb):
 
     return FMOD
 
-def chipmunk_mode (FMOD:bytearray, oft:OffsetTableDb, new_rate_divider_setting:int = 0x6b):
+def chipmunk_mode (FMOD:FlashImage, oft:OffsetTableDb, new_rate_divider_setting:int = 0x6b):
     #FMOD = bytearray(oft.graft_onto_image(FMOD, entry_prefix_bytes=bytes.fromhex("00ab")))
     # this way doesn't work anymore now that I implemented rate_divider correctly:
     #FMOD = bytearray(oft.graft_onto_image(FMOD, entry_prefix_bytes=bytes.fromhex("006b")))
     for ote in oft:
         ote.rate_divider = new_rate_divider_setting
-    FMOD = bytearray(oft.graft_onto_image(FMOD))
+    FMOD = oft.graft_onto_image(FMOD)
     return FMOD
 
-def parse_args():
-    import argparse
-    parser = argparse.ArgumentParser("Speak & Spell Live Trace", description="Run the em100 with a (possibly modified) flash image.")
+DESCRIPTION = "Run the em100 with a (possibly modified) flash image."
 
+def add_arguments(parser):
     parser.add_argument("-B", "--base-image", default=None, type=str, help="Load a different base image (default is original)")
 
     parser.add_argument("-M", "--mod", default="none", type=str, 
@@ -948,18 +978,39 @@ def parse_args():
         ],
         help="Apply a modification")
 
+    parser.add_argument("--record", default=None, type=str, help="Also save every operation to this binary trace recording (see trace_recording.py)")
+    parser.add_argument("--em100-cmd", default=EM100_CMD, type=str, help="em100 command (default: %(default)s); e.g. \"spana fake-em100 --replay capture.log\" to test without the hardware")
+    parser.add_argument("--max-lines-per-second", default=200, type=float, help="Output rate limit, lines beyond it are dropped (default: %(default)s)")
+    parser.add_argument("--every-op", action="store_true", help="Show every read on its own line instead of coalescing contiguous reads")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_FRAME_INDEX_DIR, help="Directory for cached frame indexes of the (modified) image (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Index the image's frames without reading or writing the cache")
+    parser.add_argument("--audio", default=None, type=str, help="Rebuild the audio being played from the speech data reads, into this wav file (rolls over to FILE_001.wav, ... when the sample rate changes), or - for 16-bit PCM on stdout (the trace then goes to stderr)")
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser("Speak & Spell Live Trace", description=DESCRIPTION)
+    add_arguments(parser)
     args = parser.parse_args()
     return args
 
-def main():
-    args = parse_args()
+def main(args=None):
+    if args is None:
+        args = parse_args()
 
+    if args.audio == "-":
+        # the audio goes to stdout, so everything else goes to stderr
+        audio_sink = RawPcmSink(sys.stdout.buffer)
+        with redirect_stdout(sys.stderr):
+            return trace_main(args, audio_sink)
+    return trace_main(args, make_sink(args.audio) if args.audio else None)
+
+def trace_main(args, audio_sink=None):
+    # mods patch FMOD in place (it's a private copy-on-write mapping of the image file)
     if args.base_image is not None:
-        F_ORIG = open(args.base_image, "rb").read()
+        FMOD = FlashImage.from_file(args.base_image)
     else:
-        F_ORIG = get_default_image_bytes()
-    oft = OffsetTableDb.from_flash_image(F_ORIG)
-    FMOD = bytearray(F_ORIG)
+        FMOD = FlashImage.get_default()
+    oft = OffsetTableDb.from_flash_image(FMOD)
 
     if args.mod != "none":
         print(f" applying modification: {args.mod} ")
@@ -1028,28 +1079,31 @@ def main():
         raise ValueError(f"Unsupported mod: {args.mod}")
 
 
+    # where each entry of the (modified) image really ends, for annotating lookups
+    frame_index = FrameIndex.load_or_build(FMOD, oft, cache_dir=None if args.no_cache else args.cache_dir)
+
     with closing(TempFileMgr()) as tfm:
 
         proc = subprocess.Popen(
-            get_em100_cmdline(tfm.get_tempfile(FMOD)),
+            get_em100_cmdline(tfm.get_tempfile(FMOD.view()), em100_cmd=args.em100_cmd),
             stdout=subprocess.PIPE,
-            encoding='utf-8',
         )
 
-        for op in parse_read_operations(proc.stdout): 
-            if op.command_str == "read":
-                print(f"read addr=0x{op.addr:05X}  len={op.len:5d}  data_prefix={op.data[:10].hex()}")
-                offset_table_idx = (op.addr - 0xb)/5
-                if offset_table_idx % 1.0 <= 1e-6:
-                    offset_table_idx = int(offset_table_idx)
-                    if 0 <= offset_table_idx < 224:
-                        entry = oft[offset_table_idx]
-                        speech = "-???-"
-                        if entry is not None and entry.speech is not None:
-                            speech = entry.speech
-                        print(f" -> Read offset table index: {offset_table_idx:3d} -> {speech}")
-            else:
-                print(op)
+        recorder = TraceRecordingWriter(args.record, source=f"live_trace --mod {args.mod}") if args.record else None
+        audio = LiveAudio(audio_sink, otd=oft) if audio_sink is not None else None
+        try:
+            stats = run_pipeline(proc.stdout, oft, recorder=recorder, audio=audio, coalesce=not args.every_op,
+                                 max_lines_per_second=args.max_lines_per_second, on_interrupt=proc.terminate,
+                                 frame_index=frame_index)
+            print(("interrupted: " if stats.interrupted else "") + stats.summary())
+        finally:
+            if recorder is not None:
+                recorder.close()
+                print(f"Recorded {len(recorder)} operations to {args.record}")
+            if audio is not None:
+                audio.close()
+                print(f"Audio: {audio.stats.summary()}")
+            proc.wait()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
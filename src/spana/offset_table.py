@@ -1,22 +1,25 @@
+from __future__ import annotations
 
-from spana.file_paths import KNOWN_PHRASES_CSV, get_default_image_bytes
-import pandas as pd
-import numpy as np
+from spana.known_phrases import KnownPhrases
+from spana.flash_image import FlashImage
+from spana.lazy_import import lazy_import
 import dataclasses
 import typing
 import struct
 import random
+import bisect
+import weakref
 
 PRESUMED_OFFSET_TABLE_LENGTH = 223          # TODO: fix this -- it's really driven from the first byte in the image
 PRESUMED_OFFSET_TABLE_BASE_ADDRESS = 0xB
+OFFSET_TABLE_ENTRIES = 224                  # slots the toy can read (including the one past PRESUMED_OFFSET_TABLE_LENGTH)
+OFFSET_TABLE_RECORD_BYTES = 5               # rate_divider (2 bytes) + speech data address (3 bytes)
 
 import fnmatch 
+import os
+import re
 
-def nan_to_none(maybe_nan):
-    if isinstance(maybe_nan, float):
-        if np.isnan(maybe_nan):
-            return None
-    return maybe_nan
+np = lazy_import("numpy", globals())
 
 
 @dataclasses.dataclass
@@ -27,6 +30,20 @@ class OffsetTableEntry:
     sound_data_end_addr: typing.Optional[int]   # exclusive, Python-style
     speech: typing.Optional[str]
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # tell the tables holding this entry, so they drop the indexes built on this field
+        # (while the dataclass __init__ runs, no table holds it yet)
+        if name in OffsetTableDb.INDEXED_ENTRY_FIELDS:
+            for otd in self.__dict__.get("_owners", ()):
+                otd._entry_changed(name)
+
+    def __getstate__(self):
+        # the tables holding this entry aren't part of it: pickles and copies start out in none
+        state = self.__dict__.copy()
+        state.pop("_owners", None)
+        return state
+
     @property
     def sample_rate_Hz(self):
         return 2e6/self.rate_divider
@@ -44,15 +61,181 @@ def check_expected_value(expected:bytes, observed:bytes, description:str):
     if expected != observed:
         ew_print(f"for field: {description}: expected {expected.hex()} but observed {observed.hex()}")
 
+def offset_table_idx(addr:typing.Optional[int]) -> typing.Optional[int]:
+    """ The offset table slot a read at addr is a lookup of, if it is one """
+    if addr is None or (addr - PRESUMED_OFFSET_TABLE_BASE_ADDRESS) % OFFSET_TABLE_RECORD_BYTES:
+        return None
+    idx = (addr - PRESUMED_OFFSET_TABLE_BASE_ADDRESS) // OFFSET_TABLE_RECORD_BYTES
+    return idx if 0 <= idx < OFFSET_TABLE_ENTRIES else None
+
+def is_offset_table_lookup(addr:np.ndarray) -> np.ndarray:
+    """ offset_table_idx for an array of read addresses: which ones are the start of an offset table slot """
+    table_offset = addr - PRESUMED_OFFSET_TABLE_BASE_ADDRESS
+    return (table_offset >= 0) & (table_offset < OFFSET_TABLE_RECORD_BYTES*OFFSET_TABLE_ENTRIES) & (table_offset % OFFSET_TABLE_RECORD_BYTES == 0)
+
+
+class SpeechAddressIndex:
+    """ Sorted interval index from speech data addresses to offset table entries.
+
+    Each distinct start address owns [start, end), where end is the entry's
+    sound_data_end_addr if that lies in (start, next distinct start], and the
+    next distinct start address otherwise (so a missing, stale or
+    out-of-order end address can't make intervals overlap or go empty).
+    When several entries share a start address, the lowest index wins.
+    Lookups return positions in the offset table (i.e. entry idxs).
+    """
+    NO_END = 2**63 - 1     # int64 max
+
+    def __init__(self, entries:typing.Sequence[OffsetTableEntry]):
+        by_start = sorted(
+            ((entry_idx, entry) for (entry_idx, entry) in enumerate(entries) if entry is not None),
+            key=lambda x: (x[1].sound_data_start_addr, x[0])
+        )
+
+        starts, ends, entry_idxs = [], [], []
+        for (entry_idx, entry) in by_start:
+            if starts and starts[-1] == entry.sound_data_start_addr:
+                continue
+            starts.append(entry.sound_data_start_addr)
+            ends.append(entry.sound_data_end_addr)
+            entry_idxs.append(entry_idx)
+
+        for pos in range(len(starts)):
+            next_start = starts[pos+1] if pos+1 < len(starts) else None
+            end = ends[pos]
+            if (end is None) or (end <= starts[pos]) or (next_start is not None and end > next_start):
+                end = next_start
+            ends[pos] = self.NO_END if end is None else end
+
+        self._starts = starts
+        self._ends = ends
+        self._entry_idxs = entry_idxs
+
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.entry_idxs = np.array(entry_idxs, dtype=np.int64)
+
+    def lookup(self, speech_data_address:int) -> int:
+        """ Returns the entry idx whose interval contains the address, or -1 """
+        pos = bisect.bisect_right(self._starts, speech_data_address) - 1
+        if pos < 0 or speech_data_address >= self._ends[pos]:
+            return -1
+        return self._entry_idxs[pos]
+
+    def lookup_many(self, speech_data_addresses) -> np.ndarray:
+        """ Vectorized lookup: maps an array of addresses to an array of entry idxs (-1 where none) """
+        addrs = np.asarray(speech_data_addresses, dtype=np.int64)
+        if not len(self.starts):
+            return np.full(addrs.shape, -1, dtype=np.int64)
+
+        pos = np.searchsorted(self.starts, addrs, side="right") - 1
+        found = pos >= 0
+        pos = np.where(found, pos, 0)
+        found &= addrs < self.ends[pos]
+        return np.where(found, self.entry_idxs[pos], -1)
+
+
+class SpeechIndex:
+    """ Speech string index for OffsetTableDb.lookup_by_speech.
+
+    Holds an exact-match dict, a case-folded dict, and a memo of glob
+    pattern -> matching entry idxs (patterns are compiled once).  Matching
+    follows fnmatch.fnmatch, including its os.path.normcase treatment.
+    """
+    GLOB_CHARS = re.compile(r"[*?\[]")
+
+    def __init__(self, entries:typing.Sequence[OffsetTableEntry]):
+        self._speeches = []     # (entry idx, normcase'd speech, casefolded speech)
+        self.exact = {}         # normcase'd speech -> [entry idxs]
+        self.casefolded = {}    # casefolded speech -> [entry idxs]
+        for entry_idx, entry in enumerate(entries):
+            if entry is None or entry.speech is None:
+                continue
+            speech = os.path.normcase(entry.speech)
+            folded = entry.speech.casefold()
+            self._speeches.append( (entry_idx, speech, folded) )
+            self.exact.setdefault(speech, []).append(entry_idx)
+            self.casefolded.setdefault(folded, []).append(entry_idx)
+
+        self._matches = {}      # (pattern, ignore_case) -> tuple of entry idxs
+
+    def match(self, speech_pattern:str, ignore_case:bool=False) -> typing.Tuple[int, ...]:
+        key = (speech_pattern, ignore_case)
+        matches = self._matches.get(key)
+        if matches is None:
+            matches = self._matches[key] = self._match_uncached(speech_pattern, ignore_case)
+        return matches
+
+    def _match_uncached(self, speech_pattern:str, ignore_case:bool) -> typing.Tuple[int, ...]:
+        if ignore_case:
+            pattern = speech_pattern.casefold()
+            exact, col = self.casefolded, 2
+        else:
+            pattern = os.path.normcase(speech_pattern)
+            exact, col = self.exact, 1
+
+        if not self.GLOB_CHARS.search(pattern):
+            return tuple(exact.get(pattern, ()))
+
+        regex_match = re.compile(fnmatch.translate(pattern)).match
+        return tuple( row[0] for row in self._speeches if regex_match(row[col]) )
+
+
 class OffsetTableDb:
+    # index name -> the entry fields it's built from
+    INDEX_FIELDS = {
+        "speech_address": ("sound_data_start_addr", "sound_data_end_addr"),
+        "speech": ("speech",),
+    }
+    INDEXED_ENTRY_FIELDS = frozenset( field for fields in INDEX_FIELDS.values() for field in fields )
+
     def __init__(self, entries):
         self._offset_table_entries : typing.List[OffsetTableEntry] = entries
+        self._indexes = {}
+        for entry in entries:
+            self._adopt(entry)
+
+    def __getstate__(self):
+        # indexes are rebuilt on demand
+        return dict(_offset_table_entries=self._offset_table_entries)
+
+    def __setstate__(self, state):
+        self.__init__(state["_offset_table_entries"])
+
+    def _adopt(self, entry:typing.Optional[OffsetTableEntry]):
+        """ Has entry report its field changes to this table (an entry can be in several tables) """
+        if entry is None:
+            return
+        owners = entry.__dict__.get("_owners")
+        if owners is None:
+            owners = weakref.WeakSet()
+            object.__setattr__(entry, "_owners", owners)
+        owners.add(self)
+
+    def _entry_changed(self, field_name:str):
+        for (name, fields) in self.INDEX_FIELDS.items():
+            if field_name in fields:
+                self._indexes.pop(name, None)
 
     def __getitem__(self, indexer) -> typing.Union[OffsetTableEntry, typing.Sequence[OffsetTableEntry]]:
         return self._offset_table_entries[indexer]
 
     def __setitem__(self, indexer, new_items):
         self._offset_table_entries[indexer] = new_items
+        for entry in (new_items if isinstance(indexer, slice) else [new_items]):
+            self._adopt(entry)
+        self._indexes.clear()
+
+    def _get_index(self, name:str, build):
+        """ Returns a cached index over the entries; it's dropped when the table, or a field it's built from, changes """
+        index = self._indexes.get(name)
+        if index is None:
+            index = self._indexes[name] = build(self._offset_table_entries)
+        return index
+
+    @property
+    def speech_address_index(self) -> SpeechAddressIndex:
+        return self._get_index("speech_address", SpeechAddressIndex)
 
     def get_by_idx(self, idx:int) -> OffsetTableEntry:
         return self._offset_table_entries[idx]
@@ -63,18 +246,42 @@ class OffsetTableDb:
     def __iter__(self):
         return iter(self._offset_table_entries)
 
-    def lookup_by_speech_data_address(self, speech_data_address:int) -> OffsetTableEntry:
-        for entry in self._offset_table_entries:
-            if entry.sound_data_start_addr <= speech_data_address:
-                if (entry.sound_data_end_addr is None) or (speech_data_address < entry.sound_data_end_addr):
-                    return entry
+    def lookup_by_speech_data_address(self, speech_data_address:int) -> typing.Optional[OffsetTableEntry]:
+        entry_idx = self.speech_address_index.lookup(speech_data_address)
+        if entry_idx < 0:
+            return None
+        return self._offset_table_entries[entry_idx]
+
+    def lookup_idxs_by_speech_data_address(self, speech_data_addresses) -> np.ndarray:
+        """ Maps a whole array of speech data addresses to entry idxs in one call (-1 where no entry matches) """
+        return self.speech_address_index.lookup_many(speech_data_addresses)
+
+    def speech_data_bounds(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """ (start, end) address arrays indexed by entry idx, as SpeechAddressIndex sees them (-1 for missing entries)
+
+        Unlike sound_data_end_addr (which from_flash_image takes from the next
+        entry in table order), an entry ends at the next higher start address
+        at the latest.  The last entry's end is SpeechAddressIndex.NO_END.
+        """
+        index = self.speech_address_index
+        starts = np.full(len(self), -1, dtype=np.int64)
+        ends = np.full(len(self), -1, dtype=np.int64)
+        for (idx, entry) in enumerate(self):
+            if entry is not None:
+                starts[idx] = entry.sound_data_start_addr
+        # entries sharing a start address share the interval of the one the index kept
+        ends[index.entry_idxs] = index.ends
+        for (idx, entry) in enumerate(self):
+            if entry is not None and ends[idx] < 0:
+                ends[idx] = ends[index.lookup(entry.sound_data_start_addr)]
+        return starts, ends
 
-    def lookup_by_speech(self, speech_pattern:str, single_match=False) -> typing.Union[OffsetTableEntry, typing.Sequence[OffsetTableEntry]]:
-        matches = []
-        for entry in self._offset_table_entries:
-            if entry.speech is not None:
-                if fnmatch.fnmatch(entry.speech, speech_pattern):
-                    matches.append(entry)
+    @property
+    def speech_index(self) -> SpeechIndex:
+        return self._get_index("speech", SpeechIndex)
+
+    def lookup_by_speech(self, speech_pattern:str, single_match=False, ignore_case=False) -> typing.Union[OffsetTableEntry, typing.Sequence[OffsetTableEntry]]:
+        matches = [ self._offset_table_entries[entry_idx] for entry_idx in self.speech_index.match(speech_pattern, ignore_case) ]
         if single_match:
             if len(matches) < 1:
                 raise ValueError(f"no match for pattern: \"{speech_pattern}\"")
@@ -102,6 +309,11 @@ class OffsetTableDb:
         return bytes(ba)
 
     def graft_onto_image(self, FDAT:bytes, entry_prefix_bytes=None):
+        if isinstance(FDAT, FlashImage):
+            # patched in place, no copy
+            FDAT.apply_offset_table(self)
+            return FDAT
+
         FMOD = bytearray(FDAT)
         del FDAT
         new_bytes = self.generate_bytes_for_image(entry_prefix_bytes)
@@ -110,16 +322,13 @@ class OffsetTableDb:
 
     @classmethod
     def get_default(cls):
-        FDATA = get_default_image_bytes()
+        FDATA = FlashImage.get_default()
         return cls.from_flash_image(FDATA)
 
     @classmethod
     def get_blank(cls, num_offset_table_entries, rate_divider:int=0xcd):
 
-        offset_table_idx_to_speech = {}
-        if 1:
-            df = pd.read_csv(KNOWN_PHRASES_CSV)
-            offset_table_idx_to_speech = dict([ (row['offset_table_idx'], nan_to_none(row['speech'])) for idx,row in df.iterrows()])
+        offset_table_idx_to_speech = KnownPhrases.get().idx_to_speech
 
         entries = [
             OffsetTableEntry(
@@ -142,10 +351,7 @@ class OffsetTableDb:
         check_expected_value( bytes.fromhex("00e0"), FDATA[0:2], "initial header" )
         check_expected_value( bytes.fromhex("00000b"), FDATA[2:5], "offset table base address" )
 
-        offset_table_idx_to_speech = {}
-        if 1:
-            df = pd.read_csv(KNOWN_PHRASES_CSV)
-            offset_table_idx_to_speech = dict([ (row['offset_table_idx'], nan_to_none(row['speech'])) for idx,row in df.iterrows()])
+        offset_table_idx_to_speech = KnownPhrases.get().idx_to_speech
 
         for offset_table_idx in range(offset_table_length):
             offset_entry_addr = 0xb + 5*offset_table_idx
@@ -1,18 +1,15 @@
 from spana.offset_table import OffsetTableDb, OffsetTableEntry
 from spana.encoder import Encoder
 from itertools import count
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
 
 import glob
 import os
 
 this_file_dir = os.path.dirname(os.path.normpath(__file__))
 
-def parse_args():
-    import argparse
+DESCRIPTION = "Split a recording into one wav file per word, at the silences"
 
-    parser = argparse.ArgumentParser("constructor", "Build a Speak & Spell flash image from wav files")
+def add_arguments(parser):
     parser.add_argument("-o", "--output-dir", required=1, type=str, help="Output dir for chunks")
     parser.add_argument("-I", "--start-idx", default=0, type=int, help="Initial start idx for output files")
     parser.add_argument("-F", "--format-str", default=None, type=str, help="Format string for output filenames")
@@ -20,6 +17,11 @@ def parse_args():
     parser.add_argument("-S", "--silence-len-milliseconds", default=500, type=int, help="Expected silence length in milliseconds")
     parser.add_argument("input_file", nargs=1, help="The input file to split")
 
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("constructor", "Build a Speak & Spell flash image from wav files")
+    add_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -29,13 +31,15 @@ def parse_args():
 
 
 def split_file(input_file:str, output_dir:str, filename_format:str=None, start_idx:int=0, target_num_splits:int=None, silence_len_milliseconds:int=None):
+    from pydub import AudioSegment
+    from pydub.silence import split_on_silence
 
     if filename_format is None:
         filename_format = "split_{idx:03d}.wav" 
     
     os.makedirs(output_dir, exist_ok=True)
 
-    seg : AudioSegment = AudioSegment.from_file(input_file)
+    seg = AudioSegment.from_file(input_file)
 
     #silence_lens_to_try = [1000, 900, 800, 700, 600, 550, 500, 400, 300, 200, 100]
     silence_lens_to_try = list(reversed([100+10*i for i in range(0, 90+1)]))
@@ -57,6 +61,10 @@ def split_file(input_file:str, output_dir:str, filename_format:str=None, start_i
         seg.export( out_f=out_filename, format='wav' )
     print(f" wrote {len(segments)} splits")
 
-if __name__ == "__main__":
-    args = parse_args()
+def main(args=None):
+    if args is None:
+        args = parse_args()
     split_file(args.input_file[0], args.output_dir, args.format_str, args.start_idx, args.target_num_splits, args.silence_len_milliseconds)
+
+if __name__ == "__main__":
+    main()
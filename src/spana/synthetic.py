@@ -0,0 +1,196 @@
+""" Synthetic flash images and em100 trace logs, for tests, benchmarks and load testing.
+
+synthetic_image() builds a structurally valid Speak & Spell image out of
+synthetic audio, through the real Encoder, ImageBuilder and OffsetTableDb, for
+any number of entries and any flash size.  write_em100_log() streams an em100
+trace (the text parse_trace expects) of someone "playing" entries of such an
+image, to any length: it only ever holds one read operation in memory.
+"""
+from __future__ import annotations
+
+from spana.encoder import Encoder, FRAME_SIZE_BYTES, SAMPLES_PER_FRAME
+from spana.flash_image import FlashImage, FLASH_SIZE_BYTES
+from spana.image_builder import ImageBuilder, SOUND_SECTION_START_OFFSET
+from spana.offset_table import OffsetTableDb, OffsetTableEntry, PRESUMED_OFFSET_TABLE_BASE_ADDRESS
+from spana.known_phrases import KnownPhrases
+from spana.parse_trace import READ_OP
+from spana.lazy_import import lazy_import
+import typing
+
+np = lazy_import("numpy", globals())
+
+NORMALIZE_PEAK = 450        # same as compile_voice_pack
+SAMPLE_RATE_HZ = 10000
+RATE_DIVIDER = 200          # 10kHz
+
+PREFIX = bytes.fromhex("008800 008800 008800 008800")
+SEPARATOR = bytes.fromhex('008800 008800 008800 008800 008801 000000')
+ENTRY_OVERHEAD_BYTES = len(PREFIX) + 2*len(SEPARATOR)
+
+READ_STATUS_OP = 0x05
+
+
+def synthetic_speech(num_samples:int, sample_rate_Hz:int=SAMPLE_RATE_HZ, seed:int=0) -> np.ndarray:
+    """ Vowel-ish test signal: a wandering pitch with a few harmonics, amplitude bursts and some noise,
+    normalized the way compile_voice_pack does """
+    rnd = np.random.default_rng(seed)
+    t = np.arange(num_samples) / sample_rate_Hz
+    pitch_Hz = 100 + 20*(seed % 5) + 40*np.sin(2*np.pi*0.7*t)
+    phase = 2*np.pi*np.cumsum(pitch_Hz) / sample_rate_Hz
+    s = sum( np.sin(k*phase) / k for k in range(1, 8) )
+    s *= 0.2 + 0.8*np.abs(np.sin(2*np.pi*2.5*t + seed))
+    s += 0.05*rnd.standard_normal(num_samples)
+    return (s / np.abs(s).max() * NORMALIZE_PEAK).round().astype(int)
+
+
+def sound_section_start(num_entries:int) -> int:
+    """ Where speech data can start: 0x470 like the real image, or right after a bigger offset table """
+    table_end = PRESUMED_OFFSET_TABLE_BASE_ADDRESS + 5*num_entries
+    return max(SOUND_SECTION_START_OFFSET, (table_end + 0xF) & ~0xF)
+
+
+def samples_to_fill(num_entries:int, flash_size:int, fill_fraction:float) -> int:
+    """ Samples per entry so that num_entries encoded entries take up about fill_fraction of the flash """
+    available = (flash_size - sound_section_start(num_entries)) * fill_fraction
+    frames = int(available / num_entries - ENTRY_OVERHEAD_BYTES) // FRAME_SIZE_BYTES
+    if frames < 1:
+        raise ValueError(f"{num_entries} entries don't fit in a 0x{flash_size:X}-byte flash")
+    return frames * SAMPLES_PER_FRAME
+
+
+def synthetic_image(num_entries:int=224, flash_size:int=FLASH_SIZE_BYTES, samples_per_entry:typing.Optional[int]=None,
+                    fill_fraction:float=0.6, seed:int=0) -> typing.Tuple[FlashImage, OffsetTableDb]:
+    """ A flash image with num_entries distinct entries, laid out like compile_voice_pack does.
+
+    Unless samples_per_entry is given, entries are sized to fill about
+    fill_fraction of the flash.  Entries past the known phrases get no speech.
+    """
+    if samples_per_entry is None:
+        samples_per_entry = samples_to_fill(num_entries, flash_size, fill_fraction)
+
+    idx_to_speech = KnownPhrases.get().idx_to_speech
+    enc = Encoder()
+    builder = ImageBuilder(start_addr=sound_section_start(num_entries), flash_size=flash_size)
+    entries = []
+    for idx in range(num_entries):
+        blob = PREFIX + enc.encode_fully(synthetic_speech(samples_per_entry, seed=seed+idx)) + SEPARATOR*2
+        addr = builder.add_blob(blob, entry_idx=idx)
+        entries.append(OffsetTableEntry(idx=idx, rate_divider=RATE_DIVIDER, sound_data_start_addr=addr,
+                                        sound_data_end_addr=addr+len(blob), speech=idx_to_speech.get(idx)))
+
+    otd = OffsetTableDb(entries)
+    return builder.build(otd), otd
+
+
+# --- em100 trace logs ---
+
+def command_line(timestamp:float, command_idx:int, command:int, command_name:str) -> str:
+    return f"Time: {timestamp:015.8f} command # {command_idx:<6d} : 0x{command:02x} - {command_name}\n"
+
+def data_lines(addr:int, data:bytes) -> str:
+    """ em100's hex dump of an operation's data: 16 bytes per line, each line prefixed with its address """
+    return "".join( f"{addr+offset:08x} : {data[offset:offset+16].hex(' ')} \n" for offset in range(0, len(data), 16) )
+
+
+def em100_log_chunks(image:FlashImage, otd:OffsetTableDb, read_chunk_len:int=256, status_poll_every:int=8, seed:int=0) -> typing.Generator[str, None, None]:
+    """ Endless em100 log text, one operation per chunk.
+
+    Models the Speak & Spell saying random entries: a 5-byte read of the
+    entry's offset table record, then its speech data in read_chunk_len reads
+    paced at the entry's playback rate, with a read status command every
+    status_poll_every reads and a pause between words.
+    """
+    rnd = np.random.default_rng(seed)
+    entries = [ ote for ote in otd if ote is not None and ote.sound_data_end_addr ]
+    timestamp = 0.0
+    command_idx = 0
+
+    def read(addr:int, length:int) -> str:
+        nonlocal command_idx
+        command_idx += 1
+        return command_line(timestamp, command_idx, READ_OP, "read") + data_lines(addr, image[addr:addr+length])
+
+    while True:
+        ote = entries[int(rnd.integers(len(entries)))]
+        bytes_per_second = FRAME_SIZE_BYTES * ote.sample_rate_Hz / SAMPLES_PER_FRAME
+
+        yield read(PRESUMED_OFFSET_TABLE_BASE_ADDRESS + 5*ote.idx, 5)
+        timestamp += 20e-6
+        for (num_reads, addr) in enumerate(range(ote.sound_data_start_addr, ote.sound_data_end_addr, read_chunk_len), 1):
+            length = min(read_chunk_len, ote.sound_data_end_addr - addr)
+            yield read(addr, length)
+            timestamp += length / bytes_per_second
+            if num_reads % status_poll_every == 0:
+                command_idx += 1
+                yield command_line(timestamp, command_idx, READ_STATUS_OP, "read status register")
+                timestamp += 5e-6
+        timestamp += rnd.uniform(0.2, 1.5)
+
+
+def write_em100_log(out_fo, image:FlashImage, otd:OffsetTableDb, target_bytes:int, **kwargs) -> int:
+    """ Writes at least target_bytes (stopping at the first operation boundary past it) of em100_log_chunks() to out_fo.
+
+    Returns the number of bytes (characters) written.
+    """
+    num_written = 0
+    pending = []
+    pending_len = 0
+    for chunk in em100_log_chunks(image, otd, **kwargs):
+        pending.append(chunk)
+        pending_len += len(chunk)
+        if pending_len >= 1<<20 or num_written + pending_len >= target_bytes:
+            out_fo.write("".join(pending))
+            num_written += pending_len
+            pending = []
+            pending_len = 0
+            if num_written >= target_bytes:
+                break
+    return num_written
+
+
+def parse_size(size:str) -> int:
+    """ "4096", "0x100000", "64K", "100M", "2G" -> bytes """
+    units = { "K": 2**10, "M": 2**20, "G": 2**30 }
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size, 0)
+
+
+DESCRIPTION = "Generate a synthetic flash image (and optionally an em100 trace log of it being played)"
+
+def add_arguments(parser):
+    parser.add_argument("-o", "--output-filename", type=str, default="synthetic_flash_image.bin", help="Output image filename (default: %(default)s)")
+    parser.add_argument("-n", "--num-entries", type=int, default=224, help="Offset table entries (default: %(default)s)")
+    parser.add_argument("--flash-size", type=parse_size, default=FLASH_SIZE_BYTES, help="Flash size in bytes, e.g. 0x100000 or 4M (default: 1M)")
+    parser.add_argument("--samples-per-entry", type=int, default=None, help="Samples of audio per entry (default: enough to fill --fill of the flash)")
+    parser.add_argument("--fill", type=float, default=0.6, help="Fraction of the flash to fill with speech data (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", type=str, default=None, help="Also write an em100 trace log of the image being played to this file")
+    parser.add_argument("--trace-size", type=parse_size, default=10*2**20, help="Size of the trace log, e.g. 100M or 2G (default: 10M)")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("synthetic", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    image, otd = synthetic_image(args.num_entries, flash_size=args.flash_size, samples_per_entry=args.samples_per_entry,
+                                 fill_fraction=args.fill, seed=args.seed)
+    image.save(args.output_filename)
+    used_end = max(ote.sound_data_end_addr for ote in otd)
+    print(f"Wrote {args.output_filename}: {len(otd)} entries, speech data up to 0x{used_end:06X} of 0x{len(image):06X}")
+
+    if args.trace:
+        with open(args.trace, "w") as out_fo:
+            num_written = write_em100_log(out_fo, image, otd, args.trace_size, seed=args.seed)
+        print(f"Wrote {args.trace}: {num_written} bytes of em100 trace")
+
+if __name__ == "__main__":
+    main()
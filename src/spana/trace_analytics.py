@@ -0,0 +1,217 @@
+""" What a trace says the toy did: which entries it played, when, and how much of each.
+
+analyze_trace() works on a trace's columns (see trace_recording) in a few
+numpy passes, no per-operation Python:
+
+  * reads of a 5-byte offset table slot are the toy looking up an entry
+  * every other read is mapped to the entry whose speech data it falls in
+    (OffsetTableDb.lookup_idxs_by_speech_data_address)
+  * consecutive speech reads of the same entry that continue where the last
+    one left off, with no offset table lookup in between, make up one play
+
+Each play becomes a word of the transcript; per-entry totals (plays, bytes
+and frames read, plays that stopped before the end of the entry) are summed
+over the plays.
+"""
+from __future__ import annotations
+
+from spana.encoder import FRAME_SIZE_BYTES
+from spana.offset_table import (
+    OffsetTableDb, PRESUMED_OFFSET_TABLE_BASE_ADDRESS, OFFSET_TABLE_ENTRIES, OFFSET_TABLE_RECORD_BYTES, is_offset_table_lookup,
+)
+from spana.parse_trace import READ_OP
+from spana.trace_recording import TraceRecording, load_trace
+from spana.flash_image import FlashImage
+from spana.frame_index import FrameIndex
+from spana.lazy_import import lazy_import
+import dataclasses
+import typing
+
+np = lazy_import("numpy", globals())
+
+# a play counts as complete if it got to within this many bytes of the end of the entry
+# (blobs end in separator frames, which the toy may not bother to fetch)
+END_SLACK_BYTES = 3*FRAME_SIZE_BYTES
+
+
+@dataclasses.dataclass
+class Plays:
+    """ One element per play of an entry """
+    entry_idx: np.ndarray
+    start_time: np.ndarray      # timestamp of the first read
+    end_time: np.ndarray        # timestamp of the last read
+    start_addr: np.ndarray
+    end_addr: np.ndarray        # one past the last byte read
+    bytes_read: np.ndarray
+    num_reads: np.ndarray
+    frames_consumed: np.ndarray
+    ended_early: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.entry_idx)
+
+
+@dataclasses.dataclass
+class EntryStats:
+    """ One element per offset table entry """
+    play_count: np.ndarray
+    bytes_read: np.ndarray
+    frames_consumed: np.ndarray
+    early_endings: np.ndarray
+    offset_table_reads: np.ndarray
+    play_time_s: np.ndarray
+
+
+@dataclasses.dataclass
+class TranscriptWord:
+    timestamp: float
+    entry_idx: int
+    speech: str
+    duration_s: float
+    ended_early: bool
+
+    def __str__(self):
+        return f"{self.timestamp:12.6f}s  [{self.entry_idx:3d}] {self.speech}" + ("  (cut short)" if self.ended_early else "")
+
+
+@dataclasses.dataclass
+class TraceAnalysis:
+    otd: OffsetTableDb
+    plays: Plays
+    entries: EntryStats
+    num_reads: int
+    unmapped_reads: int         # reads of neither the offset table nor any entry's speech data
+    unmapped_bytes: int
+    read_pos: np.ndarray        # trace index of each read
+    read_play: np.ndarray       # the play each read belongs to (-1 for lookups and unmapped reads)
+
+    def transcript(self) -> typing.List[TranscriptWord]:
+        plays = self.plays
+        words = []
+        for (entry_idx, start_time, end_time, ended_early) in zip(plays.entry_idx.tolist(), plays.start_time.tolist(),
+                                                                  plays.end_time.tolist(), plays.ended_early.tolist()):
+            entry = self.otd[entry_idx]
+            speech = entry.speech if entry.speech is not None else f"<entry {entry_idx}>"
+            words.append(TranscriptWord(start_time, entry_idx, speech, end_time - start_time, ended_early))
+        return words
+
+    def format_entry_table(self) -> str:
+        e = self.entries
+        lines = [f"{'idx':>4s} {'plays':>6s} {'lookups':>8s} {'bytes':>10s} {'frames':>8s} {'cut short':>9s} {'time (s)':>9s}  speech"]
+        for idx in np.flatnonzero((e.play_count > 0) | (e.offset_table_reads > 0)).tolist():
+            speech = self.otd[idx].speech if idx < len(self.otd) and self.otd[idx] is not None else None
+            lines.append(f"{idx:4d} {e.play_count[idx]:6d} {e.offset_table_reads[idx]:8d} {e.bytes_read[idx]:10d} "
+                         f"{e.frames_consumed[idx]:8d} {e.early_endings[idx]:9d} {e.play_time_s[idx]:9.3f}  {speech or '-'}")
+        return "\n".join(lines)
+
+    def summary(self) -> str:
+        return (f"{self.num_reads} reads: {len(self.plays)} plays of {int((self.entries.play_count > 0).sum())} distinct entries "
+                f"({int(self.plays.ended_early.sum())} cut short), {int(self.entries.offset_table_reads.sum())} offset table lookups, "
+                f"{self.unmapped_reads} other reads ({self.unmapped_bytes} bytes)")
+
+
+def analyze_trace(trace:TraceRecording, otd:OffsetTableDb, entry_ends:typing.Optional[np.ndarray]=None) -> TraceAnalysis:
+    """ entry_ends: where each entry's speech really ends (default: where the offset table says the next one starts) """
+    read_pos = np.flatnonzero((trace.command == READ_OP) & (trace.addr >= 0))
+    addr = trace.addr[read_pos]
+    length = trace.len[read_pos].astype(np.int64)
+    timestamp = trace.timestamp[read_pos]
+
+    is_lookup = is_offset_table_lookup(addr)
+    entry_idx = np.full(len(addr), -1, dtype=np.int64)
+    entry_idx[~is_lookup] = otd.lookup_idxs_by_speech_data_address(addr[~is_lookup])
+    is_speech = entry_idx >= 0
+    unmapped = ~is_lookup & ~is_speech
+
+    # a new play starts at a speech read of a different entry, one that doesn't continue the previous read,
+    # or the first one after an offset table lookup
+    lookups_so_far = np.cumsum(is_lookup)[is_speech]
+    (e, a, n, t) = (entry_idx[is_speech], addr[is_speech], length[is_speech], timestamp[is_speech])
+    new_play = np.ones(len(e), dtype=bool)
+    new_play[1:] = ((e[1:] != e[:-1]) | (lookups_so_far[1:] != lookups_so_far[:-1])
+                    | (a[1:] < a[:-1]) | (a[1:] > a[:-1] + n[:-1]))
+    play_starts = np.flatnonzero(new_play)
+    read_play = np.full(len(addr), -1, dtype=np.int64)
+    read_play[is_speech] = np.cumsum(new_play) - 1
+    play_lasts = np.r_[play_starts[1:], len(e)] - 1
+
+    starts, ends = otd.speech_data_bounds()
+    if entry_ends is not None:
+        ends = np.asarray(entry_ends, dtype=np.int64)
+    play_entry = e[play_starts]
+    if len(play_starts):
+        end_addr = np.maximum.reduceat(a + n, play_starts)
+        bytes_read = np.add.reduceat(n, play_starts)
+    else:
+        end_addr = bytes_read = np.zeros(0, dtype=np.int64)
+    entry_start, entry_end = starts[play_entry], ends[play_entry]
+    covered = np.clip(end_addr, entry_start, entry_end) - entry_start
+    plays = Plays(
+        entry_idx=play_entry,
+        start_time=t[play_starts],
+        end_time=t[play_lasts],
+        start_addr=a[play_starts],
+        end_addr=end_addr,
+        bytes_read=bytes_read,
+        num_reads=play_lasts - play_starts + 1,
+        frames_consumed=covered // FRAME_SIZE_BYTES,
+        ended_early=(entry_end != otd.speech_address_index.NO_END) & (end_addr < entry_end - END_SLACK_BYTES),
+    )
+
+    num_entries = max(len(otd), OFFSET_TABLE_ENTRIES)
+    def per_entry(weights=None, idxs=play_entry):
+        return np.bincount(idxs, weights=weights, minlength=num_entries)[:num_entries]
+    entries = EntryStats(
+        play_count=per_entry(),
+        bytes_read=per_entry(plays.bytes_read).astype(np.int64),
+        frames_consumed=per_entry(plays.frames_consumed).astype(np.int64),
+        early_endings=per_entry(plays.ended_early.astype(np.int64)).astype(np.int64),
+        offset_table_reads=per_entry(idxs=(addr[is_lookup] - PRESUMED_OFFSET_TABLE_BASE_ADDRESS) // OFFSET_TABLE_RECORD_BYTES),
+        play_time_s=per_entry(plays.end_time - plays.start_time),
+    )
+
+    return TraceAnalysis(
+        otd=otd,
+        plays=plays,
+        entries=entries,
+        num_reads=len(read_pos),
+        unmapped_reads=int(unmapped.sum()),
+        unmapped_bytes=int(length[unmapped].sum()),
+        read_pos=read_pos,
+        read_play=read_play,
+    )
+
+
+DESCRIPTION = "Rebuild what the toy said from a trace: a word transcript and per-entry statistics"
+
+def add_arguments(parser):
+    parser.add_argument("trace_filename", type=str, help="em100 text log or trace recording")
+    parser.add_argument("-B", "--base-image", default=None, type=str, help="Flash image the trace was taken with (default is original)")
+    parser.add_argument("--no-transcript", action="store_true", help="Only print the per-entry table")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("trace_analytics", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    image = FlashImage.from_file(args.base_image) if args.base_image is not None else FlashImage.get_default()
+    otd = OffsetTableDb.from_flash_image(image)
+    analysis = analyze_trace(load_trace(args.trace_filename), otd, entry_ends=FrameIndex.load_or_build(image, otd).entry_ends())
+
+    if not args.no_transcript:
+        for word in analysis.transcript():
+            print(word)
+        print()
+    print(analysis.format_entry_table())
+    print()
+    print(analysis.summary())
+
+if __name__ == "__main__":
+    main()
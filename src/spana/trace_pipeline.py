@@ -0,0 +1,314 @@
+""" live_trace's reader -> parser -> presenter pipeline.
+
+The em100 can produce operations faster than a terminal can print them, so
+the stages run in their own threads, joined by bounded queues:
+
+    reader      reads whatever em100 has written so far and passes it on as a batch of lines.
+                Blocks when the parser is behind (nothing raw is ever dropped).
+    parser      parse_read_operations() over those batches; records every operation
+                (if recording), feeds it to the live audio (if any, see live_audio) and
+                offers it to the presenter, dropping it from the display if the
+                presenter's queue is full.
+    presenter   (the calling thread) formats operations, coalescing contiguous reads
+                into one line, and writes the lines out in batches every flush_interval,
+                at most max_lines_per_second of them.
+
+Everything that gets dropped or coalesced is counted in PipelineStats.  If
+any stage fails, the pipeline shuts down (calling on_interrupt, e.g. to stop
+em100, which never closes its output by itself) and run() raises the error.
+"""
+from spana.parse_trace import parse_read_operations, SPIFlashOperation
+from spana.offset_table import OffsetTableDb, offset_table_idx
+import collections
+import dataclasses
+import queue
+import sys
+import threading
+import time
+import typing
+
+READ_SIZE = 1 << 16
+LINES_QUEUE_LEN = 64        # batches of up to READ_SIZE bytes
+OPS_QUEUE_LEN = 4096
+JOIN_TIMEOUT_S = 10.0
+POLL_INTERVAL_S = 0.1       # how often a blocked stage checks whether the pipeline is shutting down
+
+_END = object()
+
+
+@dataclasses.dataclass
+class PipelineStats:
+    bytes_read: int = 0
+    lines_read: int = 0
+    batches: int = 0
+    ops_parsed: int = 0
+    ops_dropped: int = 0        # parsed (and recorded) but not displayed: the presenter was behind
+    lines_coalesced: int = 0    # operations folded into another operation's line
+    lines_written: int = 0
+    lines_dropped: int = 0      # over the output rate limit
+    max_queue_depth: int = 0    # of line batches waiting for the parser
+    total_parse_lag_s: float = 0.0
+    max_parse_lag_s: float = 0.0
+    interrupted: bool = False
+
+    @property
+    def mean_parse_lag_s(self) -> float:
+        return self.total_parse_lag_s / self.batches if self.batches else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.ops_parsed} operations from {self.lines_read} lines ({self.bytes_read} bytes); "
+                f"shown in {self.lines_written} lines, {self.lines_coalesced} coalesced, "
+                f"{self.lines_dropped} lines and {self.ops_dropped} operations dropped; "
+                f"parse lag mean {self.mean_parse_lag_s*1e3:.1f} ms, max {self.max_parse_lag_s*1e3:.1f} ms; "
+                f"max queue depth {self.max_queue_depth}/{LINES_QUEUE_LEN}")
+
+
+@dataclasses.dataclass
+class _ReadRun:
+    """ Contiguous reads (and the data-less commands between them) shown as one line """
+    addr: int
+    len: int
+    data_prefix: bytes
+    num_reads: int = 1
+    others: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+
+
+class TracePresenter:
+    """ Turns operations into the lines live_trace shows """
+
+    def __init__(self, oft:OffsetTableDb, coalesce:bool=True, frame_index=None):
+        """ frame_index (optional, see frame_index) adds how much speech data each looked-up entry really has """
+        self.oft = oft
+        self.coalesce = coalesce
+        self.frame_index = frame_index
+        self.lines_coalesced = 0
+        self._run = None
+
+    def read_line(self, addr:int, length:int, data_prefix:bytes) -> str:
+        return f"read addr=0x{addr:05X}  len={length:5d}  data_prefix={data_prefix.hex()}"
+
+    def offset_table_line(self, idx:int) -> str:
+        entry = self.oft[idx] if idx < len(self.oft) else None
+        speech = "-???-"
+        if entry is not None and entry.speech is not None:
+            speech = entry.speech
+        line = f" -> Read offset table index: {idx:3d} -> {speech}"
+        if self.frame_index is not None and self.frame_index.covers(entry):
+            line += f"  ({self.frame_index.true_ends[idx] - self.frame_index.starts[idx]} bytes, {self.frame_index.stop_frames[idx]} frames)"
+        return line
+
+    def add(self, op:SPIFlashOperation) -> typing.List[str]:
+        """ Lines finished by op (possibly none, if it was coalesced) """
+        run = self._run
+        if op.command_str != "read" or op.addr is None:
+            if run is not None and not op.data:
+                run.others[op.command_str] += 1
+                self.lines_coalesced += 1
+                return []
+            return self.finish() + [str(op)]
+
+        idx = offset_table_idx(op.addr)
+        if run is not None and idx is None and op.addr == run.addr + run.len:
+            run.len += op.len
+            run.num_reads += 1
+            self.lines_coalesced += 1
+            return []
+
+        lines = self.finish()
+        if idx is not None:
+            lines += [self.read_line(op.addr, op.len, op.data[:10]), self.offset_table_line(idx)]
+        elif self.coalesce:
+            self._run = _ReadRun(op.addr, op.len, bytes(op.data[:10]))
+        else:
+            lines.append(self.read_line(op.addr, op.len, op.data[:10]))
+        return lines
+
+    def finish(self) -> typing.List[str]:
+        """ The line for the reads in progress, if any """
+        run, self._run = self._run, None
+        if run is None:
+            return []
+        line = self.read_line(run.addr, run.len, run.data_prefix)
+        if run.num_reads > 1 or run.others:
+            line += f"  ({run.num_reads} reads" + "".join(f", {n}x {name}" for (name, n) in run.others.items()) + ")"
+        return [line]
+
+
+class TracePipeline:
+    def __init__(self, in_fo, oft:OffsetTableDb, out_fo=None, recorder=None, audio=None, coalesce:bool=True,
+                 max_lines_per_second:float=200, flush_interval:float=0.1, on_interrupt:typing.Optional[typing.Callable]=None,
+                 frame_index=None):
+        """ in_fo: binary stream of em100 output (e.g. its stdout pipe); recorder: a TraceRecordingWriter or None;
+        audio: a LiveAudio or None; on_interrupt: called on ^C, e.g. to stop em100 so the parser can finish;
+        frame_index: a FrameIndex of the image, to annotate lookups with, or None """
+        self.in_fo = in_fo
+        self.out_fo = out_fo if out_fo is not None else sys.stdout
+        self.recorder = recorder
+        self.audio = audio
+        self._batch_read_time = None    # when the batch the parser is on was read
+        self.presenter = TracePresenter(oft, coalesce=coalesce, frame_index=frame_index)
+        self.flush_interval = flush_interval
+        self.lines_per_flush = max(1, int(max_lines_per_second * flush_interval))
+        self.on_interrupt = on_interrupt
+        self.stats = PipelineStats()
+        self._lines_q = queue.Queue(LINES_QUEUE_LEN)
+        self._ops_q = queue.Queue(OPS_QUEUE_LEN)
+        self._errors = []
+        self._stopping = threading.Event()
+
+    def _put(self, q:queue.Queue, item):
+        """ q.put(item), unless the pipeline shuts down while q is full """
+        while not self._stopping.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL_S)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q:queue.Queue):
+        """ q.get(), or _END if the pipeline shuts down while q is empty """
+        while not self._stopping.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _read(self):
+        stats = self.stats
+        remainder = b""
+        try:
+            while True:
+                chunk = self.in_fo.read1(READ_SIZE)
+                if not chunk:
+                    break
+                read_time = time.monotonic()
+                stats.bytes_read += len(chunk)
+                chunk = remainder + chunk
+                end = chunk.rfind(b"\n") + 1
+                remainder = chunk[end:]
+                if end:
+                    lines = chunk[:end].decode("utf-8", "replace").splitlines()
+                    stats.lines_read += len(lines)
+                    self._put(self._lines_q, (read_time, lines))
+                    stats.max_queue_depth = max(stats.max_queue_depth, self._lines_q.qsize())
+                if self._stopping.is_set():
+                    return
+            if remainder:
+                stats.lines_read += 1
+                self._put(self._lines_q, (time.monotonic(), [remainder.decode("utf-8", "replace")]))
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._put(self._lines_q, _END)
+
+    def _lines(self) -> typing.Generator[str, None, None]:
+        stats = self.stats
+        while True:
+            item = self._get(self._lines_q)
+            if item is _END:
+                return
+            (read_time, lines) = item
+            self._batch_read_time = read_time
+            yield from lines
+            lag = time.monotonic() - read_time
+            stats.batches += 1
+            stats.total_parse_lag_s += lag
+            stats.max_parse_lag_s = max(stats.max_parse_lag_s, lag)
+
+    def _parse(self):
+        stats = self.stats
+        try:
+            for op in parse_read_operations(self._lines()):
+                stats.ops_parsed += 1
+                if self.recorder is not None:
+                    self.recorder.write(op)
+                if self.audio is not None:
+                    # an operation is only complete once the next one's line has been read
+                    self.audio.write(op, read_time=self._batch_read_time)
+                try:
+                    self._ops_q.put_nowait(op)
+                except queue.Full:
+                    stats.ops_dropped += 1
+        except Exception as e:
+            # run() stops em100 and raises this once the presenter sees _END
+            self._errors.append(e)
+        finally:
+            self._put(self._ops_q, _END)
+
+    def _write(self, lines:typing.List[str]):
+        if len(lines) > self.lines_per_flush:
+            self.stats.lines_dropped += len(lines) - self.lines_per_flush
+            lines = lines[:self.lines_per_flush] + [f"  ... {len(lines) - self.lines_per_flush} lines dropped (output rate limit)"]
+        if lines:
+            self.out_fo.write("".join(line + "\n" for line in lines))
+            self.out_fo.flush()
+            self.stats.lines_written += len(lines)
+
+    def _present(self):
+        pending = []
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                op = self._ops_q.get(timeout=max(0.0, next_flush - time.monotonic()))
+            except queue.Empty:
+                op = None
+            if op is _END:
+                break
+            if op is not None:
+                pending += self.presenter.add(op)
+            if time.monotonic() >= next_flush:
+                self._write(pending)
+                pending = []
+                next_flush = time.monotonic() + self.flush_interval
+        self._write(pending + self.presenter.finish())
+
+    def _discard_until_end(self):
+        """ Lets the parser finish (and record) what em100 already sent, without showing it """
+        while True:
+            try:
+                op = self._ops_q.get(timeout=JOIN_TIMEOUT_S)
+            except queue.Empty:
+                return
+            if op is _END:
+                return
+            self.stats.ops_dropped += 1
+
+    def _shut_down(self, threads:typing.List[threading.Thread]):
+        """ After a failure: stops em100 and the other stages (which are daemon threads, so a read
+        that never returns can't keep the process alive) """
+        self._stopping.set()
+        if self.on_interrupt is not None:
+            self.on_interrupt()
+        for thread in threads:
+            thread.join(POLL_INTERVAL_S * 10)
+
+    def run(self) -> PipelineStats:
+        """ Runs until in_fo ends (or ^C); raises the first error any stage hit """
+        threads = [ threading.Thread(target=self._read, name="trace-reader", daemon=True),
+                    threading.Thread(target=self._parse, name="trace-parser", daemon=True) ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._present()
+        except KeyboardInterrupt:
+            self.stats.interrupted = True
+            if self.on_interrupt is not None:
+                self.on_interrupt()
+            self._discard_until_end()
+        except BaseException:
+            # e.g. BrokenPipeError, when the output goes to `head`
+            self._shut_down(threads)
+            raise
+        finally:
+            self.stats.lines_coalesced = self.presenter.lines_coalesced
+        if self._errors:
+            self._shut_down(threads)
+            raise self._errors[0]
+        for thread in threads:
+            thread.join(JOIN_TIMEOUT_S)
+        return self.stats
+
+
+def run_pipeline(in_fo, oft:OffsetTableDb, **kwargs) -> PipelineStats:
+    return TracePipeline(in_fo, oft, **kwargs).run()
@@ -0,0 +1,278 @@
+""" Compact binary recordings of em100 trace operations.
+
+An em100 text log is about 3x bigger than the data it carries and has to be
+re-parsed for every look at it.  A recording stores the same
+SPIFlashOperations as
+
+    header      64 bytes: magic, version, op count, section offsets
+    data        every operation's data bytes, back to back
+    columns     one little-endian array per field, num_ops long each
+                (timestamp, command, command_idx, addr, len, data_offset, command_name_idx)
+    metadata    JSON: column offsets/dtypes, command names, where it came from
+
+so TraceRecording can np.memmap it and hand out the columns as arrays without
+reading (let alone parsing) anything, and get any operation by index.
+Operations without data lines have addr -1 (None in SPIFlashOperation).
+"""
+from __future__ import annotations
+
+from spana.parse_trace import SPIFlashOperation, parse_read_operations_fast
+from spana.lazy_import import lazy_import
+import array
+import io
+import json
+import os
+import struct
+import sys
+import typing
+
+np = lazy_import("numpy", globals())
+
+MAGIC = b"SPTRACE\0"
+VERSION = 1
+FILE_EXTENSION = ".sptrace"
+HEADER = struct.Struct("<8sIIQQQQQ")     # magic, version, header size, num ops, data start, data len, metadata start, metadata len
+HEADER_SIZE = 64
+NO_ADDR = -1
+
+# name, array.array typecode (for the writer), numpy dtype (for the reader)
+COLUMNS = (
+    ("timestamp", "d", "<f8"),
+    ("command", "B", "u1"),
+    ("command_idx", "q", "<i8"),
+    ("addr", "q", "<i8"),
+    ("len", "L", "<u4"),
+    ("data_offset", "Q", "<u8"),
+    ("command_name_idx", "H", "<u2"),
+)
+
+
+class TraceRecordingWriter:
+    """ Streams operations into a recording: data is written as it comes, the columns (kept in
+    compact arrays) when closed.  Use as a context manager so an interrupted capture still gets closed. """
+
+    def __init__(self, filename:typing.Union[str, typing.BinaryIO], source:typing.Optional[str]=None):
+        """ filename can also be a seekable binary file object, which is left open """
+        self.filename = filename
+        self.source = source
+        self._owns_fo = isinstance(filename, str)
+        self._fo = open(filename, "wb") if self._owns_fo else filename
+        self._fo.write(bytes(HEADER_SIZE))      # filled in by close()
+        self._data_len = 0
+        self._columns = { name: array.array(typecode if typecode != "L" else "I") for (name, typecode, _) in COLUMNS }
+        self._command_names = {}
+
+    def __len__(self) -> int:
+        return len(self._columns["timestamp"])
+
+    def write(self, op:SPIFlashOperation):
+        c = self._columns
+        c["timestamp"].append(op.timestamp)
+        c["command"].append(op.command)
+        c["command_idx"].append(op.command_idx)
+        c["addr"].append(NO_ADDR if op.addr is None else op.addr)
+        c["len"].append(len(op.data))
+        c["data_offset"].append(self._data_len)
+        c["command_name_idx"].append(self._command_names.setdefault(op.command_str, len(self._command_names)))
+        self._fo.write(op.data)
+        self._data_len += len(op.data)
+
+    def write_all(self, ops:typing.Iterable[SPIFlashOperation]) -> int:
+        for op in ops:
+            self.write(op)
+        return len(self)
+
+    def close(self):
+        if self._fo is None:
+            return
+        fo = self._fo
+        fo.write(bytes(-fo.tell() % 8))
+
+        column_meta = []
+        for (name, _, dtype) in COLUMNS:
+            column = self._columns[name]
+            if sys.byteorder != "little":
+                column.byteswap()
+            column_meta.append(dict(name=name, dtype=dtype, offset=fo.tell()))
+            fo.write(column.tobytes())
+            fo.write(bytes(-fo.tell() % 8))
+
+        metadata = json.dumps(dict(
+            columns=column_meta,
+            command_names=list(self._command_names),
+            source=self.source,
+        )).encode()
+        metadata_start = fo.tell()
+        fo.write(metadata)
+
+        fo.seek(0)
+        fo.write(HEADER.pack(MAGIC, VERSION, HEADER_SIZE, len(self), HEADER_SIZE, self._data_len, metadata_start, len(metadata)))
+        if self._owns_fo:
+            fo.close()
+        self._fo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TraceRecording:
+    """ A recording, memory-mapped.  The columns are numpy arrays (e.g. rec.timestamp, rec.addr),
+    rec[i] is the i-th SPIFlashOperation, and iterating gives them all in order. """
+
+    def __init__(self, filename:str):
+        if not self.is_recording(filename):
+            raise ValueError(f"{filename} is not a trace recording")
+        self._load(filename, np.memmap(filename, dtype=np.uint8, mode="r"))
+
+    @classmethod
+    def from_operations(cls, ops:typing.Iterable[SPIFlashOperation], source:typing.Optional[str]=None) -> "TraceRecording":
+        """ An in-memory recording of ops """
+        out_fo = io.BytesIO()
+        with TraceRecordingWriter(out_fo, source=source) as writer:
+            writer.write_all(ops)
+        recording = cls.__new__(cls)
+        recording._load(source, np.frombuffer(out_fo.getbuffer(), dtype=np.uint8))
+        return recording
+
+    def _load(self, filename:typing.Optional[str], buf:np.ndarray):
+        self.filename = filename
+        (_, version, _, num_ops, data_start, data_len, metadata_start, metadata_len) = HEADER.unpack_from(buf[:HEADER.size].tobytes())
+        if version != VERSION:
+            raise ValueError(f"{filename} is a version {version} trace recording, can only read version {VERSION}")
+
+        self._mm = buf
+        metadata = json.loads(self._mm[metadata_start:metadata_start+metadata_len].tobytes())
+        self.num_ops = num_ops
+        self.command_names = metadata["command_names"]
+        self.source = metadata["source"]
+        self.data = self._mm[data_start:data_start+data_len]
+
+        for column in metadata["columns"]:
+            dtype = np.dtype(column["dtype"])
+            start = column["offset"]
+            setattr(self, column["name"], self._mm[start:start + num_ops*dtype.itemsize].view(dtype))
+
+    @staticmethod
+    def is_recording(filename:str) -> bool:
+        with open(filename, "rb") as in_fo:
+            return in_fo.read(len(MAGIC)) == MAGIC
+
+    def __len__(self) -> int:
+        return self.num_ops
+
+    def op_data(self, idx:int) -> np.ndarray:
+        """ Operation idx's data, without copying """
+        start = int(self.data_offset[idx])
+        return self.data[start:start + int(self.len[idx])]
+
+    def __getitem__(self, idx:int) -> SPIFlashOperation:
+        if idx < 0:
+            idx += self.num_ops
+        if not 0 <= idx < self.num_ops:
+            raise IndexError(f"operation {idx} out of range for a recording of {self.num_ops}")
+        addr = int(self.addr[idx])
+        return SPIFlashOperation(
+            command=int(self.command[idx]),
+            command_str=self.command_names[self.command_name_idx[idx]],
+            timestamp=float(self.timestamp[idx]),
+            command_idx=int(self.command_idx[idx]),
+            addr=None if addr == NO_ADDR else addr,
+            len=int(self.len[idx]),
+            data=bytearray(self.op_data(idx)),
+        )
+
+    def __iter__(self) -> typing.Generator[SPIFlashOperation, None, None]:
+        return self.iter_range(0, self.num_ops)
+
+    def iter_range(self, start:int, stop:int, chunk_len:int=65536) -> typing.Generator[SPIFlashOperation, None, None]:
+        """ Operations [start, stop), converting the columns a chunk at a time """
+        for chunk_start in range(start, stop, chunk_len):
+            chunk = slice(chunk_start, min(chunk_start + chunk_len, stop))
+            data_start = int(self.data_offset[chunk.start])
+            data_stop = int(self.data_offset[chunk.stop-1]) + int(self.len[chunk.stop-1])
+            data = self.data[data_start:data_stop].tobytes()
+            for (command, name_idx, timestamp, command_idx, addr, length, data_offset) in zip(
+                    self.command[chunk].tolist(), self.command_name_idx[chunk].tolist(), self.timestamp[chunk].tolist(),
+                    self.command_idx[chunk].tolist(), self.addr[chunk].tolist(), self.len[chunk].tolist(),
+                    self.data_offset[chunk].tolist()):
+                offset = data_offset - data_start
+                yield SPIFlashOperation(
+                    command=command,
+                    command_str=self.command_names[name_idx],
+                    timestamp=timestamp,
+                    command_idx=command_idx,
+                    addr=None if addr == NO_ADDR else addr,
+                    len=length,
+                    data=bytearray(data[offset:offset+length]),
+                )
+
+    def time_range(self, start_time:float, end_time:float) -> typing.Tuple[int, int]:
+        """ (start, stop) indexes of the operations with start_time <= timestamp < end_time """
+        return (int(np.searchsorted(self.timestamp, start_time, side="left")),
+                int(np.searchsorted(self.timestamp, end_time, side="left")))
+
+    def summary(self) -> str:
+        duration = float(self.timestamp[-1] - self.timestamp[0]) if self.num_ops else 0.0
+        return (f"{self.num_ops} operations ({', '.join(self.command_names)}), {len(self.data)} data bytes, "
+                f"{duration:.3f}s" + (f", from {self.source}" if self.source else ""))
+
+    def close(self):
+        if isinstance(self._mm, np.memmap):
+            self._mm._mmap.close()
+
+
+def convert_log(log_filename:str, recording_filename:str) -> int:
+    """ Parses an em100 text log into a recording; returns the number of operations """
+    with open(log_filename) as in_fo, TraceRecordingWriter(recording_filename, source=os.path.basename(log_filename)) as writer:
+        return writer.write_all(parse_read_operations_fast(in_fo))
+
+
+def load_trace(filename:str) -> TraceRecording:
+    """ A recording, or an em100 text log parsed into an in-memory recording """
+    if TraceRecording.is_recording(filename):
+        return TraceRecording(filename)
+    with open(filename) as in_fo:
+        return TraceRecording.from_operations(parse_read_operations_fast(in_fo), source=os.path.basename(filename))
+
+
+def read_operations(filename:str) -> typing.Iterable[SPIFlashOperation]:
+    """ The operations in either a recording or an em100 text log """
+    if TraceRecording.is_recording(filename):
+        yield from TraceRecording(filename)
+    else:
+        with open(filename) as in_fo:
+            yield from parse_read_operations_fast(in_fo)
+
+
+DESCRIPTION = "Convert an em100 trace log into a binary trace recording (or summarize a recording)"
+
+def add_arguments(parser):
+    parser.add_argument("input_filename", type=str, help="em100 text log to convert, or a recording to summarize")
+    parser.add_argument("-o", "--output-filename", type=str, default=None, help=f"Recording to write (default: the log's name with {FILE_EXTENSION})")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("trace_recording", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    if TraceRecording.is_recording(args.input_filename):
+        print(f"{args.input_filename}: {TraceRecording(args.input_filename).summary()}")
+        return
+
+    output_filename = args.output_filename or os.path.splitext(args.input_filename)[0] + FILE_EXTENSION
+    num_ops = convert_log(args.input_filename, output_filename)
+    print(f"Wrote {num_ops} operations to {output_filename} "
+          f"({os.path.getsize(output_filename)} bytes, from {os.path.getsize(args.input_filename)} bytes of log)")
+
+if __name__ == "__main__":
+    main()
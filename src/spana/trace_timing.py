@@ -0,0 +1,274 @@
+""" The toy's SPI access pattern, from trace timestamps.
+
+em100 timestamps when each command starts, so everything here is built from
+the times between reads:
+
+  gaps          between consecutive reads, and between reads within a play
+                (trace_analytics' grouping of contiguous reads of one entry)
+  bursts        runs of reads less than burst_gap_s apart
+  lookup latency    from an entry's offset table read to its first speech read
+  throughput    bytes per second while speaking: each in-play read's length over the
+                time until the next read, per play, per entry and per rate_divider
+                (compared with the rate the decoder consumes 12-byte frames at)
+  min timing    during a play the toy issues the next read a gap after the last one;
+                a flash that took longer than that to deliver a read would hold up
+                playback, so the shortest in-play gaps bound the timing it tolerates
+
+analyze_timing() returns summaries plus histogram arrays for all of them.
+"""
+from __future__ import annotations
+
+from spana.encoder import FRAME_SIZE_BYTES, SAMPLES_PER_FRAME
+from spana.offset_table import OffsetTableDb, is_offset_table_lookup
+from spana.trace_analytics import analyze_trace, TraceAnalysis
+from spana.trace_recording import TraceRecording, load_trace
+from spana.flash_image import FlashImage
+from spana.frame_index import FrameIndex
+from spana.lazy_import import lazy_import
+import dataclasses
+import typing
+
+np = lazy_import("numpy", globals())
+
+DEFAULT_BURST_GAP_S = 1e-3
+READ_OVERHEAD_BYTES = 4         # command + 24-bit address
+HISTOGRAM_BINS = 50
+
+
+@dataclasses.dataclass
+class Distribution:
+    count: int
+    min: float
+    p1: float
+    median: float
+    p99: float
+    max: float
+    mean: float
+    hist_counts: np.ndarray
+    hist_edges: np.ndarray
+    hist_underflow: int = 0         # values <= 0, which log-spaced bins can't hold (e.g. reads with the same timestamp)
+
+    @classmethod
+    def of(cls, values, log_bins:bool=True, bins:int=HISTOGRAM_BINS) -> "Distribution":
+        """ Summary and histogram of values (log-spaced bins over the positive values, if log_bins)
+
+        hist_counts.sum() + hist_underflow == count.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return cls(0, *[np.nan]*6, np.zeros(0, dtype=np.int64), np.zeros(0))
+        underflow = 0
+        if log_bins and (values > 0).any():
+            positive = values[values > 0]
+            underflow = len(values) - len(positive)
+            lo, hi = positive.min(), positive.max()
+            edges = np.geomspace(lo, hi if hi > lo else lo*1.01, bins + 1)
+            counts, edges = np.histogram(positive, edges)
+        else:
+            counts, edges = np.histogram(values, bins)
+        (p1, median, p99) = np.percentile(values, [1, 50, 99])
+        return cls(len(values), float(values.min()), float(p1), float(median), float(p99), float(values.max()),
+                   float(values.mean()), counts, edges, underflow)
+
+    def format(self, scale:float=1.0, unit:str="") -> str:
+        if not self.count:
+            return "(none)"
+        return (f"n={self.count:<8d} min {self.min*scale:10.3f}  p1 {self.p1*scale:10.3f}  median {self.median*scale:10.3f}  "
+                f"p99 {self.p99*scale:10.3f}  max {self.max*scale:10.3f} {unit}"
+                + (f"  ({self.hist_underflow} <= 0)" if self.hist_underflow else ""))
+
+
+@dataclasses.dataclass
+class RateStats:
+    rate_divider: int
+    sample_rate_Hz: float
+    plays: int
+    median_read_bytes: float
+    throughput: Distribution        # bytes/s per play
+    expected_bytes_per_s: float     # what the decoder consumes at this rate
+
+    @property
+    def ratio(self) -> float:
+        return self.throughput.median / self.expected_bytes_per_s
+
+
+@dataclasses.dataclass
+class TimingReport:
+    duration_s: float
+    num_reads: int
+    bytes_read: int
+    read_gaps: Distribution
+    in_play_gaps: Distribution
+    lookup_latency: Distribution
+    burst_gap_s: float
+    burst_bytes: Distribution
+    burst_reads: Distribution
+    play_throughput: np.ndarray         # bytes/s per play (nan for single-read plays)
+    entry_throughput: np.ndarray        # bytes/s per entry over all its plays (nan if never played)
+    per_rate: typing.Dict[int, RateStats]
+    peak_bytes_per_s: float             # busiest 1s window
+    min_in_play_gap_s: float
+    required_bytes_per_s: float         # fastest in-play read delivery rate: read bytes (with overhead) / gap after it
+    analysis: TraceAnalysis
+
+    @property
+    def required_spi_clock_Hz(self) -> float:
+        return 8 * self.required_bytes_per_s
+
+    def histograms(self) -> typing.Dict[str, np.ndarray]:
+        """ name_counts/name_edges arrays (and name_underflow, the values <= 0 left out of them) for every distribution, e.g. for np.savez """
+        out = {}
+        for name in ("read_gaps", "in_play_gaps", "lookup_latency", "burst_bytes", "burst_reads"):
+            dist = getattr(self, name)
+            out[f"{name}_counts"] = dist.hist_counts
+            out[f"{name}_edges"] = dist.hist_edges
+            out[f"{name}_underflow"] = np.int64(dist.hist_underflow)
+        out["play_throughput"] = self.play_throughput
+        out["entry_throughput"] = self.entry_throughput
+        return out
+
+    def format(self) -> str:
+        lines = [
+            f"{self.num_reads} reads, {self.bytes_read} bytes over {self.duration_s:.3f}s "
+            f"({self.bytes_read / self.duration_s if self.duration_s else 0:,.0f} bytes/s mean, {self.peak_bytes_per_s:,.0f} bytes/s in the busiest second)",
+            "",
+            f"gap between reads (ms)      {self.read_gaps.format(1e3)}",
+            f"gap within a play (ms)      {self.in_play_gaps.format(1e3)}",
+            f"lookup -> first read (ms)   {self.lookup_latency.format(1e3)}",
+            f"burst size (bytes)          {self.burst_bytes.format()}",
+            f"burst size (reads)          {self.burst_reads.format()}",
+            f"  (bursts: reads less than {self.burst_gap_s*1e3:g} ms apart)",
+            "",
+            f"{'rate_divider':>12s} {'rate (Hz)':>10s} {'plays':>6s} {'read len':>9s} {'bytes/s':>10s} {'decoder B/s':>12s} {'ratio':>6s}",
+        ]
+        for rs in self.per_rate.values():
+            lines.append(f"{rs.rate_divider:12d} {rs.sample_rate_Hz:10.0f} {rs.plays:6d} {rs.median_read_bytes:9.0f} "
+                         f"{rs.throughput.median:10,.0f} {rs.expected_bytes_per_s:12,.0f} {rs.ratio:6.2f}")
+        lines += [
+            "",
+            f"shortest gap within a play: {self.min_in_play_gap_s*1e6:.1f} us; the toy needs reads delivered at "
+            f">= {self.required_bytes_per_s:,.0f} bytes/s (SPI clock >= {self.required_spi_clock_Hz/1e6:.3f} MHz) to keep up",
+        ]
+        return "\n".join(lines)
+
+
+def bytes_per_second(rate_divider:int) -> float:
+    """ How fast the decoder consumes speech data at a rate_divider """
+    return FRAME_SIZE_BYTES * 2e6 / rate_divider / SAMPLES_PER_FRAME
+
+
+def analyze_timing(trace:TraceRecording, otd:OffsetTableDb, burst_gap_s:float=DEFAULT_BURST_GAP_S,
+                   analysis:typing.Optional[TraceAnalysis]=None) -> TimingReport:
+    if analysis is None:
+        analysis = analyze_trace(trace, otd)
+    plays = analysis.plays
+    t = trace.timestamp[analysis.read_pos]
+    length = trace.len[analysis.read_pos].astype(np.int64)
+    play = analysis.read_play
+
+    gaps = np.diff(t)
+    # pairs of consecutive reads in the same play: the first one's bytes lasted the gap
+    same_play = (play[1:] == play[:-1]) & (play[1:] >= 0)
+    pair_play = play[1:][same_play]
+    pair_gap = gaps[same_play]
+    pair_len = length[:-1][same_play]
+
+    num_plays = len(plays)
+    paced_bytes = np.bincount(pair_play, weights=pair_len, minlength=num_plays)
+    paced_time = np.bincount(pair_play, weights=pair_gap, minlength=num_plays)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        play_throughput = np.where(paced_time > 0, paced_bytes / paced_time, np.nan)
+
+    num_entries = len(analysis.entries.play_count)
+    entry_bytes = np.bincount(plays.entry_idx, weights=paced_bytes, minlength=num_entries)
+    entry_time = np.bincount(plays.entry_idx, weights=paced_time, minlength=num_entries)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entry_throughput = np.where(entry_time > 0, entry_bytes / entry_time, np.nan)
+
+    # lookups: a lookup read immediately followed by the first read of a play
+    is_lookup = is_offset_table_lookup(trace.addr[analysis.read_pos])
+    first_reads = np.flatnonzero((play[1:] >= 0) & is_lookup[:-1]) + 1
+    lookup_latency = t[first_reads] - t[first_reads - 1]
+
+    burst_starts = np.flatnonzero(np.r_[True, gaps >= burst_gap_s])
+    burst_bytes = np.add.reduceat(length, burst_starts) if len(t) else np.zeros(0)
+    burst_reads = np.diff(np.r_[burst_starts, len(t)])
+
+    rate_dividers = np.array([ otd[idx].rate_divider for idx in plays.entry_idx.tolist() ], dtype=np.int64)
+    per_rate = {}
+    for rate_divider in np.unique(rate_dividers).tolist():
+        mask = rate_dividers == rate_divider
+        in_rate = np.isin(pair_play, np.flatnonzero(mask))
+        per_rate[rate_divider] = RateStats(
+            rate_divider=rate_divider,
+            sample_rate_Hz=2e6 / rate_divider,
+            plays=int(mask.sum()),
+            median_read_bytes=float(np.median(pair_len[in_rate])) if in_rate.any() else np.nan,
+            throughput=Distribution.of(play_throughput[mask][~np.isnan(play_throughput[mask])]),
+            expected_bytes_per_s=bytes_per_second(rate_divider),
+        )
+
+    duration = float(t[-1] - t[0]) if len(t) else 0.0
+    if len(t):
+        window_counts, _ = np.histogram(t, bins=max(1, int(np.ceil(duration))), range=(t[0], t[0] + max(1.0, np.ceil(duration))), weights=length)
+        peak = float(window_counts.max())
+    else:
+        peak = 0.0
+
+    # (reads with the same timestamp say nothing about the flash's speed)
+    timed = pair_gap > 0
+    required = float(((pair_len[timed] + READ_OVERHEAD_BYTES) / pair_gap[timed]).max()) if timed.any() else 0.0
+
+    return TimingReport(
+        duration_s=duration,
+        num_reads=len(t),
+        bytes_read=int(length.sum()),
+        read_gaps=Distribution.of(gaps),
+        in_play_gaps=Distribution.of(pair_gap),
+        lookup_latency=Distribution.of(lookup_latency),
+        burst_gap_s=burst_gap_s,
+        burst_bytes=Distribution.of(burst_bytes),
+        burst_reads=Distribution.of(burst_reads),
+        play_throughput=play_throughput,
+        entry_throughput=entry_throughput,
+        per_rate=per_rate,
+        peak_bytes_per_s=peak,
+        min_in_play_gap_s=float(pair_gap.min()) if len(pair_gap) else np.nan,
+        required_bytes_per_s=required,
+        analysis=analysis,
+    )
+
+
+DESCRIPTION = "Analyze the timing of the reads in a trace: gaps, bursts, throughput per rate and the flash speed the toy needs"
+
+def add_arguments(parser):
+    parser.add_argument("trace_filename", type=str, help="em100 text log or trace recording")
+    parser.add_argument("-B", "--base-image", default=None, type=str, help="Flash image the trace was taken with (default is original)")
+    parser.add_argument("--burst-gap-ms", type=float, default=DEFAULT_BURST_GAP_S*1e3, help="Reads closer together than this are one burst (default: %(default)s)")
+    parser.add_argument("--histograms", type=str, default=None, help="Save the histogram arrays to this .npz file")
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser("trace_timing", description=DESCRIPTION)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args()
+
+    image = FlashImage.from_file(args.base_image) if args.base_image is not None else FlashImage.get_default()
+    otd = OffsetTableDb.from_flash_image(image)
+    trace = load_trace(args.trace_filename)
+    analysis = analyze_trace(trace, otd, entry_ends=FrameIndex.load_or_build(image, otd).entry_ends())
+    report = analyze_timing(trace, otd, burst_gap_s=args.burst_gap_ms/1e3, analysis=analysis)
+    print(report.format())
+
+    if args.histograms:
+        np.savez(args.histograms, **report.histograms())
+        print(f"Wrote {args.histograms}")
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ class TempFileMgr:
         self._to_remove = []
 
     def get_tempfile(self, byts:bytes):
-        with tempfile.NamedTemporaryFile(delete=False, delete_on_close=False) as tf:
+        with tempfile.NamedTemporaryFile(delete=False) as tf:
             tf.write(byts)
             filename = tf.name
             print(f"generated tempfile {filename=}")
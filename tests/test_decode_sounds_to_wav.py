@@ -0,0 +1,26 @@
+from spana.decode_sounds_to_wav import add_arguments, decoder_main
+from spana.offset_table import PRESUMED_OFFSET_TABLE_LENGTH
+from spana.synthetic import synthetic_image
+from scipy.io.wavfile import read as wav_read
+import numpy as np
+import argparse
+import os
+
+
+def test_parallel_decode_matches_serial(tmp_path):
+    image, otd = synthetic_image(num_entries=PRESUMED_OFFSET_TABLE_LENGTH, samples_per_entry=23*10)
+    image_filename = str(tmp_path / "image.bin")
+    image.save(image_filename)
+
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    for jobs in (1, 3):
+        decoder_main(parser.parse_args(["-j", str(jobs), "-o", str(tmp_path / f"j{jobs}"), "--cache-dir", str(tmp_path / "cache"), image_filename]))
+
+    serial = sorted(os.listdir(tmp_path / "j1"))
+    assert len(serial) == len(otd)
+    assert sorted(os.listdir(tmp_path / "j3")) == serial
+    for filename in serial:
+        (rate_1, pcm_1), (rate_3, pcm_3) = (wav_read(str(tmp_path / d / filename)) for d in ("j1", "j3"))
+        assert rate_1 == rate_3 and len(pcm_1) and np.array_equal(pcm_1, pcm_3)
+    assert os.listdir(tmp_path / "cache")
@@ -0,0 +1,37 @@
+from spana.encode_cache import EncodeCache
+from spana.compile_voice_pack import encode_single_file
+from scipy.io.wavfile import write as wav_write
+import numpy as np
+import os
+
+
+def test_encode_cache_lru(tmp_path):
+    cache = EncodeCache(str(tmp_path), max_bytes=2500)
+
+    keys = [ EncodeCache.make_key(bytes([i]), dict(normalize_peak=450)) for i in range(3) ]
+    assert len(set(keys)) == 3
+    assert EncodeCache.make_key(b"\x00", dict(normalize_peak=451)) != keys[0]
+
+    assert cache.get(keys[0]) is None
+    for (age, key) in enumerate(keys):
+        cache.put(key, bytes([age])*1000)
+        os.utime(cache._path(key), ns=(age*10**9, age*10**9))
+
+    assert cache.get(keys[0]) == bytes([0])*1000     # now the most recently used
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    assert cache.evict() == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_encode_single_file_cache(tmp_path):
+    wav_filename = str(tmp_path / "042_test.wav")
+    wav_write(wav_filename, 10000, (1000*np.sin(np.arange(2000)/7)).astype(np.int16))
+
+    cache = EncodeCache(str(tmp_path / "cache"))
+    encoded = encode_single_file(wav_filename, cache=cache)
+    assert encode_single_file(wav_filename, cache=cache) == encoded == encode_single_file(wav_filename)
+    assert (cache.hits, cache.misses) == (1, 1)
+
@@ -1,4 +1,9 @@
-from spana.encoder import nibble_to_signed, header_bits
+from spana.encoder import nibble_to_signed, header_bits, encode_samples, pad_up_to_multiple, Encoder, Decoder
+from spana.encoder import SeekableDecoder, FRAME_SIZE_BYTES
+from spana.offset_table import OffsetTableEntry
+from spana.synthetic import synthetic_image
+import io
+import numpy as np
 import pytest
 
 def test_header_bits():
@@ -23,4 +28,127 @@ def test_nts():
     assert nibble_to_signed(0) == 0
     assert nibble_to_signed(7) == 7
     assert nibble_to_signed(8) == -8
-    assert nibble_to_signed(15) == -1
\ No newline at end of file
+    assert nibble_to_signed(15) == -1
+
+def _reference_encode(s, fixed_g=None):
+    """ The original one-gain-at-a-time search, built on encode_frame_at_gain """
+    s = pad_up_to_multiple(s, 23)
+    last_sample = 0
+    out = b""
+    for idx in range(0, len(s), 23):
+        frame = s[idx:idx+23]
+        gs = range(0, 6+1) if fixed_g is None else [fixed_g]
+        best = None
+        for g in gs:
+            encoded_bytes, score, cur = Encoder.encode_frame_at_gain(frame, g, last_sample)[:3]
+            if (best is None) or (score < best[1]):
+                best = (encoded_bytes, score, cur)
+        out += best[0]
+        last_sample = best[2]
+    return out
+
+@pytest.mark.parametrize("fixed_g", [None, 0, 3, 7])
+@pytest.mark.parametrize("dtype", [int, float])
+def test_vectorized_encoder_matches_reference(fixed_g, dtype):
+    rnd = np.random.default_rng(1234)
+    t = np.arange(23*40)
+    s = (300*np.sin(2*np.pi*t/37) + rnd.normal(0, 40, size=len(t))).round().astype(dtype)
+    s[500:520] = 450  # a step the quantizer has to chase
+    if dtype is float:
+        s += 0.25
+
+    assert Encoder().encode_fully(s, fixed_g=fixed_g) == _reference_encode(s, fixed_g=fixed_g)
+
+def test_encode_frame_all_gains_dtypes():
+    s = (300*np.sin(np.arange(23)/3)).round().astype(int)
+    for frame in (s, s.astype(float)):
+        scores, vals, steps, error = Encoder.encode_frame_all_gains(frame, 10)
+        assert (scores.dtype, vals.dtype, steps.dtype, error.dtype) == (np.float64, np.int64, np.int64, np.float64)
+        _, (_, score, _, _, _, best_error, _) = Encoder().encode_frame(frame)
+        assert type(score) is float and best_error.dtype == np.float64
+
+def test_decode_array_matches_decode_fully():
+    rnd = np.random.default_rng(99)
+    s = (400*np.sin(2*np.pi*np.arange(23*30)/51)).round().astype(int)
+    terminator = bytes.fromhex('008800 008800 008800 008800 008801 000000')*2
+    blobs = [
+        b"",
+        bytes.fromhex("008800 008800 008800 008800") + Encoder().encode_fully(s) + terminator,
+        Encoder().encode_fully(s)[:-5],     # trailing partial frame, never stops
+    ]
+    for _ in range(200):
+        # random frames with a random mix of keep_going bits (and every g, including 7)
+        frames = rnd.integers(0, 256, size=[rnd.integers(1, 30), 12], dtype=np.uint8)
+        frames[:,0] &= 0b1111_1110
+        frames[:,0] |= (rnd.random(len(frames)) < 0.6)
+        blobs.append(frames.tobytes())
+
+    for blob in blobs:
+        expected = Decoder().decode_fully(io.BytesIO(blob))
+        got = Decoder().decode_array(blob)
+        assert got.dtype == np.int32
+        assert got.tolist() == expected
+
+def test_quant_table():
+    from spana.codec_tables import QUANT_TABLE, QUANT_DELTA_MIN, QUANT_DELTA_MAX
+    deltas = np.arange(QUANT_DELTA_MIN - 50, QUANT_DELTA_MAX + 50)
+    for g in range(0, 7+1):
+        expected = np.round(deltas / 2**g).astype(int).clip(-8, +7)
+        got = QUANT_TABLE[g, deltas.clip(QUANT_DELTA_MIN, QUANT_DELTA_MAX) - QUANT_DELTA_MIN]
+        assert (got == expected).all()
+
+
+@pytest.mark.parametrize("dtype", [int, float])
+def test_encode_stream_matches_encode_fully(dtype):
+    rnd = np.random.default_rng(1)
+    s = (400*np.sin(np.arange(23*40 + 5)/6) + rnd.normal(0, 20, 23*40 + 5)).round().astype(dtype)
+
+    expected = Encoder().encode_fully(s)
+    for chunk_sizes in ([1], [22, 1], [23], [50, 3], [7, 0, 100]):
+        cuts = np.cumsum(np.resize(chunk_sizes, len(s)))
+        chunks = np.split(s, cuts[cuts < len(s)])
+        assert b"".join(Encoder().encode_stream(iter(chunks))) == expected
+
+
+def test_encode_stream_memory():
+    import tracemalloc
+
+    def chunks(num_chunks):
+        for chunk_idx in range(num_chunks):
+            yield (300*np.sin(np.arange(chunk_idx*1000, (chunk_idx+1)*1000)/5)).round().astype(int)
+
+    tracemalloc.start()
+    num_bytes = 0
+    for byts in Encoder().encode_stream(chunks(20)):
+        num_bytes += len(byts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert num_bytes == 12 * -(-20000 // 23)
+    assert peak < 200_000     # well under what 20000 boxed samples of input would take
+
+
+def test_seekable_decoder():
+    image, otd = synthetic_image(num_entries=8, samples_per_entry=23*30)
+    # plus an entry of random frames: every header, including g == 7
+    noise = np.random.default_rng(0).integers(0, 256, size=12*200, dtype=np.uint8)
+    noise[::12] |= 1
+    image[0x80000:0x80000+len(noise)] = noise.tobytes()
+    entries = list(otd) + [ OffsetTableEntry(idx=8, rate_divider=200, sound_data_start_addr=0x80000, sound_data_end_addr=0x80000+len(noise), speech=None) ]
+
+    sd = SeekableDecoder(image)
+    assert sd.precompute(entries) == len(entries)
+    dec = Decoder()
+    rnd = np.random.default_rng(1)
+    for ote in entries:
+        full = dec.decode_entry(image, ote)
+        checkpoints = sd.checkpoints(ote)
+        assert checkpoints.num_samples == len(full)
+        for _ in range(20):
+            first = int(rnd.integers(0, checkpoints.stop_frame))
+            n = int(rnd.integers(0, 40))
+            expected = full[checkpoints.sample_offsets[first]:checkpoints.sample_offsets[min(first+n, checkpoints.stop_frame)]]
+            assert np.array_equal(sd.decode_range(ote, first, n), expected)
+        assert np.array_equal(sd.decode_range(ote, 0, 10**6), full)
+        assert len(sd.decode_range(ote, checkpoints.stop_frame, 5)) == 0
+        assert sd.frame_at(ote, ote.sound_data_start_addr + 5*FRAME_SIZE_BYTES + 3) == 5
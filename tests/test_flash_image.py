@@ -0,0 +1,59 @@
+from spana.flash_image import FlashImage
+from spana.offset_table import OffsetTableDb
+from spana.encoder import Decoder, Encoder
+import numpy as np
+import pytest
+
+def make_image_file(tmp_path):
+    otd = OffsetTableDb.get_blank(num_offset_table_entries=4)
+    blob = Encoder().encode_fully((300*np.sin(np.arange(23*10)/5)).round().astype(int)) + bytes(36)
+    for idx, ote in enumerate(otd):
+        ote.sound_data_start_addr = 0x470 + idx*len(blob)
+        ote.sound_data_end_addr = ote.sound_data_start_addr + len(blob)
+
+    image = bytearray(2**16)
+    image[:len(otd.generate_bytes_for_image())] = otd.generate_bytes_for_image()
+    for ote in otd:
+        image[ote.sound_data_start_addr:ote.sound_data_end_addr] = blob
+
+    filename = tmp_path / "image.bin"
+    filename.write_bytes(image)
+    return filename, otd, blob
+
+def test_mapped_image_is_copy_on_write(tmp_path):
+    filename, otd, blob = make_image_file(tmp_path)
+    original = filename.read_bytes()
+
+    image = FlashImage.from_file(filename)
+    view = image.entry_view(otd[1])
+    assert bytes(view) == blob
+
+    # patches land in place, are visible through existing views, and never reach the file
+    image.patch(otd[1].sound_data_start_addr, bytes(12))
+    assert bytes(view[:12]) == bytes(12)
+    assert filename.read_bytes() == original
+
+def test_graft_onto_flash_image_is_in_place(tmp_path):
+    filename, otd, blob = make_image_file(tmp_path)
+    image = FlashImage.from_file(filename, use_mmap=False)
+
+    otd[0].rate_divider = 0x6b
+    expected = otd.graft_onto_image(filename.read_bytes())
+
+    assert otd.graft_onto_image(image) is image
+    assert image.tobytes() == expected
+
+def test_patches_cannot_resize_the_image():
+    image = FlashImage.blank(64)
+    with pytest.raises(ValueError):
+        image[60:68] = bytes(8)
+    with pytest.raises(ValueError):
+        image[0:4] = bytes(8)
+    assert len(image) == 64
+
+def test_decode_entry(tmp_path):
+    filename, otd, blob = make_image_file(tmp_path)
+    image = FlashImage.from_file(filename)
+    expected = Decoder().decode_array(blob)
+    assert (Decoder().decode_entry(image, otd[2]) == expected).all()
+    assert (Decoder().decode_entry(filename.read_bytes(), otd[2]) == expected).all()
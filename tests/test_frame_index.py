@@ -0,0 +1,120 @@
+from spana.frame_index import FrameIndex, NO_FRAME
+from spana.encoder import Decoder, FrameCheckpoints, SeekableDecoder, find_stop_frame, FRAME_SIZE_BYTES
+from spana.offset_table import OffsetTableDb, OffsetTableEntry
+from spana.synthetic import synthetic_image
+from spana import codec_tables
+import numpy as np
+import os
+
+
+def kaitai_frames(keep_going) -> int:
+    """ The .ksy's repeat-until: frames up to the first non-keep_going one with _index > 1 """
+    for (idx, kg) in enumerate(keep_going):
+        if not kg and idx > 1:
+            return idx + 1
+    return NO_FRAME
+
+
+def image_with_odd_entries():
+    image, otd = synthetic_image(num_entries=8, samples_per_entry=23*30)
+    rnd = np.random.default_rng(0)
+    entries = list(otd)
+
+    # random frames (every header), presumed to end well past where they stop
+    noise = rnd.integers(0, 256, size=12*200, dtype=np.uint8)
+    image[0x80000:0x80000+len(noise)] = noise.tobytes()
+    entries.append(OffsetTableEntry(idx=8, rate_divider=200, sound_data_start_addr=0x80000, sound_data_end_addr=0x80000+len(noise), speech=None))
+
+    # keep_going frames running past the presumed end: the decoder reads on until the stop frames after it
+    kg_frames = rnd.integers(0, 256, size=12*50, dtype=np.uint8)
+    kg_frames[::12] = (kg_frames[::12] & 0xF0) | 0b0001
+    image[0x90000:0x90000+len(kg_frames)] = kg_frames.tobytes()
+    entries.append(OffsetTableEntry(idx=9, rate_divider=200, sound_data_start_addr=0x90000, sound_data_end_addr=0x90000+12*20, speech=None))
+
+    # sharing entry 3's start, with no end of its own
+    entries.append(OffsetTableEntry(idx=10, rate_divider=200, sound_data_start_addr=otd[3].sound_data_start_addr, sound_data_end_addr=None, speech=None))
+    entries.append(None)
+    return image, OffsetTableDb(entries)
+
+
+def test_frame_index_matches_decoder():
+    image, otd = image_with_odd_entries()
+    index = FrameIndex.build(image, otd)
+    assert len(index) == len(otd)
+    assert index.starts[11] == -1 and index.true_ends[11] == -1
+
+    dec = Decoder()
+    for ote in otd:
+        if ote is None:
+            continue
+        true_end = int(index.true_ends[ote.idx])
+        data = np.frombuffer(image.view(ote.sound_data_start_addr, true_end), dtype=np.uint8).reshape([-1, FRAME_SIZE_BYTES])
+        keep_going = codec_tables.A_HEADER_TO_KEEP_GOING[data[:,0] & 0b1111]
+        assert index.terminated[ote.idx]
+        assert find_stop_frame(keep_going) == index.stop_frames[ote.idx] == len(data) - 1
+        assert index.kaitai_frames[ote.idx] == kaitai_frames(keep_going)
+
+        s = index.frames(ote.idx)
+        assert np.array_equal(index.frame_addrs[s], ote.sound_data_start_addr + FRAME_SIZE_BYTES*np.arange(len(data)))
+        assert np.array_equal(index.keep_going[s], keep_going)
+        assert np.array_equal(index.gain[s], 1 << codec_tables.A_HEADER_TO_G[data[:,0] & 0b1111])
+
+        expected = FrameCheckpoints.from_bytes(image.view(ote.sound_data_start_addr, true_end))
+        checkpoints = index.checkpoints(ote.idx)
+        assert np.array_equal(checkpoints.start_values, expected.start_values)
+        assert np.array_equal(checkpoints.sample_offsets, expected.sample_offsets)
+        assert checkpoints.num_samples == len(dec.decode_array(image.view(ote.sound_data_start_addr, 2**20)))
+
+    # synthetic blobs end in their stop frame; the noise entry stops early; entry 9 runs past its presumed end
+    assert (index.slack_bytes[:8] == 0).all()
+    assert index.slack_bytes[8] > 0
+    assert index.true_ends[9] > otd[9].sound_data_end_addr and index.slack_bytes[9] < 0
+    assert index.true_ends[10] == index.true_ends[3]
+
+
+def test_frame_index_presumed_end_is_next_speech_data():
+    # a table that isn't in address order: from_flash_image's ends (the next entry's start) are wrong for entries 0 and 1
+    image, otd = synthetic_image(num_entries=3, samples_per_entry=23*30)
+    (a, b, c) = (ote.sound_data_start_addr for ote in otd)
+    entries = [ OffsetTableEntry(idx=0, rate_divider=200, sound_data_start_addr=a, sound_data_end_addr=c, speech=None),
+                OffsetTableEntry(idx=1, rate_divider=200, sound_data_start_addr=c, sound_data_end_addr=b, speech=None),
+                OffsetTableEntry(idx=2, rate_divider=200, sound_data_start_addr=b, sound_data_end_addr=None, speech=None) ]
+    index = FrameIndex.build(image, OffsetTableDb(entries))
+    assert index.presumed_ends.tolist() == [b, -1, c]
+    assert index.slack_bytes.tolist() == [0, 0, 0]
+    assert index.true_ends.tolist() == [b, otd[2].sound_data_end_addr, c]
+
+
+def test_frame_index_seekable_decoder():
+    image, otd = image_with_odd_entries()
+    index = FrameIndex.build(image, otd)
+    with_index, without = SeekableDecoder(image, frame_index=index), SeekableDecoder(image)
+    for ote in otd[:9]:
+        assert np.array_equal(with_index.decode_range(ote, 3, 10**6), without.decode_range(ote, 3, 10**6))
+    # past its presumed end, only the index knows where entry 9 really goes
+    assert with_index.checkpoints(otd[9]).stop_frame == index.stop_frames[9] > without.checkpoints(otd[9]).stop_frame
+
+
+def test_frame_index_cache(tmp_path):
+    image, otd = image_with_odd_entries()
+    cache_dir = str(tmp_path)
+    built = FrameIndex.load_or_build(image, otd, cache_dir=cache_dir)
+    assert not built.from_cache
+    assert os.listdir(cache_dir) == [f"{built.image_sha256}.npz"]
+
+    cached = FrameIndex.load_or_build(image, otd, cache_dir=cache_dir)
+    assert cached.from_cache
+    for name in FrameIndex.SAVED_ARRAYS:
+        assert np.array_equal(getattr(cached, name), getattr(built, name)), name
+
+    # different entry bounds for the same image: rebuilt (and re-cached)
+    otd[9].sound_data_end_addr += 12
+    assert not FrameIndex.load_or_build(image, otd, cache_dir=cache_dir).from_cache
+    assert FrameIndex.load_or_build(image, otd, cache_dir=cache_dir).from_cache
+
+    # a different image misses; a damaged cache file is rebuilt
+    image.patch(0x90000, b"\x00"*12)
+    assert not FrameIndex.load_or_build(image, otd, cache_dir=cache_dir).from_cache
+    with open(os.path.join(cache_dir, f"{built.image_sha256}.npz"), "wb") as out_fo:
+        out_fo.write(b"not an npz")
+    assert FrameIndex.load(os.path.join(cache_dir, f"{built.image_sha256}.npz")) is None
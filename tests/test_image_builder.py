@@ -0,0 +1,95 @@
+from spana.image_builder import ImageBuilder, FlashCapacityExceededError, SOUND_SECTION_START_OFFSET
+from spana.flash_image import FlashImage
+from spana.offset_table import OffsetTableDb
+import pytest
+
+
+def test_image_builder():
+    builder = ImageBuilder(flash_size=0x2000)
+    otd = OffsetTableDb.get_blank(num_offset_table_entries=4)
+
+    blobs = [ b"\x11"*100, b"\x22"*200, b"\x11"*100, b"\x33"*50 ]
+    for (ote, blob) in zip(otd, blobs):
+        ote.sound_data_start_addr = builder.add_blob(blob, entry_idx=ote.idx)
+
+    assert [ ote.sound_data_start_addr for ote in otd ] == [0x470, 0x470+100, 0x470, 0x470+300]
+    assert builder.used_bytes == 350
+    assert builder.bytes_saved_by_dedup == 100
+    assert builder.entry_blobs[2].entry_idxs == [0, 2]
+
+    image = builder.build(otd)
+    assert len(image) == 0x2000
+    assert image[0x470+100:0x470+300] == b"\x22"*200
+    assert image[0:len(otd.generate_bytes_for_image())] == otd.generate_bytes_for_image()
+
+    report = builder.usage_report()
+    assert "350 bytes in 3 blobs" in report
+
+
+def test_image_builder_capacity():
+    builder = ImageBuilder(flash_size=SOUND_SECTION_START_OFFSET + 1000)
+    builder.add_blob(b"\x01"*600)
+    with pytest.raises(FlashCapacityExceededError):
+        builder.add_blob(b"\x02"*600)
+    assert builder.add_blob(b"\x03"*400) == SOUND_SECTION_START_OFFSET + 600
+    assert builder.free_bytes == 0
+
+    with pytest.raises(FlashCapacityExceededError):
+        builder.write_at(SOUND_SECTION_START_OFFSET + 999, b"\x04\x04")
+
+    # the offset table has to fit below the sound data
+    with pytest.raises(FlashCapacityExceededError):
+        ImageBuilder(start_addr=0x100).build(OffsetTableDb.get_blank(num_offset_table_entries=223))
+
+
+def test_image_builder_over_image():
+    image = FlashImage(b"\x55"*0x600 + b"\xff"*0x200)
+    builder = ImageBuilder.over_image(image)
+    assert builder.add_blob(b"\x66"*0x10) == 0x600
+    assert builder.free_bytes == 0x1F0
+
+
+def kg_frame(n:int) -> bytes:
+    return bytes([0x01 | (n << 4)]) + bytes([n])*11     # keep_going, distinct per n
+
+def non_kg_frame(n:int) -> bytes:
+    return bytes([0x00]) + bytes([n])*11
+
+STOP = non_kg_frame(0xA0) + non_kg_frame(0xA1) + non_kg_frame(0xA2)
+
+
+def test_compact_blobs():
+    from spana.image_builder import compact_blobs
+    from spana.encoder import Decoder
+
+    blobs = [
+        non_kg_frame(1) + kg_frame(1) + kg_frame(2) + kg_frame(3) + STOP,
+        non_kg_frame(2) + kg_frame(4) + STOP,
+        kg_frame(2) + kg_frame(3) + STOP,       # contained in blob 0
+        kg_frame(5) + kg_frame(6),              # never stops: kept verbatim
+        non_kg_frame(3) + kg_frame(7) + STOP + b"\x55"*40,  # trailing bytes after the stop are dropped
+    ]
+    section = compact_blobs(blobs)
+
+    assert section.offsets[2] == section.offsets[0] + 24
+    assert section.decoded_sizes[4] == 12*5
+    # blob 1 and 4 start with a non-keep_going frame, so each shares another blob's stop frame
+    assert len(section.data) == (12*7 + 12*5 + 12*5 - 2*12) + 24
+
+    dec = Decoder()
+    for (blob, offset) in zip(blobs, section.offsets):
+        assert (dec.decode_array(blob) == dec.decode_array(section.data[offset:])).all()
+
+
+def test_add_blobs_compacted():
+    builder = ImageBuilder(flash_size=0x2000)
+    entry_blobs = {
+        0: non_kg_frame(1) + kg_frame(1) + kg_frame(2) + STOP,
+        1: non_kg_frame(2) + kg_frame(3) + STOP,
+        2: non_kg_frame(1) + kg_frame(1) + kg_frame(2) + STOP,
+    }
+    addrs = builder.add_blobs_compacted(entry_blobs)
+    assert addrs[0] == addrs[2]
+    assert builder.bytes_saved_by_dedup == 72
+    assert builder.bytes_saved_by_compaction == 12
+    assert builder.used_bytes == 72 + 60 - 12
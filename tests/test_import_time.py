@@ -0,0 +1,50 @@
+""" Cold-start budget for the `spana` command.
+
+Runs `python -X importtime -m spana <command> --help` in a fresh interpreter
+and checks that no heavy third-party module gets imported and that the total
+import time stays under budget.
+"""
+import os
+import subprocess
+import sys
+import pytest
+
+import spana
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(spana.__file__)))
+
+HEAVY_MODULES = ("numpy", "scipy", "pandas", "pydub")
+IMPORT_TIME_BUDGET_MS = 200     # numpy alone is ~100ms
+
+
+def import_times(args) -> dict:
+    """ module name -> self import time in microseconds """
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    proc = subprocess.run([sys.executable, "-X", "importtime", *args],
+        env=env, capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = times.get(name.strip(), 0) + int(self_us)
+    return times
+
+
+@pytest.mark.parametrize("command", ["", "compile", "decode", "extract", "split", "trace"])
+def test_cli_import_time(command):
+    args = ["-m", "spana"] + ([command] if command else []) + ["--help"]
+    times = import_times(args)
+
+    heavy = [ name for name in times if name.split(".")[0] in HEAVY_MODULES ]
+    assert not heavy, f"`spana {command} --help` imports {heavy}"
+
+    total_ms = sum(times.values()) / 1000
+    assert total_ms < IMPORT_TIME_BUDGET_MS, f"`spana {command} --help` spent {total_ms:.1f}ms importing"
+
+
+def test_library_import_is_light():
+    times = import_times(["-c", "import spana.encoder, spana.offset_table, spana.split_file"])
+    heavy = [ name for name in times if name.split(".")[0] in HEAVY_MODULES ]
+    assert not heavy
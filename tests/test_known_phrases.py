@@ -0,0 +1,41 @@
+from spana.known_phrases import KnownPhrases
+import os
+import pickle
+
+
+def test_known_phrases():
+    kp = KnownPhrases.get()
+    assert KnownPhrases.get() is kp
+    assert kp.columns == ("offset_table_idx", "speech", "Unnamed: 2", "snoop")
+    assert kp.speech(42) == "Angel"
+    assert kp.speech(207) == "That is incorrect, the correct spelling of"
+    assert kp.column("snoop")[207] == "Naw dog, its like "
+    assert kp.column("snoop")[0] is None
+    assert kp.column("Unnamed: 2")[26] == "short, single pitch"
+    assert all(isinstance(idx, int) for idx in kp.idx_to_speech)
+
+
+def test_known_phrases_snapshot(tmp_path):
+    csv_path = tmp_path / "phrases.csv"
+    csv_path.write_text("offset_table_idx,speech,,snoop\n0,A,,yo\n1,\"B, b\",,\n")
+    cache_dir = str(tmp_path / "cache")
+
+    kp = KnownPhrases._load_via_snapshot(str(csv_path), cache_dir)
+    snapshot_filename = KnownPhrases.snapshot_filename(str(csv_path), cache_dir)
+    assert os.path.exists(snapshot_filename)
+    assert kp.idx_to_speech == {0: "A", 1: "B, b"}
+
+    # unchanged mtime/size: the snapshot is used without reading the CSV
+    with open(snapshot_filename, "rb") as in_fo:
+        snapshot = pickle.load(in_fo)
+    snapshot["phrases"].idx_to_speech[0] = "from snapshot"
+    with open(snapshot_filename, "wb") as out_fo:
+        pickle.dump(snapshot, out_fo)
+    assert KnownPhrases._load_via_snapshot(str(csv_path), cache_dir).speech(0) == "from snapshot"
+
+    # changed contents: reparsed
+    csv_path.write_text("offset_table_idx,speech,,snoop\n0,Z,,yo\n")
+    os.utime(csv_path, ns=(0, 12345))
+    kp = KnownPhrases._load_via_snapshot(str(csv_path), cache_dir)
+    assert kp.idx_to_speech == {0: "Z"}
+    assert kp.column("snoop") == {0: "yo"}
@@ -0,0 +1,112 @@
+from spana.synthetic import synthetic_image, synthetic_speech, write_em100_log, PREFIX, SEPARATOR
+from spana.encoder import Encoder, Decoder, StreamingDecoder
+from spana.parse_trace import parse_read_operations
+from spana.live_audio import LiveAudio, RawPcmSink, WavSink, PCM_SCALE
+from spana.trace_pipeline import run_pipeline
+import spana
+import io
+import os
+import random
+import subprocess
+import sys
+import wave
+import numpy as np
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(spana.__file__)))
+
+
+def test_streaming_decoder_matches_decode_array():
+    blob = PREFIX + Encoder().encode_fully(synthetic_speech(23*60)) + SEPARATOR*2 + bytes(range(256))
+    expected = Decoder().decode_array(blob)
+
+    rnd = random.Random(0)
+    for _ in range(20):
+        dec = StreamingDecoder()
+        pieces = []
+        pos = 0
+        while pos < len(blob):
+            n = rnd.randint(1, 40)
+            pieces.append(dec.feed(blob[pos:pos+n]))
+            pos += n
+        assert dec.done
+        assert np.array_equal(np.concatenate(pieces), expected)
+
+
+def write_log(tmp_path):
+    image, otd = synthetic_image(num_entries=10, samples_per_entry=23*50)
+    log_filename = str(tmp_path / "trace.log")
+    with open(log_filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=300_000, read_chunk_len=100)
+    return image, otd, log_filename
+
+
+def test_audio_matches_played_entries(tmp_path):
+    image, otd, log_filename = write_log(tmp_path)
+    with open(log_filename) as in_fo:
+        ops = list(parse_read_operations(in_fo))
+    looked_up = [ (op.addr - 0xb)//5 for op in ops if op.addr is not None and op.len == 5 ]
+
+    out_fo = io.BytesIO()
+    audio = LiveAudio(RawPcmSink(out_fo), max_silence_s=0)
+    for op in ops:
+        audio.write(op)
+    pcm = np.frombuffer(out_fo.getvalue(), dtype="<i2")
+
+    dec = Decoder()
+    expected = np.clip(np.concatenate([ dec.decode_entry(image, otd[idx]) for idx in looked_up[:-1] ]) * PCM_SCALE, -32768, 32767)
+    # the log ends partway through the last word
+    assert audio.stats.words == len(looked_up)
+    assert np.array_equal(pcm[:len(expected)], expected)
+    assert audio.stats.unmatched_reads == 0
+
+
+def test_live_audio_with_fake_em100(tmp_path):
+    _, otd, log_filename = write_log(tmp_path)
+    proc = subprocess.Popen([sys.executable, "-m", "spana.fake_em100", "--replay", log_filename, "--speed", "0"],
+        env=dict(os.environ, PYTHONPATH=SRC_DIR), stdout=subprocess.PIPE)
+    wav_filename = str(tmp_path / "live.wav")
+    audio = LiveAudio(WavSink(wav_filename), otd=otd, max_silence_s=0.1)
+    run_pipeline(proc.stdout, otd, out_fo=io.StringIO(), audio=audio)
+    audio.close()
+    assert proc.wait() == 0
+
+    with wave.open(wav_filename) as wav:
+        assert wav.getframerate() == 10000
+        assert wav.getnframes() == audio.stats.samples_written > 0
+    latencies = np.array(audio.stats.latencies_s)
+    assert len(latencies) > 0
+    assert (latencies >= 0).all() and latencies.max() < 5.0
+    assert "latency" in audio.stats.summary()
+
+
+def test_wav_sink_rolls_over(tmp_path):
+    sink = WavSink(str(tmp_path / "a.wav"))
+    sink.write(np.zeros(100, dtype=np.int16), 10000)
+    sink.write(np.ones(50, dtype=np.int16), 8000)
+    sink.close()
+    assert sink.filenames == [str(tmp_path / "a.wav"), str(tmp_path / "a_001.wav")]
+    with wave.open(sink.filenames[1]) as wav:
+        assert (wav.getframerate(), wav.getnframes()) == (8000, 50)
+
+
+def test_trace_audio_without_lookups(tmp_path, capsys):
+    from spana.cli import main as spana_main
+    from spana.trace_recording import TraceRecordingWriter
+
+    image, otd = synthetic_image(samples_per_entry=23*20)
+    image.save(str(tmp_path / "image.bin"))
+    log_filename = str(tmp_path / "trace.log")
+    with open(log_filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=100_000, read_chunk_len=100)
+    with open(log_filename) as in_fo:
+        ops = list(parse_read_operations(in_fo))
+    # as if the lookups weren't traced: words can only start at entry start addresses from the offset table
+    speech_ops = [ op for op in ops if not (op.addr is not None and op.len == 5) ]
+    with TraceRecordingWriter(str(tmp_path / "trace.sptrace")) as recorder:
+        recorder.write_all(speech_ops)
+
+    spana_main(["trace-audio", str(tmp_path / "trace.sptrace"), "-B", str(tmp_path / "image.bin"), "-o", str(tmp_path / "out.wav")])
+    summary = capsys.readouterr().err
+    starts = { ote.sound_data_start_addr for ote in otd }
+    assert f"{sum(op.addr in starts for op in speech_ops)} words" in summary
+    assert " 0 reads not part of a word" in summary
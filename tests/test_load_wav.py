@@ -0,0 +1,23 @@
+from spana.compile_voice_pack import load_wav_for_encoding, encode_wav_file
+from scipy.io.wavfile import write as wav_write
+import numpy as np
+
+
+def test_encode_any_rate_and_channels(tmp_path):
+    t = np.arange(48000) / 48000
+    tone = np.sin(2*np.pi*440*t)
+    stereo = np.stack([ (8000*tone).astype(np.int16), (4000*tone).astype(np.int16) ], axis=1)
+    wav_write(str(tmp_path / "stereo_48k.wav"), 48000, stereo)
+    wav_write(str(tmp_path / "u8_44k1.wav"), 44100, (127 + 100*np.sin(2*np.pi*440*np.arange(44100)/44100)).astype(np.uint8))
+
+    s, conversion = load_wav_for_encoding(str(tmp_path / "stereo_48k.wav"))
+    assert len(s) == 10000
+    assert conversion == "48000 Hz int16 x2 -> 10000 Hz"
+    assert 5500 < np.abs(s[100:-100]).max() < 6100      # channels averaged, tone well below the new Nyquist kept
+
+    s, conversion = load_wav_for_encoding(str(tmp_path / "u8_44k1.wav"))
+    assert len(s) == 10000
+    assert abs(s[100:-100].mean()) < 5                  # unsigned samples recentred
+
+    encoded, timing = encode_wav_file(str(tmp_path / "u8_44k1.wav"))
+    assert timing.encoded_len_bytes == len(encoded) == 12 * -(-10001 // 23)
@@ -1,4 +1,6 @@
 from spana.offset_table import OffsetTableDb
+import numpy as np
+import dataclasses
 from spana.file_paths import get_default_image_bytes
 import pytest
 
@@ -35,4 +37,101 @@ def test_offset_table():
     db[42].sound_data_start_addr = entry2.sound_data_start_addr
     mod_image_bytes = db.graft_onto_image(default_image_bytes)
     assert mod_image_bytes != default_image_bytes
-    
\ No newline at end of file
+    
+
+def make_db(starts_and_ends):
+    db = OffsetTableDb.get_blank(num_offset_table_entries=len(starts_and_ends))
+    for ote, (start, end) in zip(db, starts_and_ends):
+        ote.sound_data_start_addr = start
+        ote.sound_data_end_addr = end
+    return db
+
+def test_lookup_by_speech_data_address():
+    # out of order, one shared start, one stale end (0), one past the next start, last one open-ended
+    db = make_db([(0x2000, 0x2100), (0x1000, 0x1800), (0x1000, 0x1800), (0x3000, 0), (0x1800, 0x2800), (0x4000, None)])
+
+    expected = {
+        0x0fff: None, 0x1000: 1, 0x17ff: 1, 0x1800: 4, 0x1fff: 4, 0x2000: 0, 0x20ff: 0, 0x2100: None,
+        0x2fff: None, 0x3000: 3, 0x3fff: 3, 0x4000: 5, 0xfffff: 5,
+    }
+    for addr, entry_idx in expected.items():
+        entry = db.lookup_by_speech_data_address(addr)
+        assert (entry.idx if entry is not None else None) == entry_idx
+
+    idxs = db.lookup_idxs_by_speech_data_address(np.array(list(expected.keys())))
+    assert idxs.tolist() == [ (-1 if x is None else x) for x in expected.values() ]
+
+def test_address_index_follows_entry_changes():
+    db = make_db([(0x1000, 0x1100), (0x2000, 0x2100)])
+    assert db.lookup_by_speech_data_address(0x2050).idx == 1
+
+    db[1].sound_data_start_addr = 0x3000
+    db[1].sound_data_end_addr = 0x3100
+    assert db.lookup_by_speech_data_address(0x2050) is None
+    assert db.lookup_by_speech_data_address(0x3050).idx == 1
+
+    db[0] = dataclasses.replace(db[0], sound_data_start_addr=0x2000, sound_data_end_addr=0x2100)
+    assert db.lookup_by_speech_data_address(0x2050).idx == 0
+
+def test_indexes_only_dropped_by_own_entries():
+    db = make_db([(0x1000, 0x1100), (0x2000, 0x2100)])
+    other = make_db([(0x1000, 0x1100)])
+    address_index, speech_index = db.speech_address_index, db.speech_index
+
+    # other tables' entries, new entries, and fields an index isn't built from leave it alone
+    other[0].sound_data_start_addr = 0x5000
+    OffsetTableDb.get_blank(num_offset_table_entries=4)
+    db[0].rate_divider += 1
+    assert db.speech_address_index is address_index and db.speech_index is speech_index
+
+    db[0].sound_data_end_addr = 0x1080
+    assert db.speech_address_index is not address_index and db.speech_index is speech_index
+    db[1].speech = "Something else"
+    assert db.speech_index is not speech_index
+
+    # an entry in two tables keeps both up to date
+    both = OffsetTableDb([db[1]])
+    db[1].sound_data_start_addr = 0x3000
+    assert both.lookup_by_speech_data_address(0x3000) is db.lookup_by_speech_data_address(0x3000) is db[1]
+
+def test_pickle_and_copy():
+    import copy, pickle
+    db = make_db([(0x1000, 0x1100), (0x2000, 0x2100)])
+    db.speech_address_index, db.speech_index
+
+    for clone in (pickle.loads(pickle.dumps(db)), copy.deepcopy(db)):
+        assert [ dataclasses.asdict(e) for e in clone ] == [ dataclasses.asdict(e) for e in db ]
+        # the clone's entries belong to the clone only
+        clone[1].sound_data_start_addr = 0x3000
+        assert clone.lookup_by_speech_data_address(0x3000) is clone[1]
+        assert db.lookup_by_speech_data_address(0x3000) is None and db[1].sound_data_start_addr == 0x2000
+
+    for entry in (pickle.loads(pickle.dumps(db[0])), copy.copy(db[0]), copy.deepcopy(db[0])):
+        assert entry == db[0]
+        entry.sound_data_start_addr = 0x5000
+        assert db.lookup_by_speech_data_address(0x1000) is db[0]
+        assert db.lookup_by_speech_data_address(0x5000) is None
+
+def test_lookup_by_speech_matches_fnmatch():
+    import fnmatch
+    db = OffsetTableDb.get_blank(num_offset_table_entries=224)
+    db[10].speech = None
+
+    for pattern in ["Angel", "angel", "*Beep*", "Beep 2?7", "[AB]*", "*", "No such word", "E", "That is*, the*"]:
+        expected = [ e for e in db if e.speech is not None and fnmatch.fnmatch(e.speech, pattern) ]
+        assert db.lookup_by_speech(pattern) == expected
+        assert db.lookup_by_speech(pattern) == expected  # again, from the memo
+
+    assert db.lookup_by_speech("ANGEL", ignore_case=True) == [db.lookup_by_speech("Angel", single_match=True)]
+    assert len(db.lookup_by_speech("*BEEP*", ignore_case=True)) == len(db.lookup_by_speech("*Beep*"))
+
+    with pytest.raises(ValueError):
+        db.lookup_by_speech("*Beep*", single_match=True)
+    with pytest.raises(ValueError):
+        db.lookup_by_speech("No such word", single_match=True)
+
+    # the memo is dropped when the table changes
+    beep = db.lookup_by_speech("Beep 217", single_match=True)
+    beep.speech = "Boop 217"
+    assert db.lookup_by_speech("Beep 217") == []
+    assert db.lookup_by_speech("Boop*") == [beep]
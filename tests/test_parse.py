@@ -1,4 +1,7 @@
-from spana.parse_trace import CMD_RE, ADDRLINE_RE, parse_read_operations, READ_OP
+from spana.parse_trace import CMD_RE, ADDRLINE_RE, parse_read_operations, parse_read_operations_fast, READ_OP
+from spana.synthetic import synthetic_image, write_em100_log
+import io
+import random
 import re
 
 import os
@@ -31,3 +34,49 @@ def test3():
         else:
             print(ro)
     #print(read_ops)
+
+def parse_all(parse, text, **kwargs):
+    """ (operations, error) from parsing text """
+    ops = []
+    try:
+        for op in parse(io.StringIO(text), **kwargs):
+            ops.append(op)
+    except ValueError as e:
+        return ops, str(e)
+    return ops, None
+
+def test_parse_fast_matches():
+    image, otd = synthetic_image(num_entries=8, samples_per_entry=23*30)
+    log_fo = io.StringIO()
+    write_em100_log(log_fo, image, otd, 30_000, read_chunk_len=40, status_poll_every=3)
+    lines = log_fo.getvalue().split("\n")
+
+    ops, error = parse_all(parse_read_operations_fast, "\n".join(lines), block_size=1000)
+    assert error is None and ops == parse_all(parse_read_operations, "\n".join(lines))[0]
+    assert len(ops) > 100
+
+    # lines em100 wouldn't print go through the slow path, which must give the same ops (or error)
+    mutations = [
+        lambda line: "  " + line,
+        lambda line: line.replace(" : ", "  :  "),
+        lambda line: line[:20],
+        lambda line: "",
+        lambda line: "garbage " + line,
+        lambda line: "Time: nonsense",
+        lambda line: line.upper(),
+        lambda line: line.replace("0", "g", 1),
+        lambda line: line.replace("command", "command\t"),
+    ]
+    rnd = random.Random(0)
+    num_errors = 0
+    for _ in range(100):
+        mutated = lines[:rnd.randint(5, len(lines))]
+        for _ in range(rnd.randint(1, 4)):
+            idx = rnd.randrange(len(mutated))
+            mutated[idx] = rnd.choice(mutations)(mutated[idx])
+        text = "\n".join(mutated)
+
+        expected = parse_all(parse_read_operations, text)
+        assert parse_all(parse_read_operations_fast, text, block_size=rnd.choice([64, 1000, 1 << 20])) == expected
+        num_errors += expected[1] is not None
+    assert num_errors > 0
@@ -0,0 +1,41 @@
+from spana.synthetic import synthetic_image, write_em100_log, parse_size
+from spana.offset_table import OffsetTableDb
+from spana.parse_trace import parse_read_operations, READ_OP
+from spana.encoder import Decoder
+import io
+
+
+def test_synthetic_image_any_size():
+    # more entries than the real offset table, in a smaller flash
+    image, otd = synthetic_image(num_entries=300, flash_size=0x40000)
+    assert len(image) == 0x40000
+
+    parsed = OffsetTableDb.from_flash_image(image, offset_table_length=300)
+    assert [ ote.sound_data_start_addr for ote in parsed ] == [ ote.sound_data_start_addr for ote in otd ]
+    assert otd[-1].sound_data_end_addr <= 0x40000
+    assert otd[0].sound_data_start_addr >= 0xb + 5*300
+
+    dec = Decoder()
+    lengths = { len(dec.decode_entry(image, ote)) for ote in otd }
+    assert len(lengths) == 1 and lengths.pop() > 0
+
+
+def test_em100_log_parses():
+    image, otd = synthetic_image(num_entries=10, samples_per_entry=23*50)
+    log_fo = io.StringIO()
+    num_written = write_em100_log(log_fo, image, otd, target_bytes=200_000, status_poll_every=2)
+    assert num_written == len(log_fo.getvalue()) >= 200_000
+
+    log_fo.seek(0)
+    ops = list(parse_read_operations(log_fo))
+    reads = [ op for op in ops if op.command == READ_OP ]
+    assert len(reads) < len(ops)
+    assert [ op.command_idx for op in ops ] == list(range(1, len(ops)+1))
+    for op in reads:
+        assert bytes(op.data) == image[op.addr:op.addr+op.len]
+
+
+def test_parse_size():
+    assert parse_size("4096") == 4096
+    assert parse_size("0x100000") == parse_size("1M") == 2**20
+    assert parse_size("2G") == 2*2**30
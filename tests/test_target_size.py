@@ -0,0 +1,69 @@
+from spana.compile_voice_pack import EncodeResult, choose_rate_dividers, encode_task, measure_snr_db, encode_single_file, CANDIDATE_RATE_DIVIDERS
+from spana.encoder import Decoder, FRAME_SIZE_BYTES
+from spana.image_builder import FlashCapacityExceededError
+from scipy.io.wavfile import write as wav_write
+import numpy as np
+import pytest
+
+
+def candidate(filename, rate_divider, size, snr_db):
+    return EncodeResult(filename, rate_divider, bytes(size), None, snr_db)
+
+
+def test_choose_rate_dividers():
+    candidates = {
+        # cheap to downgrade: loses little SNR per byte saved
+        "a.wav": [ candidate("a.wav", 200, 1000, 30), candidate("a.wav", 250, 800, 29), candidate("a.wav", 400, 500, 25) ],
+        # expensive to downgrade
+        "b.wav": [ candidate("b.wav", 200, 1000, 30), candidate("b.wav", 250, 800, 15), candidate("b.wav", 400, 500, 5) ],
+    }
+
+    chosen = choose_rate_dividers(candidates, budget_bytes=2000, min_snr_db=10)
+    assert { f: r.rate_divider for (f, r) in chosen.items() } == { "a.wav": 200, "b.wav": 200 }
+
+    chosen = choose_rate_dividers(candidates, budget_bytes=1500, min_snr_db=10)
+    assert { f: r.rate_divider for (f, r) in chosen.items() } == { "a.wav": 400, "b.wav": 200 }
+
+    chosen = choose_rate_dividers(candidates, budget_bytes=1300, min_snr_db=10)
+    assert { f: r.rate_divider for (f, r) in chosen.items() } == { "a.wav": 400, "b.wav": 250 }
+
+    # overhead counts once per file
+    chosen = choose_rate_dividers(candidates, budget_bytes=1500, min_snr_db=10, overhead_bytes=100)
+    assert { f: r.rate_divider for (f, r) in chosen.items() } == { "a.wav": 400, "b.wav": 250 }
+
+    # b.wav at 5 dB would fit, but is below the floor
+    with pytest.raises(FlashCapacityExceededError):
+        choose_rate_dividers(candidates, budget_bytes=1000, min_snr_db=10)
+
+
+def test_snr_falls_with_sample_rate(tmp_path):
+    wav_filename = str(tmp_path / "042_test.wav")
+    t = np.arange(8000) / 10000
+    wav_write(wav_filename, 10000, (4000*np.sin(2*np.pi*300*t) + 2000*np.sin(2*np.pi*2200*t)).astype(np.int16))
+
+    results = [ encode_task( (wav_filename, rate_divider, None, True) ) for rate_divider in CANDIDATE_RATE_DIVIDERS ]
+    sizes = [ len(result.encoded) for result in results ]
+    snrs = [ result.snr_db for result in results ]
+
+    assert sizes == sorted(sizes, reverse=True)
+    assert snrs[0] > 10
+    # the 2200 Hz tone is above the 5kHz rate's Nyquist frequency, so that one is much worse
+    assert snrs[-1] < snrs[0] - 5
+
+
+def test_snr_of_short_decode(tmp_path):
+    wav_filename = str(tmp_path / "042_test.wav")
+    t = np.arange(4000) / 10000
+    s = 4000*np.sin(2*np.pi*300*t)
+    wav_write(wav_filename, 10000, s.astype(np.int16))
+    encoded = encode_single_file(wav_filename)
+
+    # only the first half decodes: the missing half counts as all noise (not as a repeat of the first half)
+    half = encoded[:len(encoded)//2 // FRAME_SIZE_BYTES * FRAME_SIZE_BYTES]
+    decoded = Decoder().decode_array(half)[1:]
+    padded = np.zeros(len(s))
+    padded[:len(decoded)] = decoded
+    gain = np.dot(s, padded) / np.dot(padded, padded)
+    expected = 10*np.log10(np.dot(s, s) / np.sum((s - gain*padded)**2))
+    assert measure_snr_db(wav_filename, half, 10000) == pytest.approx(expected, rel=1e-3)
+    assert expected < 5
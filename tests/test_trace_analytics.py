@@ -0,0 +1,59 @@
+from spana.synthetic import synthetic_image, write_em100_log, em100_log_chunks
+from spana.parse_trace import parse_read_operations, SPIFlashOperation
+from spana.trace_recording import TraceRecording, load_trace
+from spana.trace_analytics import analyze_trace
+from spana.encoder import FRAME_SIZE_BYTES
+import io
+import itertools
+
+
+def test_transcript_matches_played_entries(tmp_path):
+    image, otd = synthetic_image(num_entries=30, samples_per_entry=23*40)
+    log_filename = str(tmp_path / "trace.log")
+    with open(log_filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=400_000, status_poll_every=2)
+    with open(log_filename) as in_fo:
+        ops = list(parse_read_operations(in_fo))
+
+    # the entries em100_log_chunks looked up, in order
+    looked_up = [ (op.addr - 0xb)//5 for op in ops if op.addr is not None and op.len == 5 ]
+
+    analysis = analyze_trace(load_trace(log_filename), otd)
+    words = analysis.transcript()
+    assert [ word.entry_idx for word in words ] == looked_up
+    assert [ word.speech for word in words ] == [ otd[idx].speech for idx in looked_up ]
+    # every play but the last (where the log was cut off) went to the end of its entry
+    assert not analysis.plays.ended_early[:-1].any()
+    blob_len = otd[0].sound_data_end_addr - otd[0].sound_data_start_addr
+    assert (analysis.plays.bytes_read[:-1] == blob_len).all()
+    assert (analysis.plays.frames_consumed[:-1] == blob_len // FRAME_SIZE_BYTES).all()
+
+    e = analysis.entries
+    assert e.play_count.sum() == len(words)
+    assert (e.offset_table_reads == e.play_count).all()
+    assert e.bytes_read.sum() == analysis.plays.bytes_read.sum()
+    assert analysis.unmapped_reads == 0
+    assert analysis.num_reads == sum(1 for op in ops if op.command == 3)
+
+
+def test_cut_short_and_unmapped():
+    _, otd = synthetic_image(num_entries=5, samples_per_entry=23*40)
+    ote = otd[3]
+    def read(t, addr, length):
+        return SPIFlashOperation(3, "read", t, 0, addr, length, bytearray(length))
+    ops = [
+        read(0.0, 0xb + 5*3, 5),
+        read(0.1, ote.sound_data_start_addr, 120),
+        read(0.2, ote.sound_data_start_addr + 120, 120),
+        read(0.3, 0xfff00, 64),                     # past all the speech data
+        read(0.4, 0xb + 5*3, 5),
+        read(0.5, ote.sound_data_start_addr, 100),
+    ]
+    analysis = analyze_trace(TraceRecording.from_operations(ops), otd)
+    assert analysis.plays.entry_idx.tolist() == [3, 3]
+    assert analysis.plays.bytes_read.tolist() == [240, 100]
+    assert analysis.plays.frames_consumed.tolist() == [20, 8]
+    assert analysis.plays.ended_early.tolist() == [True, True]
+    assert analysis.entries.early_endings[3] == 2
+    assert (analysis.unmapped_reads, analysis.unmapped_bytes) == (1, 64)
+    assert [ str(word).endswith("(cut short)") for word in analysis.transcript() ] == [True, True]
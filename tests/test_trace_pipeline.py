@@ -0,0 +1,122 @@
+from spana.synthetic import synthetic_image, write_em100_log
+from spana.parse_trace import parse_read_operations, SPIFlashOperation
+from spana.trace_pipeline import TracePresenter, run_pipeline
+from spana.trace_recording import TraceRecording, TraceRecordingWriter
+from spana.cli import main as spana_main
+import spana
+import io
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(spana.__file__)))
+
+
+def read(addr, length, command_idx):
+    return SPIFlashOperation(3, "read", command_idx*1e-3, command_idx, addr, length, bytearray(range(length)))
+
+def status(command_idx):
+    return SPIFlashOperation(5, "read status register", command_idx*1e-3, command_idx, None, 0, bytearray())
+
+
+def test_presenter_coalesces():
+    _, otd = synthetic_image(num_entries=4, samples_per_entry=23*10)
+    presenter = TracePresenter(otd)
+    ops = [ read(0xb + 5*2, 5, 1), read(0x1000, 16, 2), read(0x1010, 16, 3), status(4), read(0x1020, 8, 5), read(0x2000, 16, 6) ]
+    lines = sum((presenter.add(op) for op in ops), []) + presenter.finish()
+    assert lines == [
+        "read addr=0x00015  len=    5  data_prefix=0001020304",
+        f" -> Read offset table index:   2 -> {otd[2].speech}",
+        "read addr=0x01000  len=   40  data_prefix=00010203040506070809  (3 reads, 1x read status register)",
+        "read addr=0x02000  len=   16  data_prefix=00010203040506070809",
+    ]
+    assert presenter.lines_coalesced == 3
+
+
+def write_log(tmp_path):
+    image, otd = synthetic_image(num_entries=10, samples_per_entry=23*50)
+    log_filename = str(tmp_path / "trace.log")
+    with open(log_filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=500_000, status_poll_every=2)
+    return image, otd, log_filename
+
+
+def test_pipeline_with_fake_em100(tmp_path):
+    image, otd, log_filename = write_log(tmp_path)
+    with open(log_filename) as in_fo:
+        ops = list(parse_read_operations(in_fo))
+
+    proc = subprocess.Popen([sys.executable, "-m", "spana.fake_em100", "--replay", log_filename, "--speed", "0"],
+        env=dict(os.environ, PYTHONPATH=SRC_DIR), stdout=subprocess.PIPE)
+    out_fo = io.StringIO()
+    with TraceRecordingWriter(str(tmp_path / "trace.sptrace")) as recorder:
+        stats = run_pipeline(proc.stdout, otd, out_fo=out_fo, recorder=recorder, max_lines_per_second=1e6)
+    assert proc.wait() == 0
+
+    assert stats.ops_parsed == len(ops)
+    assert list(TraceRecording(str(tmp_path / "trace.sptrace"))) == ops
+    assert stats.lines_dropped == 0 and stats.lines_written == len(out_fo.getvalue().splitlines())
+    assert stats.lines_coalesced > 0
+    assert "Read offset table index" in out_fo.getvalue()
+    assert stats.batches > 0 and stats.max_parse_lag_s >= 0
+
+
+def test_pipeline_rate_limit(tmp_path):
+    _, otd, log_filename = write_log(tmp_path)
+    with open(log_filename, "rb") as in_fo:
+        log = in_fo.read()
+
+    out_fo = io.StringIO()
+    stats = run_pipeline(io.BytesIO(log), otd, out_fo=out_fo, coalesce=False, max_lines_per_second=50)
+    assert stats.lines_dropped > 0
+    assert "lines dropped (output rate limit)" in out_fo.getvalue()
+    # the parser still saw everything
+    assert stats.ops_parsed == log.count(b"Time:")
+
+
+class FailingRecorder:
+    def write(self, op):
+        raise OSError("disk full")
+
+class BrokenPipeOut:
+    def write(self, text):
+        raise BrokenPipeError()
+
+    def flush(self):
+        pass
+
+
+@pytest.mark.parametrize("failure", ["recorder", "output"])
+def test_pipeline_failure_never_closing_input(tmp_path, failure):
+    """ Like em100, the input never ends by itself: a failing stage must stop it and raise, not hang """
+    _, otd, log_filename = write_log(tmp_path)
+    (read_fd, write_fd) = os.pipe()
+    with open(log_filename, "rb") as in_fo:
+        os.write(write_fd, in_fo.read(32768))
+
+    interrupted = []
+    def on_interrupt():
+        interrupted.append(True)
+        os.close(write_fd)
+
+    kwargs = dict(recorder=FailingRecorder(), out_fo=io.StringIO()) if failure == "recorder" else dict(out_fo=BrokenPipeOut())
+    t_start = time.monotonic()
+    with open(read_fd, "rb") as in_fo:
+        with pytest.raises(OSError):
+            run_pipeline(in_fo, otd, on_interrupt=on_interrupt, flush_interval=0.01, **kwargs)
+    assert interrupted
+    assert time.monotonic() - t_start < 5
+
+
+def test_live_trace_with_fake_em100(tmp_path, monkeypatch, capsys):
+    image, _ = synthetic_image(samples_per_entry=23*20)
+    image.save(str(tmp_path / "image.bin"))
+    monkeypatch.setenv("PYTHONPATH", SRC_DIR)
+
+    spana_main(["trace", "-B", str(tmp_path / "image.bin"), "--record", str(tmp_path / "live.sptrace"), "--cache-dir", str(tmp_path / "cache"),
+                "--em100-cmd", f"{sys.executable} -m spana.fake_em100 --speed 0 --max-ops 300"])
+    assert "300 operations" in capsys.readouterr().out
+    assert len(TraceRecording(str(tmp_path / "live.sptrace"))) == 300
+    assert len(os.listdir(tmp_path / "cache")) == 1      # the frame index, kept out of the real cache
@@ -0,0 +1,52 @@
+from spana.synthetic import synthetic_image, write_em100_log
+from spana.parse_trace import parse_read_operations, SPIFlashOperation
+from spana.trace_recording import TraceRecording, TraceRecordingWriter, convert_log, read_operations
+import pytest
+
+
+@pytest.fixture
+def log_filename(tmp_path):
+    image, otd = synthetic_image(num_entries=10, samples_per_entry=23*50)
+    filename = str(tmp_path / "trace.log")
+    with open(filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=300_000, status_poll_every=2)
+    return filename
+
+
+def test_round_trip(log_filename, tmp_path):
+    with open(log_filename) as in_fo:
+        ops = list(parse_read_operations(in_fo))
+
+    recording_filename = str(tmp_path / "trace.sptrace")
+    assert convert_log(log_filename, recording_filename) == len(ops)
+
+    rec = TraceRecording(recording_filename)
+    assert len(rec) == len(ops)
+    assert list(rec) == ops
+    assert list(read_operations(recording_filename)) == list(read_operations(log_filename))
+    assert rec.data.nbytes == sum(op.len for op in ops)
+
+    # random access
+    for idx in (0, 7, len(ops)//2, -1):
+        assert rec[idx] == ops[idx]
+        assert rec.op_data(idx).tobytes() == bytes(ops[idx].data)
+    with pytest.raises(IndexError):
+        rec[len(ops)]
+
+    start, stop = rec.time_range(ops[10].timestamp, ops[20].timestamp)
+    assert (start, stop) == (10, 20)
+    assert list(rec.iter_range(start, stop, chunk_len=3)) == ops[10:20]
+
+
+def test_no_data_and_empty(tmp_path):
+    filename = str(tmp_path / "small.sptrace")
+    status = SPIFlashOperation(command=5, command_str="read status register", timestamp=0.5, command_idx=1, addr=None, len=0, data=bytearray())
+    with TraceRecordingWriter(filename) as writer:
+        writer.write(status)
+    rec = TraceRecording(filename)
+    assert rec[0] == status and rec[0].addr is None
+
+    filename = str(tmp_path / "empty.sptrace")
+    TraceRecordingWriter(filename).close()
+    assert list(TraceRecording(filename)) == []
+    assert not TraceRecording.is_recording(__file__)
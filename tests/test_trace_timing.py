@@ -0,0 +1,51 @@
+from spana.synthetic import synthetic_image, write_em100_log
+from spana.trace_recording import load_trace
+from spana.trace_timing import analyze_timing, bytes_per_second, Distribution
+import numpy as np
+import pytest
+
+
+def test_timing_of_synthetic_trace(tmp_path):
+    image, otd = synthetic_image(num_entries=20, samples_per_entry=23*40)
+    # em100_log_chunks paces reads at each entry's playback rate
+    for ote in otd[1::2]:
+        ote.rate_divider = 250
+    log_filename = str(tmp_path / "trace.log")
+    with open(log_filename, "w") as out_fo:
+        write_em100_log(out_fo, image, otd, target_bytes=400_000, read_chunk_len=64, status_poll_every=1000)
+
+    report = analyze_timing(load_trace(log_filename), otd)
+    assert sorted(report.per_rate) == [200, 250]
+    for rate_stats in report.per_rate.values():
+        assert rate_stats.ratio == pytest.approx(1.0, rel=1e-3)
+        assert rate_stats.median_read_bytes == 64
+    assert report.lookup_latency.median == pytest.approx(20e-6)
+
+    # reads within a play are 64 bytes / playback rate apart; gaps between plays are 0.2-1.5s
+    assert report.in_play_gaps.min == pytest.approx(64 / bytes_per_second(200), rel=1e-3)
+    assert report.read_gaps.max > 0.2
+    assert report.required_bytes_per_s == pytest.approx((64 + 4) * bytes_per_second(200) / 64, rel=1e-3)
+    # at the default 1ms burst gap, only a lookup and the read right after it make a burst
+    assert report.burst_reads.count == report.num_reads - report.lookup_latency.count
+    assert report.burst_reads.max == 2
+
+    histograms = report.histograms()
+    for name in ("read_gaps", "in_play_gaps", "lookup_latency", "burst_bytes", "burst_reads"):
+        assert histograms[f"{name}_counts"].sum() + histograms[f"{name}_underflow"] == getattr(report, name).count
+    assert len(histograms["read_gaps_edges"]) == len(histograms["read_gaps_counts"]) + 1
+    assert np.isnan(report.entry_throughput[len(otd):]).all()
+    assert "rate_divider" in report.format()
+
+
+def test_distribution_counts_non_positive_values():
+    # reads with identical timestamps give zero gaps, which log-spaced bins can't hold
+    gaps = np.array([0.0, 0.0, 1e-5, 2e-4, 3e-3, 0.5])
+    dist = Distribution.of(gaps)
+    assert dist.count == 6 and dist.min == 0.0
+    assert dist.hist_underflow == 2
+    assert dist.hist_counts.sum() == 4 and dist.hist_edges[0] == 1e-5
+    assert "(2 <= 0)" in dist.format(1e3)
+
+    linear = Distribution.of(gaps, log_bins=False)
+    assert linear.hist_underflow == 0 and linear.hist_counts.sum() == 6
+    assert Distribution.of(np.zeros(3)).hist_counts.sum() == 3